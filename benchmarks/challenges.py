@@ -0,0 +1,90 @@
+"""Recorded agent runs for the tasks in `challenges/`.
+
+Each step is the code a model sent to the code interpreter when solving the task;
+`{{ DATALAB_API_URL }}` is replaced with the URL of the (mock) datalab API.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+
+CHALLENGES_DIR = Path(__file__).parent.parent / "challenges"
+
+LABBOOK_SCHEMA = """{"type": "object", "required": ["item_id", "name"], "properties": {
+"item_id": {"type": "string"}, "name": {"type": "string"}, "chemform": {"type": "string"},
+"date": {"type": "string", "format": "date"}, "description": {"type": "string"},
+"synthesis_constituents": {"type": "array"}, "synthesis_description": {"type": "string"}}}"""
+
+
+@dataclass(frozen=True)
+class Challenge:
+    name: str
+    question: str
+    steps: list[str]
+    final_answer: str
+    # whether the question comes with an image upload (a lab book page)
+    image: bool = False
+
+
+XRD = Challenge(
+    name="xrd",
+    question=(CHALLENGES_DIR / "xrd.md").read_text().strip(),
+    steps=[
+        """from datalab_api import DatalabClient
+client = DatalabClient("{{ DATALAB_API_URL }}")
+materials = client.get_items("starting_materials")
+parent = next(m for m in materials if m.get("barcode") == "AJ0002")
+print(parent)""",
+        """samples = [client.get_item(s["item_id"]) for s in client.get_items("samples")]
+children = [
+    s for s in samples
+    if any(c["item"]["item_id"] == parent["item_id"] for c in s.get("synthesis_constituents", []))
+]
+print([(s["item_id"], s["chemform"], [f["name"] for f in s["files"]]) for s in children])""",
+        """import numpy as np
+import matplotlib.pyplot as plt
+fig, ax = plt.subplots(figsize=(8, 6))
+for offset, sample in enumerate(children):
+    client.get_item_files(sample["item_id"])
+    for f in sample["files"]:
+        data = np.loadtxt(f["name"])
+        ax.plot(data[:, 0], data[:, 1] / data[:, 1].max() + offset, label=f"{sample['item_id']} ({sample['chemform']})")
+ax.set_xlabel("2θ (°)")
+ax.set_ylabel("Normalised intensity (offset)")
+ax.legend()
+plt.show()""",
+    ],
+    final_answer=(
+        "Here are the XRD patterns of the four samples made from AJ0002 (Co3O4):"
+        " jdb1-1, jdb1-2, jdb1-3 and jdb2-1, offset vertically for clarity."
+    ),
+)
+
+LABBOOK = Challenge(
+    name="labbook",
+    question=(CHALLENGES_DIR / "labbook.md").read_text().strip() + "\n\n" + LABBOOK_SCHEMA,
+    steps=[
+        """import json
+from datalab_api import DatalabClient
+client = DatalabClient("{{ DATALAB_API_URL }}")
+sample = {
+    "name": "NaCoO2 via solid state route",
+    "chemform": "NaCoO2",
+    "date": "2024-05-09",
+    "description": "Transcribed from lab book page 42.",
+    "synthesis_constituents": [
+        {"item": {"item_id": "AJ0001", "type": "starting_materials"}, "quantity": 0.53, "unit": "g"},
+        {"item": {"item_id": "AJ0002", "type": "starting_materials"}, "quantity": 0.80, "unit": "g"},
+    ],
+    "synthesis_description": "Ground in agate mortar, pelletised, fired at 850 °C for 12 h under O2.",
+}
+print(json.dumps(client.create_item("jdb4-1", "samples", sample), indent=2))""",
+        """item = client.get_item("jdb4-1")
+print({key: item[key] for key in ("item_id", "refcode", "name", "chemform", "date")})""",
+    ],
+    final_answer="I created the sample jdb4-1 (NaCoO2) from the lab book page.",
+    image=True,
+)
+
+CHALLENGES = {challenge.name: challenge for challenge in (XRD, LABBOOK)}
@@ -0,0 +1,138 @@
+"""Deterministic datalab fixtures for the benchmarks: a few starting materials,
+samples synthesised from them, their XRD files and the resulting item graph.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Any
+
+SERVER_VERSION = "0.4.0"
+
+STARTING_MATERIALS = [
+    {"item_id": "AJ0001", "barcode": "AJ0001", "name": "Sodium carbonate", "chemform": "Na2CO3"},
+    {"item_id": "AJ0002", "barcode": "AJ0002", "name": "Cobalt(II,III) oxide", "chemform": "Co3O4"},
+    {"item_id": "AJ0003", "barcode": "AJ0003", "name": "Lithium carbonate", "chemform": "Li2CO3"},
+]
+
+# (item_id, chemical formula, starting materials it was made from)
+SAMPLES = [
+    ("jdb1-1", "NaCoO2", ["AJ0001", "AJ0002"]),
+    ("jdb1-2", "Na0.7CoO2", ["AJ0001", "AJ0002"]),
+    ("jdb1-3", "NaCoO2", ["AJ0001", "AJ0002"]),
+    ("jdb2-1", "LiCoO2", ["AJ0003", "AJ0002"]),
+    ("jdb3-1", "Li2CO3", ["AJ0003"]),
+    ("jdb3-2", "Na2CO3", ["AJ0001"]),
+]
+
+# Reflections (2θ) of the simulated patterns, per formula
+REFLECTIONS = {
+    "NaCoO2": [16.1, 32.5, 36.2, 41.7, 49.6, 65.3],
+    "Na0.7CoO2": [15.8, 32.1, 35.9, 39.2, 46.8, 64.9],
+    "LiCoO2": [18.9, 37.4, 38.4, 39.1, 45.3, 59.6, 65.5],
+    "Li2CO3": [21.3, 29.4, 30.6, 31.8, 36.9, 48.8],
+    "Na2CO3": [30.1, 34.1, 35.3, 37.9, 38.2, 46.4],
+}
+
+XRD_POINTS = 4000
+
+
+def xrd_pattern(formula: str, points: int = XRD_POINTS) -> bytes:
+    """A simulated powder pattern as a two-column `.xy` file."""
+    lines = []
+    for idx in range(points):
+        two_theta = 10 + 60 * idx / (points - 1)
+        intensity = 50 + 5 * math.sin(idx)
+        for rank, peak in enumerate(REFLECTIONS[formula]):
+            intensity += 1000 / (rank + 1) * math.exp(-(((two_theta - peak) / 0.08) ** 2))
+        lines.append(f"{two_theta:.4f} {intensity:.2f}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _relationship(item_id: str) -> dict[str, Any]:
+    return {"item_id": item_id, "type": "starting_materials", "relation": "parent"}
+
+
+def build_items() -> tuple[dict[str, dict[str, Any]], dict[str, tuple[str, bytes]]]:
+    """Returns the items by id, and the files by immutable id as (name, contents)."""
+    items: dict[str, dict[str, Any]] = {}
+    files: dict[str, tuple[str, bytes]] = {}
+    for idx, material in enumerate(STARTING_MATERIALS):
+        items[material["item_id"]] = {
+            **material,
+            "type": "starting_materials",
+            "refcode": f"test:{material['item_id']}",
+            "immutable_id": f"{idx:024x}",
+            "relationships": [],
+            "files": [],
+            "file_ObjectIds": [],
+            "blocks_obj": {},
+            "display_order": [],
+        }
+    for idx, (item_id, formula, constituents) in enumerate(SAMPLES):
+        file_id = f"{idx + 100:024x}"
+        name = f"{item_id}_xrd.xy"
+        files[file_id] = (name, xrd_pattern(formula))
+        block_id = f"block{idx}"
+        items[item_id] = {
+            "item_id": item_id,
+            "type": "samples",
+            "refcode": f"test:{item_id.upper()}",
+            "immutable_id": f"{idx + 50:024x}",
+            "name": f"{formula} sample {item_id}",
+            "chemform": formula,
+            "synthesis_constituents": [
+                {
+                    "item": {"item_id": item, "type": "starting_materials"},
+                    "quantity": 1.0,
+                    "unit": "g",
+                }
+                for item in constituents
+            ],
+            "relationships": [_relationship(item) for item in constituents],
+            "files": [{"immutable_id": file_id, "name": name, "extension": ".xy"}],
+            "file_ObjectIds": [file_id],
+            "blocks_obj": {
+                block_id: {
+                    "block_id": block_id,
+                    "blocktype": "xrd",
+                    "file_id": file_id,
+                    "item_id": item_id,
+                }
+            },
+            "display_order": [block_id],
+        }
+    return items, files
+
+
+def summary(item: dict[str, Any]) -> dict[str, Any]:
+    """The item as it appears in listings and search results."""
+    return {
+        key: item[key]
+        for key in ("item_id", "type", "refcode", "name", "chemform", "barcode")
+        if key in item
+    }
+
+
+def item_graph(items: dict[str, dict[str, Any]], item_id: str | None = None) -> dict[str, Any]:
+    edges = [
+        {"data": {"id": f"{parent['item_id']}->{item['item_id']}", "source": parent["item_id"], "target": item["item_id"]}}
+        for item in items.values()
+        for parent in item.get("relationships", [])
+    ]
+    if item_id is not None:
+        edges = [
+            edge
+            for edge in edges
+            if item_id in (edge["data"]["source"], edge["data"]["target"])
+        ]
+        node_ids = {item_id} | {
+            end for edge in edges for end in (edge["data"]["source"], edge["data"]["target"])
+        }
+    else:
+        node_ids = set(items)
+    nodes = [
+        {"data": {"id": node, "name": items[node].get("name"), "type": items[node]["type"]}}
+        for node in sorted(node_ids)
+    ]
+    return {"status": "success", "nodes": nodes, "edges": edges}
@@ -0,0 +1,221 @@
+"""A local stand-in for the datalab API, seeded with the benchmark fixtures.
+
+It implements just enough of the API for `datalab_api.DatalabClient` to list,
+search, fetch, create and update items, download files and fetch the item graph,
+and counts the requests it serves.
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import re
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from fixtures import SERVER_VERSION, build_items, item_graph, summary
+
+ITEM_TYPE_ENDPOINTS = {
+    "samples": ("samples", "cells"),
+    "starting-materials": ("starting_materials",),
+    "equipment": ("equipment",),
+    "cells": ("cells",),
+}
+
+
+class MockDatalab:
+    """The in-memory state behind the mock server; `reset()` restores the fixtures."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.items, self.files = build_items()
+            self.requests: Counter[str] = Counter()
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "data": {
+                "id": "/",
+                "type": "info",
+                "attributes": {
+                    "server_version": SERVER_VERSION,
+                    "available_api_versions": ["0.1.0"],
+                    "identifier_prefix": "test",
+                },
+            }
+        }
+
+    def handle(
+        self, method: str, path: str, body: bytes, content_type: str
+    ) -> tuple[int, str, bytes]:
+        """Returns the status, content type and body of the response."""
+        url = urlsplit(path)
+        route = unquote(url.path).rstrip("/") or "/"
+        with self._lock:
+            # e.g. "GET /get-item-data/..." regardless of the item
+            endpoint = re.sub(r"^(/[^/]+)/.+$", r"\1/...", route)
+            self.requests[f"{method} {endpoint}"] += 1
+            status, payload = self._dispatch(method, route, parse_qs(url.query), body, content_type)
+        if isinstance(payload, bytes):
+            return status, "application/octet-stream", payload
+        if isinstance(payload, str):
+            return status, "text/html", payload.encode()
+        return status, "application/json", json.dumps(payload).encode()
+
+    def _dispatch(
+        self,
+        method: str,
+        route: str,
+        query: dict[str, list[str]],
+        body: bytes,
+        content_type: str,
+    ) -> tuple[int, Any]:
+        if method == "GET":
+            if route == "/":
+                return 200, "<html><head><title>datalab API</title></head></html>"
+            if route == "/info":
+                return 200, self.info()
+            if route == "/info/blocks":
+                return 200, {"data": [{"id": "xrd", "type": "block_type", "attributes": {"name": "Powder XRD"}}]}
+            if route == "/get-current-user":
+                return 200, {"display_name": "Benchmark User", "immutable_id": "0" * 24}
+            if route.lstrip("/") in ITEM_TYPE_ENDPOINTS:
+                types = ITEM_TYPE_ENDPOINTS[route.lstrip("/")]
+                return 200, {
+                    "status": "success",
+                    "items": [summary(item) for item in self.items.values() if item["type"] in types],
+                }
+            if route == "/search-items":
+                terms = query.get("query", [""])[0].lower()
+                types = query.get("types", ["samples"])[0].split(",")
+                return 200, {
+                    "status": "success",
+                    "items": [
+                        summary(item)
+                        for item in self.items.values()
+                        if item["type"] in types
+                        and terms in json.dumps(summary(item)).lower()
+                    ],
+                }
+            if match := re.fullmatch(r"/get-item-data/([^/]+)", route):
+                if (item := self.items.get(match.group(1))) is None:
+                    return 404, {"status": "error", "message": "Item not found"}
+                return 200, {"status": "success", "item_data": copy.deepcopy(item)}
+            if match := re.fullmatch(r"/item-graph(?:/([^/]+))?", route):
+                return 200, item_graph(self.items, match.group(1))
+            if match := re.fullmatch(r"/files/([^/]+)/([^/]+)", route):
+                if (file := self.files.get(match.group(1))) is None:
+                    return 404, {"status": "error", "message": "File not found"}
+                return 200, file[1]
+            if match := re.fullmatch(r"/collections/([^/]+)", route):
+                return 404, {"status": "error", "message": "Collection not found"}
+            return 404, {"status": "error", "message": f"No route {route}"}
+
+        if method == "POST" and route == "/new-sample":
+            data = json.loads(body)["new_sample_data"]
+            item_id = data.get("item_id") or f"auto{len(self.items)}"
+            if item_id in self.items:
+                return 409, {"status": "error", "message": "DuplicateKeyError"}
+            item = {
+                "relationships": [],
+                "files": [],
+                "file_ObjectIds": [],
+                "blocks_obj": {},
+                "display_order": [],
+                **data,
+                "item_id": item_id,
+                "refcode": f"test:{item_id.upper()}",
+            }
+            self.items[item_id] = item
+            return 201, {"status": "success", "sample_list_entry": summary(item)}
+        if method == "POST" and route == "/save-item":
+            payload = json.loads(body)
+            if (item := self.items.get(payload["item_id"])) is None:
+                return 404, {"status": "error", "message": "Item not found"}
+            item.update(payload["data"])
+            return 200, {"status": "success"}
+        if method == "POST" and route == "/upload-file":
+            item_id = re.search(rb'name="item_id"\r\n\r\n([^\r\n]+)', body)
+            name = re.search(
+                rb'name="file"; filename="([^"]+)"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--',
+                body,
+                re.DOTALL,
+            )
+            if not (item_id and name) or (item := self.items.get(item_id.group(1).decode())) is None:
+                return 400, {"status": "error", "message": "Bad upload"}
+            file_id = f"{len(self.files) + 1000:024x}"
+            self.files[file_id] = (name.group(1).decode(), name.group(2))
+            item["files"].append({"immutable_id": file_id, "name": name.group(1).decode()})
+            item["file_ObjectIds"].append(file_id)
+            return 201, {"status": "success", "file_id": file_id}
+        if method == "POST" and route == "/add-data-block":
+            payload = json.loads(body)
+            if (item := self.items.get(payload["item_id"])) is None:
+                return 404, {"status": "error", "message": "Item not found"}
+            block_id = f"block{sum(len(i['blocks_obj']) for i in self.items.values())}"
+            block = {"block_id": block_id, "blocktype": payload["block_type"], "item_id": item["item_id"]}
+            item["blocks_obj"][block_id] = block
+            item["display_order"].append(block_id)
+            return 200, {"status": "success", "new_block_obj": block}
+        if method == "POST" and route == "/update-block":
+            payload = json.loads(body)
+            block = dict(payload["block_data"])
+            if payload.get("save_to_db") and (item := self.items.get(block.get("item_id"))):
+                item["blocks_obj"][block["block_id"]] = block
+            return 200, {"status": "success", "new_block_data": block}
+        return 405, {"status": "error", "message": f"{method} {route} is not supported"}
+
+
+class MockDatalabServer:
+    """Serves a `MockDatalab` on `http://127.0.0.1:<port>` from a background thread."""
+
+    def __init__(self, port: int = 0):
+        self.datalab = MockDatalab()
+        datalab = self.datalab
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):  # noqa: A002
+                pass
+
+            def do_GET(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, content_type, payload = datalab.handle(
+                    self.command, self.path, body, self.headers.get("Content-Type", "")
+                )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_POST = do_PUT = do_GET
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+
+
+if __name__ == "__main__":
+    import time
+
+    server = MockDatalabServer(port=8081)
+    print(f"Mock datalab API running at {server.url}")
+    while True:
+        time.sleep(3600)
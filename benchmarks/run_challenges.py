@@ -0,0 +1,227 @@
+"""Offline end-to-end benchmark of the agent on the tasks in `challenges/`.
+
+The real `AgentExecutor` and `local_codebox_tool` (with warm kernels, the datalab
+caching proxy and output reduction) are driven by a scripted chat model against
+a local mock datalab API, so runs are free, repeatable and comparable:
+
+    python benchmarks/run_challenges.py --repeat 3 --json results.json
+    python benchmarks/run_challenges.py --baseline results.json
+
+With `--baseline`, the exit code is 1 if any challenge got slower (wall time)
+or bigger (tokens, memory) than the baseline by more than `--tolerance`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "streamlit_app"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+# the kernels inherit this when they are started
+os.environ.setdefault("DATALAB_API_KEY", "benchmark")
+
+from langchain.agents import AgentExecutor, create_tool_calling_agent  # noqa: E402
+from langchain.callbacks.base import BaseCallbackHandler  # noqa: E402
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from attachments import AttachmentStore, resolve_attachments  # noqa: E402
+from challenges import CHALLENGES, Challenge  # noqa: E402
+from datalab_cache import get_datalab_proxy  # noqa: E402
+from docs_index import DOCS_RETRIEVAL, docs_lookup_tool, inject_docs  # noqa: E402
+from kernel_scheduler import KernelScheduler  # noqa: E402
+from mock_datalab import MockDatalabServer  # noqa: E402
+from parallel_tools import PARALLEL_TOOL_CALLS, ParallelAgentExecutor  # noqa: E402
+from prompting import PromptCacheStatsHandler, build_system_prompt  # noqa: E402
+from scripted_llm import ScriptedChatModel  # noqa: E402
+from tools import SESSION_ID, LocalCodeBoxToolRunManager, local_codebox_tool  # noqa: E402
+
+messages_template = ChatPromptTemplate.from_messages(
+    [
+        MessagesPlaceholder(variable_name="chat_history"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ]
+)
+
+# Metrics compared against a baseline; lower is better for all of them
+REGRESSION_METRICS = ("wall_time_s", "prompt_tokens", "output_tokens", "peak_python_memory_mb")
+
+
+class ToolTimingHandler(BaseCallbackHandler):
+    """Counts tool calls and the time spent in them, i.e. waiting for the kernel."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+        self._started: dict[UUID, float] = {}
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.calls += 1
+        self._started[run_id] = time.perf_counter()
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self.seconds += time.perf_counter() - self._started.pop(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self.seconds += time.perf_counter() - self._started.pop(run_id)
+
+
+def _lab_book_page(store: AttachmentStore) -> dict[str, Any]:
+    """A stand-in photo of a lab book page, as an attachment block."""
+    image = Image.new("RGB", (2400, 3200), "white")
+    draw = ImageDraw.Draw(image)
+    for line, text in enumerate(
+        ["9/5/24  NaCoO2 (jdb4-1)", "Na2CO3 AJ0001 0.53 g", "Co3O4 AJ0002 0.80 g", "850 C 12 h, O2"]
+    ):
+        draw.text((200, 300 + 200 * line), text, fill="black")
+    path = Path(tempfile.mkstemp(suffix=".png")[1])
+    image.save(path)
+    attachment = store.put(path.read_bytes(), "labbook.png", "image/png")
+    path.unlink()
+    return attachment.as_block()
+
+
+def run_challenge(
+    challenge: Challenge, datalab_url: str, store: AttachmentStore, session_id: str
+) -> dict[str, Any]:
+    steps = [step.replace("{{ DATALAB_API_URL }}", datalab_url) for step in challenge.steps]
+    llm = ScriptedChatModel(steps=steps, final_answer=challenge.final_answer)
+    tools = [local_codebox_tool, docs_lookup_tool] if DOCS_RETRIEVAL else [local_codebox_tool]
+    agent = create_tool_calling_agent(llm.bind_tools(tools), tools, messages_template)
+    executor_class = ParallelAgentExecutor if PARALLEL_TOOL_CALLS else AgentExecutor
+    agent_executor = executor_class(agent=agent, tools=tools)
+
+    content: list[dict[str, Any]] = [{"type": "text", "text": challenge.question}]
+    if challenge.image:
+        content.append(_lab_book_page(store))
+    chat_history = resolve_attachments(
+        [
+            {"role": "system", "content": build_system_prompt(datalab_url)},
+            {"role": "user", "content": content},
+        ],
+        store,
+    )
+    if DOCS_RETRIEVAL:
+        chat_history = inject_docs(chat_history)
+
+    timing = ToolTimingHandler()
+    cache_stats = PromptCacheStatsHandler()
+    token = SESSION_ID.set(session_id)
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        response = agent_executor.invoke(
+            {"chat_history": chat_history}, {"callbacks": [timing, cache_stats]}
+        )
+    finally:
+        wall_time = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        SESSION_ID.reset(token)
+        LocalCodeBoxToolRunManager.release(session_id)
+
+    return {
+        "challenge": challenge.name,
+        "wall_time_s": round(wall_time, 3),
+        "kernel_time_s": round(timing.seconds, 3),
+        "tool_calls": timing.calls,
+        "llm_calls": cache_stats.stats.calls,
+        "prompt_tokens": cache_stats.stats.input_tokens,
+        "output_tokens": cache_stats.stats.output_tokens,
+        "peak_python_memory_mb": round(peak / 1024**2, 2),
+        "answered": response["output"] == challenge.final_answer,
+    }
+
+
+def summarise(results: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """The median of each metric over the repeats of each challenge."""
+    summary: dict[str, dict[str, Any]] = {}
+    for name in dict.fromkeys(result["challenge"] for result in results):
+        runs = [result for result in results if result["challenge"] == name]
+        summary[name] = {
+            key: statistics.median(run[key] for run in runs)
+            for key, value in runs[0].items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        summary[name]["answered"] = all(run["answered"] for run in runs)
+    return summary
+
+
+def compare(
+    summary: dict[str, dict[str, Any]], baseline: dict[str, dict[str, Any]], tolerance: float
+) -> list[str]:
+    regressions = []
+    for name, metrics in summary.items():
+        if name.startswith("_"):
+            continue
+        for key in REGRESSION_METRICS:
+            before = baseline.get(name, {}).get(key)
+            if before and metrics[key] > before * (1 + tolerance):
+                regressions.append(f"{name}: {key} {before} -> {metrics[key]}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--challenge", action="append", choices=sorted(CHALLENGES), help="Defaults to all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-proxy", action="store_true", help="Talk to the mock datalab directly")
+    parser.add_argument("--json", type=Path, help="Write the summary here")
+    parser.add_argument("--baseline", type=Path, help="A summary written by a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    server = MockDatalabServer()
+    datalab_url = server.url if args.no_proxy else get_datalab_proxy(server.url).url
+    store = AttachmentStore(Path(tempfile.mkdtemp(prefix="benchmark-attachments-")))
+
+    # don't count the kernel start-up
+    with KernelScheduler.instance().lease("benchmark-warmup"):
+        pass
+    KernelScheduler.instance().release_session("benchmark-warmup")
+
+    results = []
+    for name in args.challenge or sorted(CHALLENGES):
+        for repeat in range(args.repeat):
+            server.datalab.reset()
+            result = run_challenge(CHALLENGES[name], datalab_url, store, f"benchmark-{name}-{repeat}")
+            result["datalab_requests"] = sum(server.datalab.requests.values())
+            results.append(result)
+            print(json.dumps(result))
+
+    summary = summarise(results)
+    summary["_process"] = {
+        # kilobytes on Linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "kernels": KernelScheduler.instance().metrics(),
+    }
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        args.json.write_text(json.dumps(summary, indent=2))
+
+    failed = [name for name, metrics in summary.items() if not name.startswith("_") and not metrics["answered"]]
+    if failed:
+        print(f"Challenges that did not complete: {', '.join(failed)}")
+        return 1
+    if args.baseline:
+        regressions = compare(summary, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
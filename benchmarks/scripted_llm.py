@@ -0,0 +1,87 @@
+"""A deterministic chat model that replays recorded tool calls.
+
+Each call looks at how many tool results have come back since the latest user
+message and emits the next recorded call to the first bound tool, then the final
+answer. Token usage is estimated from the actual request (messages and tool
+definitions), so prompt growth over the agent loop is still measured.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Sequence
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from history import estimate_tokens
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Replays `steps` (the code for each tool call) and then answers `final_answer`.
+
+    Parameters
+    ----------
+    steps
+        The code sent to the code interpreter at each step of the agent loop.
+    final_answer
+        The answer returned once every step has run.
+
+    """
+
+    steps: list[str]
+    final_answer: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: Sequence[BaseTool | dict[str, Any]], **kwargs: Any):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    @staticmethod
+    def _step(messages: list[BaseMessage]) -> int:
+        """The number of tool results since the latest user message."""
+        step = 0
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                break
+            if isinstance(message, ToolMessage):
+                step += 1
+        return step
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        step = self._step(messages)
+        if step < len(self.steps):
+            tool_name = kwargs["tools"][0]["function"]["name"]
+            message = AIMessage(
+                content="",
+                tool_calls=[
+                    {"name": tool_name, "args": {"code": self.steps[step]}, "id": f"call_{step}"}
+                ],
+            )
+            output_tokens = estimate_tokens(self.steps[step])
+        else:
+            message = AIMessage(content=self.final_answer)
+            output_tokens = estimate_tokens(self.final_answer)
+
+        input_tokens = sum(estimate_tokens(m.content) for m in messages)
+        input_tokens += estimate_tokens(json.dumps(kwargs.get("tools", [])))
+        usage = {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        message.response_metadata["usage"] = usage
+        return ChatResult(
+            generations=[ChatGeneration(message=message)], llm_output={"usage": usage}
+        )
+
+
+__all__ = ("ScriptedChatModel",)
@@ -0,0 +1,160 @@
+"""Runs the agent in the background so that a turn can be stopped.
+
+Every turn runs `AgentExecutor.ainvoke` as a task on one event loop thread
+shared by all sessions; the LLM clients are cached across turns and sessions, and
+their async HTTP connections belong to the loop they were opened on. Each task
+carries its session's Streamlit script context (so callbacks render into the
+right session) and session id (so tool calls find the session's kernel). The
+script thread only waits for it, which keeps it responsive to the Stop button:
+cancelling the run cancels the in-flight LLM request and interrupts the kernel if
+code is running.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Callable
+
+from langchain.agents import AgentExecutor
+from langchain_core.callbacks import BaseCallbackHandler
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.runtime.scriptrunner.script_run_context import (
+    SCRIPT_RUN_CONTEXT_ATTR_NAME,
+    ScriptRunContext,
+)
+
+from kernel_scheduler import KernelScheduler
+from tools import SESSION_ID
+
+# Sync tools (each blocked on a kernel) and callbacks run in this many threads
+AGENT_RUN_MAX_WORKERS = 32
+
+_script_run_ctx: ContextVar[ScriptRunContext | None] = ContextVar(
+    "agent_run_script_run_ctx", default=None
+)
+
+
+class _LoopThread(threading.Thread):
+    """Streamlit looks up the script context on the current thread; on the loop
+    thread, it is the context of whichever task is running.
+    """
+
+
+setattr(_LoopThread, SCRIPT_RUN_CONTEXT_ATTR_NAME, property(lambda self: _script_run_ctx.get()))
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(
+                ThreadPoolExecutor(max_workers=AGENT_RUN_MAX_WORKERS, thread_name_prefix="agent-run")
+            )
+            _LoopThread(target=_loop.run_forever, name="agent-runs", daemon=True).start()
+        return _loop
+
+
+class AgentRun:
+    """One agent turn, running in the background.
+
+    Parameters
+    ----------
+    agent_executor
+        The agent to run.
+    inputs
+        The inputs of the turn, e.g. `{"chat_history": [...]}`.
+    callbacks
+        Callback handlers for the run.
+    session_id
+        The session the tool calls belong to.
+
+    """
+
+    def __init__(
+        self,
+        agent_executor: AgentExecutor,
+        inputs: dict[str, Any],
+        callbacks: list[BaseCallbackHandler],
+        session_id: str,
+    ):
+        self.session_id = session_id
+        self.callbacks = callbacks
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self.response: dict[str, Any] | None = None
+        self.error: BaseException | None = None
+        self.cancelled = False
+
+        self._done = threading.Event()
+        self._future: Future = asyncio.run_coroutine_threadsafe(
+            self._invoke(agent_executor, inputs, get_script_run_ctx()), _get_loop()
+        )
+        self._future.add_done_callback(self._finish)
+
+    async def _invoke(
+        self, agent_executor: AgentExecutor, inputs: dict[str, Any], ctx: ScriptRunContext | None
+    ) -> dict[str, Any]:
+        # both are local to this task, and copied into the threads running tools
+        _script_run_ctx.set(ctx)
+        SESSION_ID.set(self.session_id)
+        return await agent_executor.ainvoke(inputs, {"callbacks": self.callbacks})
+
+    def _finish(self, future: Future) -> None:
+        if future.cancelled():
+            self.cancelled = True
+        elif (exc := future.exception()) is not None:
+            self.error = exc
+        else:
+            self.response = future.result()
+        status = "cancelled" if self.cancelled else "error" if self.error is not None else "ok"
+        for callback in self.callbacks:
+            # e.g. end the trace of a turn that was stopped half-way through
+            if hasattr(callback, "close"):
+                callback.close(status)
+        self.finished = time.monotonic()
+        self._done.set()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def cancel(self) -> None:
+        """Stop the run: cancel the pending LLM request or tool call, and interrupt
+        the code running in the session's kernel.
+        """
+        if self.done or not self._future.cancel():
+            return
+        if KernelScheduler.instance().interrupt(self.session_id):
+            print(f"Interrupted kernel of session {self.session_id}")
+
+    def wait(self, heartbeat: Callable[[], None] | None = None, interval: float = 0.5) -> None:
+        """Block until the run is over, calling `heartbeat` every `interval` seconds.
+
+        In a Streamlit script, `heartbeat` should update an element: Streamlit only
+        interrupts the script for a rerun (e.g. when Stop is clicked) when it
+        renders something.
+        """
+        while not self._done.wait(interval):
+            if heartbeat is not None:
+                heartbeat()
+
+    def detach(self) -> None:
+        """Stop rendering the run, once the script run that displayed it is gone."""
+        for callback in self.callbacks:
+            if hasattr(callback, "detach"):
+                callback.detach()
+
+
+__all__ = ("AgentRun",)
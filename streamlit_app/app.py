@@ -1,9 +1,7 @@
+import json
 import os
-from pathlib import Path
-import base64
 
 from langchain.agents import create_tool_calling_agent, AgentExecutor
-from langchain_anthropic import ChatAnthropic
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage
@@ -13,15 +11,28 @@ import streamlit as st
 
 from dotenv import load_dotenv, find_dotenv
 
-from tools import local_codebox_tool, LocalCodeBoxToolRunManager
+from tools import local_codebox_tool, LocalCodeBoxToolRunManager, current_session_id
+from agent_runner import AgentRun
+from file_browser import FileIndex, render_file_browser
+from kernel_scheduler import KernelScheduler, session_workdir
 from streamlit_callback import CustomStreamlitCallbackHandler
+from attachments import VISION_MIME_TYPES, AttachmentStore, resolve_attachments
+from history import ChatHistoryManager
+from session_store import process_memory
+from tracing import TracingCallbackHandler
+from router import MODEL_ROUTING, ModelRouter, RoutingLog
+from docs_index import DOCS_RETRIEVAL, docs_lookup_tool, inject_docs
+from parallel_tools import PARALLEL_TOOL_CALLS, ParallelAgentExecutor
+from datalab_cache import DATALAB_CACHE_PROXY, get_datalab_proxy
+from prompting import (
+    CachingChatAnthropic,
+    PromptCacheStatsHandler,
+    build_system_prompt,
+)
 
 # Load environment variables but we'll prioritize user-provided keys
 load_dotenv(find_dotenv())
 
-DATALAB_API_PROMPT: str = (
-    Path(__file__).parent.parent / "prompts" / "datalab-api-prompt.md"
-).read_text()
 MODEL_OPTIONS = {
     "Claude 3 Haiku": "claude-3-5-haiku-latest",
     "Claude 3.7 Sonnet": "claude-3-7-sonnet-latest",
@@ -31,17 +42,26 @@ MODEL_OPTIONS = {
 }
 DEFAULT_MODEL = "claude-3-haiku-20240307"
 
-DEFAULT_DATALAB_API_URL = "https://demo.datalab-org.io"
+# Estimated tokens of chat history sent with each turn, leaving room in the
+# context window for the agent scratchpad and the answer
+MODEL_HISTORY_TOKEN_BUDGETS = {
+    "claude-3-5-haiku-latest": 60_000,
+    "claude-3-7-sonnet-latest": 80_000,
+    "gpt-4o": 40_000,
+    "o3-mini": 60_000,
+    "gpt-3.5-turbo": 8_000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 30_000
 
-SYSTEM_PROMPT = f"""You are a virtual data management assistant that helps materials chemists
-manage their experimental data and plan experiments. 
-You can use a code interpreter tool to assist you (only if needed). If you use the code interpreter, 
-DO NOT EXPLAIN THE CODE. Instead, just use the output of the code
-to answer the question the user asked. 
-Here is some more info about the datalab API: {DATALAB_API_PROMPT}"""
+# Distinct (model, API key) pairs whose clients are kept open
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 16))
 
+DEFAULT_DATALAB_API_URL = "https://demo.datalab-org.io"
 
-codebox = LocalCodeBoxToolRunManager.instance().codebox
+# Start warming up kernels before the first tool call needs one
+KernelScheduler.instance()
+# Delete what was kept for sessions whose browser tab has since been closed
+LocalCodeBoxToolRunManager.release_ended_sessions()
 
 
 def initialize_api_keys():
@@ -65,26 +85,82 @@ def initialize_api_keys():
     if "selected_model" not in st.session_state:
         st.session_state.selected_model = DEFAULT_MODEL
 
+    if "model_routing" not in st.session_state:
+        st.session_state.model_routing = MODEL_ROUTING
 
-def get_llm():
-    """Get the LLM based on the selected model and API keys"""
-    model_name = st.session_state.selected_model
 
+def llm_api_key(model_name: str) -> str | None:
+    """The API key the user gave for the provider of `model_name`."""
     if model_name.startswith("claude"):
-        if not st.session_state.anthropic_api_key:
-            return None
-        return ChatAnthropic(
-            anthropic_api_key=st.session_state.anthropic_api_key,
-            model=model_name,
-        )
+        return st.session_state.anthropic_api_key or None
     elif model_name.startswith("gpt") or model_name.startswith("o3"):
-        if not st.session_state.openai_api_key:
-            return None
-        return ChatOpenAI(
-            api_key=st.session_state.openai_api_key,
+        return st.session_state.openai_api_key or None
+    return None
+
+
+@st.cache_resource(max_entries=LLM_CACHE_MAX_ENTRIES, show_spinner=False)
+def create_llm(model_name: str, api_key: str):
+    """One client per model and API key, shared by all sessions and reruns so that
+    its HTTP connections to the provider are kept alive between turns.
+    """
+    if model_name.startswith("claude"):
+        # marks the static system prompt and tool definitions as cacheable
+        return CachingChatAnthropic(
+            anthropic_api_key=api_key,
             model=model_name,
+            streaming=True,
         )
-    return None
+    return ChatOpenAI(
+        api_key=api_key,
+        model=model_name,
+        streaming=True,
+    )
+
+
+def routed_models() -> tuple[tuple[str, str], ...]:
+    """(model, API key) of every model the router may use: those with a key."""
+    return tuple(
+        (model_name, api_key)
+        for model_name in dict.fromkeys([st.session_state.selected_model, *MODEL_OPTIONS.values()])
+        if (api_key := llm_api_key(model_name)) is not None
+    )
+
+
+@st.cache_resource(max_entries=LLM_CACHE_MAX_ENTRIES, show_spinner=False)
+def create_router(primary: str, models: tuple[tuple[str, str], ...]) -> ModelRouter:
+    return ModelRouter(
+        primary, {model_name: create_llm(model_name, api_key) for model_name, api_key in models}
+    )
+
+
+def get_llm():
+    """Get the LLM based on the selected model and API keys; in routing mode, a
+    router between the selected model and every other model with a key.
+    """
+    model_name = st.session_state.selected_model
+    if (api_key := llm_api_key(model_name)) is None:
+        return None
+    if st.session_state.model_routing:
+        return create_router(model_name, routed_models())
+    return create_llm(model_name, api_key)
+
+
+@st.cache_resource(max_entries=LLM_CACHE_MAX_ENTRIES, show_spinner=False)
+def create_agent_executor(
+    model_name: str, api_key: str, routed: tuple[tuple[str, str], ...] = ()
+) -> AgentExecutor:
+    """The agent for a model and API key; it holds no per-session state (callbacks
+    and chat history are passed to each run), so it is shared like the LLM.
+    With `routed` models, each step goes to one of them (see `ModelRouter`).
+    With `PARALLEL_TOOL_CALLS`, independent tool calls of a step run concurrently
+    (see `ParallelAgentExecutor`).
+    """
+    tools = [local_codebox_tool, docs_lookup_tool] if DOCS_RETRIEVAL else [local_codebox_tool]
+    llm = create_router(model_name, routed) if routed else create_llm(model_name, api_key)
+    llm_with_tools = llm.bind_tools(tools)
+    agent = create_tool_calling_agent(llm_with_tools, tools, messages_template)
+    executor_class = ParallelAgentExecutor if PARALLEL_TOOL_CALLS else AgentExecutor
+    return executor_class(agent=agent, tools=tools, verbose=True)
 
 
 messages_template = ChatPromptTemplate.from_messages(
@@ -169,25 +245,102 @@ with st.sidebar:
             st.session_state.api_keys_submitted = True
             st.success("API keys saved!")
 
+    st.toggle(
+        "Route between models",
+        value=st.session_state.model_routing,
+        key="model_routing_toggle",
+        on_change=lambda: st.session_state.update(
+            model_routing=st.session_state.model_routing_toggle
+        ),
+        help=(
+            "Use a fast model for simple steps (short questions, reading results) and "
+            "a strong one for planning and after repeated failures, falling back to "
+            "another provider on timeouts or rate limits. Uses every model with a key."
+        ),
+    )
+
 # Initialize the session state for chat messages
 if "messages" not in st.session_state:
-    st.session_state.messages = [{"role": "system", "content": SYSTEM_PROMPT.replace("{{ DATALAB_API_URL }}", st.session_state.datalab_api_url)}]
+    # generated code reads the datalab API through a caching proxy shared by all sessions
+    datalab_proxy_url = (
+        get_datalab_proxy(st.session_state.datalab_api_url).url
+        if DATALAB_CACHE_PROXY
+        else None
+    )
+    st.session_state.messages = [
+        {
+            "role": "system",
+            "content": build_system_prompt(
+                st.session_state.datalab_api_url, datalab_proxy_url
+            ),
+        }
+    ]
 
-if "files" not in st.session_state:
-    st.session_state.files = codebox.list_files()
+if "attachment_store" not in st.session_state:
+    st.session_state.attachment_store = AttachmentStore()
+
+if "history_manager" not in st.session_state:
+    st.session_state.history_manager = ChatHistoryManager()
+
+if "prompt_cache_stats" not in st.session_state:
+    st.session_state.prompt_cache_stats = []
+
+if "file_index" not in st.session_state:
+    # the session's own files only, where its kernel works
+    st.session_state.file_index = FileIndex(session_workdir(current_session_id()))
 
 # Display files in sidebar
 with st.sidebar:
     st.header("Files")
-    if st.session_state.files:
-        for file in st.session_state.files:
-            with open(os.path.join(".codebox", file.name), "rb") as f:
-                btn = st.download_button(
-                    label=file.name,
-                    data=f.read(),
-                    file_name=file.name,
-                    mime="image/png",
-                )
+    render_file_browser(st.session_state.file_index)
+
+    with st.expander("Kernels", expanded=False):
+        st.json(KernelScheduler.instance().metrics())
+
+    with st.expander("Memory", expanded=False):
+        st.caption("This session")
+        # read only: sessions that never ran code have no state to show
+        manager = LocalCodeBoxToolRunManager.get(current_session_id())
+        st.json({
+            **(manager.memory_usage() if manager is not None else {}),
+            "chat_messages_bytes": sum(
+                len(json.dumps(message, default=str)) for message in st.session_state.messages
+            ),
+        })
+        st.caption("Whole app")
+        st.json(process_memory())
+
+    if st.session_state.model_routing:
+        with st.expander("Model routing", expanded=False):
+            st.json(RoutingLog.instance().summary())
+            st.caption("Latest decisions")
+            st.dataframe(
+                [
+                    {
+                        "model": record.model,
+                        "reason": f"{record.tier}: {record.reason}",
+                        "latency_s": round(record.latency_s, 2),
+                        "cost_usd": round(record.cost_usd, 5),
+                        "fell_back_from": ", ".join(record.fell_back_from),
+                    }
+                    for record in reversed(RoutingLog.instance().records()[-10:])
+                ],
+                hide_index=True,
+            )
+
+    if DATALAB_CACHE_PROXY:
+        with st.expander("Datalab API cache", expanded=False):
+            st.json(get_datalab_proxy(st.session_state.datalab_api_url).cache.metrics())
+
+    if st.session_state.prompt_cache_stats:
+        with st.expander("Prompt cache", expanded=False):
+            st.caption("Last turn")
+            st.json(st.session_state.prompt_cache_stats[-1])
+            st.caption("Whole session")
+            st.json({
+                key: sum(turn[key] for turn in st.session_state.prompt_cache_stats)
+                for key in ("calls", "cache_hits", "cache_misses", "input_tokens", "cached_tokens", "cache_write_tokens")
+            })
 
 # Check if required API keys are provided
 llm = get_llm()
@@ -197,14 +350,12 @@ if not llm:
     )
     st.stop()
 
-tools = [local_codebox_tool]
-
-# bind tools
-llm_with_tools = llm.bind_tools(tools)
-
-# Initialize the conversational agent
-agent = create_tool_calling_agent(llm_with_tools, tools, messages_template)
-agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+# changing the model or key in the sidebar selects (or creates) another cached agent
+agent_executor = create_agent_executor(
+    st.session_state.selected_model,
+    llm_api_key(st.session_state.selected_model),
+    routed_models() if st.session_state.model_routing else (),
+)
 
 # Display the chat history
 for message in st.session_state.messages:
@@ -215,8 +366,15 @@ for message in st.session_state.messages:
         else:
             st.markdown(message["content"])
 
-# Capture the user's input
-question = st.chat_input("Give me a task or ask me any question")
+# from a turn that ended while its script run was being replaced
+if (agent_run_error := st.session_state.pop("agent_run_error", None)) is not None:
+    st.exception(agent_run_error)
+
+# Capture the user's input; one turn at a time
+agent_run: AgentRun | None = st.session_state.get("agent_run")
+question = st.chat_input(
+    "Give me a task or ask me any question", disabled=agent_run is not None
+)
 uploaded_file = st.file_uploader("Choose a file")
 
 
@@ -229,28 +387,24 @@ uploaded_file = st.file_uploader("Choose a file")
 
 if question:
     if uploaded_file is not None:
-        file_bytes = uploaded_file.getvalue()
-        with open(os.path.join(".codebox", uploaded_file.name), "wb") as f:
-            f.write(file_bytes)
-
-        st.session_state.files = codebox.list_files()
-
-        encoded_string = base64.b64encode(file_bytes).decode("utf-8")
-        # st.write(bytes_data)
+        # streamed to disk once per upload, then copied into the session's directory
+        attachment = st.session_state.attachment_store.put_upload(uploaded_file)
+        # tracked, so that the session's directory is deleted once the session ends
+        LocalCodeBoxToolRunManager.instance(current_session_id())
+        st.session_state.attachment_store.copy_to(
+            attachment, session_workdir(current_session_id())
+        )
 
-        if uploaded_file.type in ("image/jpeg", "image/png"):
+        if attachment.mime_type in VISION_MIME_TYPES:
+            # keep only a reference in the chat history; the image is only encoded
+            # for the LLM in the turn it is sent with
             message = HumanMessage(
                 content=[
                     {
                         "type": "text",
                         "text": question,
                     },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{uploaded_file.type};base64,{encoded_string}"
-                        },
-                    },
+                    attachment.as_block(),
                 ]
             )
 
@@ -272,21 +426,79 @@ if question:
         st.markdown(question)
 
     # Save the user's message to the session state
-    st.session_state.messages.append({"role": "user", "content": message.content})
+    user_message = {"role": "user", "content": message.content}
+    if uploaded_file is not None:
+        # pins this message as the latest file context when compacting the history
+        user_message["file"] = uploaded_file.name
+    st.session_state.messages.append(user_message)
 
     # Set up the Streamlit callback handler
     st_callback = CustomStreamlitCallbackHandler(
-        st.container(), max_thought_containers=20, expand_new_thoughts=True
+        st.container(),
+        max_thought_containers=20,
+        expand_new_thoughts=True,
+        files_dir=session_workdir(current_session_id()),
     )
 
-    response = agent_executor.invoke(
-        {"chat_history": st.session_state.messages}, {"callbacks": [st_callback]}
+    cache_stats = PromptCacheStatsHandler()
+    tracing = TracingCallbackHandler(
+        current_session_id(), model=st.session_state.selected_model
     )
 
-    with st.chat_message("assistant"):
-        st.markdown(response["output"])
-
-    # Save the assistant's response to the session state
-    st.session_state.messages.append(
-        {"role": "assistant", "content": response["output"]}
+    chat_history = st.session_state.messages
+    if DOCS_RETRIEVAL:
+        # only the docs relevant to this question, instead of all of them every
+        # time; kept on the question, so that it is resent the same way later
+        chat_history = inject_docs(chat_history)
+    chat_history = st.session_state.history_manager.compact(
+        chat_history,
+        MODEL_HISTORY_TOKEN_BUDGETS.get(
+            st.session_state.selected_model, DEFAULT_HISTORY_TOKEN_BUDGET
+        ),
+    )
+    chat_history = resolve_attachments(chat_history, st.session_state.attachment_store)
+
+    # run the agent in the background, so that the turn can be stopped
+    agent_run = AgentRun(
+        agent_executor,
+        {"chat_history": chat_history},
+        [st_callback, cache_stats, tracing],
+        session_id=current_session_id(),
     )
+    st.session_state.agent_run = agent_run
+    st.session_state.agent_run_cache_stats = cache_stats
+elif agent_run is not None:
+    # a rerun (e.g. Stop was clicked) replaced the script run that displayed the
+    # agent's thoughts, so their containers are gone
+    agent_run.detach()
+    if not agent_run.done:
+        st.info("Still working on the last question...")
+
+if agent_run is not None:
+    status = st.empty()
+    stop = st.empty()
+    stop.button("Stop", key="stop_agent_run", on_click=agent_run.cancel)
+    agent_run.wait(lambda: status.caption(f"Running for {agent_run.elapsed:.0f} s"))
+    status.empty()
+    stop.empty()
+    del st.session_state.agent_run
+
+    st.session_state.prompt_cache_stats.append(
+        st.session_state.pop("agent_run_cache_stats").as_dict()
+    )
+
+    if agent_run.error is not None:
+        st.session_state.agent_run_error = agent_run.error
+    else:
+        output = (
+            "_Stopped._" if agent_run.cancelled else agent_run.response["output"]
+        )
+        with st.chat_message("assistant"):
+            st.markdown(output)
+
+        # Save the assistant's response to the session state
+        st.session_state.messages.append({"role": "assistant", "content": output})
+
+    if not question or agent_run.error is not None:
+        # re-enable the chat input and show the outcome
+        st.rerun()
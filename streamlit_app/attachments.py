@@ -0,0 +1,216 @@
+"""Content-addressed storage for uploaded attachments.
+
+Uploads are stored once on disk under their SHA-256 digest and referenced from the
+chat history by digest, instead of being kept inline as base64 in session memory.
+Images are only expanded into (downscaled) vision inputs for the turn they were
+uploaded in; later turns see a short text reference instead.
+
+Uploads are streamed to disk in chunks and hashed as they are written, so even
+files of hundreds of MB are never copied in memory, and nothing is base64-encoded
+unless it is sent to a vision model.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import os
+import shutil
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from PIL import Image
+
+ATTACHMENT_DIR = Path(os.environ.get("ATTACHMENT_DIR", ".attachments"))
+
+# Longest image side sent to vision models; larger images are downscaled by the
+# provider anyway, so sending more only costs bandwidth and latency
+VISION_MAX_SIDE = 1568
+VISION_JPEG_QUALITY = 85
+
+VISION_MIME_TYPES = ("image/jpeg", "image/png")
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024**2))
+
+
+@dataclass(frozen=True)
+class Attachment:
+    digest: str
+    name: str
+    mime_type: str
+    size: int
+
+    def as_block(self) -> dict[str, Any]:
+        """The content block stored in `st.session_state.messages`."""
+        return {"type": "attachment", **asdict(self)}
+
+    @classmethod
+    def from_block(cls, block: dict[str, Any]) -> Attachment:
+        return cls(
+            digest=block["digest"],
+            name=block["name"],
+            mime_type=block["mime_type"],
+            size=block["size"],
+        )
+
+
+class AttachmentStore:
+    def __init__(self, root: Path = ATTACHMENT_DIR):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        # upload id -> attachment, so that an upload is only read once
+        self._uploads: dict[str, Attachment] = {}
+        # destination -> (digest, size, mtime) of the copy made there
+        self._copies: dict[Path, tuple[str, int, int]] = {}
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest
+
+    def put(self, data: bytes, name: str, mime_type: str) -> Attachment:
+        """Store `data` unless an identical upload is already stored."""
+        return self.put_stream(BytesIO(data), name, mime_type)
+
+    def put_stream(
+        self,
+        stream: BinaryIO,
+        name: str,
+        mime_type: str,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ) -> Attachment:
+        """Store the rest of `stream`, hashing it while it is written in chunks;
+        an identical upload that is already stored is kept instead.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        tmp = self.root / f".upload-{os.getpid()}-{id(stream)}.tmp"
+        try:
+            with open(tmp, "wb") as handle:
+                while chunk := stream.read(chunk_size):
+                    digest.update(chunk)
+                    handle.write(chunk)
+                    size += len(chunk)
+            path = self.path(digest.hexdigest())
+            if path.exists():
+                tmp.unlink()
+            else:
+                tmp.replace(path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return Attachment(digest=digest.hexdigest(), name=name, mime_type=mime_type, size=size)
+
+    def put_upload(self, upload: Any) -> Attachment:
+        """Store a Streamlit `UploadedFile`; the same upload is only read and
+        hashed once, however many turns it is attached to.
+        """
+        attachment = self._uploads.get(upload.file_id)
+        if attachment is None or not self.path(attachment.digest).exists():
+            upload.seek(0)
+            attachment = self.put_stream(
+                upload, upload.name, upload.type or "application/octet-stream"
+            )
+            self._uploads[upload.file_id] = attachment
+        return attachment
+
+    def copy_to(self, attachment: Attachment, directory: Path) -> Path:
+        """Make the attachment available as `directory/<name>` (e.g. to the
+        kernels), unless that file is still the copy made for an earlier,
+        identical upload.
+
+        The file is copied rather than linked: code may rewrite it in place,
+        which must not change the stored attachment.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        destination = directory / Path(attachment.name).name
+        try:
+            info = destination.stat()
+        except FileNotFoundError:
+            info = None
+        if (
+            info is not None
+            and self._copies.get(destination) == (attachment.digest, info.st_size, info.st_mtime_ns)
+        ):
+            return destination
+        tmp = directory / f".{destination.name}.tmp"
+        # copied by the OS where possible (sendfile), without reading it into memory
+        shutil.copyfile(self.path(attachment.digest), tmp)
+        tmp.replace(destination)
+        info = destination.stat()
+        self._copies[destination] = (attachment.digest, info.st_size, info.st_mtime_ns)
+        return destination
+
+    def vision_data_uri(
+        self, attachment: Attachment, max_side: int = VISION_MAX_SIDE
+    ) -> str:
+        """A data URI for the image, downscaled to at most `max_side` pixels.
+        The downscaled copy is cached next to the original.
+        """
+        cached = self.root / f"{attachment.digest}.vision-{max_side}.jpg"
+        if not cached.exists():
+            with Image.open(self.path(attachment.digest)) as image:
+                image.thumbnail((max_side, max_side))
+                buffer = BytesIO()
+                image.convert("RGB").save(
+                    buffer, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True
+                )
+            tmp = cached.with_suffix(".tmp")
+            tmp.write_bytes(buffer.getvalue())
+            tmp.replace(cached)
+        encoded = base64.b64encode(cached.read_bytes()).decode("utf-8")
+        return f"data:image/jpeg;base64,{encoded}"
+
+
+def _reference_block(attachment: Attachment) -> dict[str, str]:
+    return {
+        "type": "text",
+        "text": (
+            f"[An image named {attachment.name} was shown earlier in the conversation;"
+            " it can be opened with code if needed.]"
+        ),
+    }
+
+
+def resolve_attachments(
+    messages: list[dict[str, Any]], store: AttachmentStore
+) -> list[dict[str, Any]]:
+    """Replace attachment blocks with content the LLM understands.
+
+    Images in the latest user message become vision inputs; those in earlier
+    messages become a short text reference, so they are only sent once.
+    """
+    latest_user = max(
+        (idx for idx, message in enumerate(messages) if message["role"] == "user"),
+        default=None,
+    )
+    resolved = []
+    for idx, message in enumerate(messages):
+        content = message["content"]
+        if isinstance(content, str) or not any(
+            isinstance(block, dict) and block.get("type") == "attachment"
+            for block in content
+        ):
+            resolved.append(message)
+            continue
+        blocks = []
+        for block in content:
+            if not (isinstance(block, dict) and block.get("type") == "attachment"):
+                blocks.append(block)
+                continue
+            attachment = Attachment.from_block(block)
+            if idx == latest_user and attachment.mime_type in VISION_MIME_TYPES:
+                blocks.append(
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": store.vision_data_uri(attachment)},
+                    }
+                )
+            else:
+                blocks.append(_reference_block(attachment))
+        resolved.append({**message, "content": blocks})
+    return resolved
+
+
+__all__ = ("VISION_MIME_TYPES", "Attachment", "AttachmentStore", "resolve_attachments")
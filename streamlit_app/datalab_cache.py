@@ -0,0 +1,407 @@
+"""A local caching HTTP proxy for the datalab API.
+
+Generated code talks to the proxy instead of the datalab instance directly, so
+repeated reads (`get_items`, `get_item`, `search_items`, `get_item_graph`, file
+downloads...) across retries, turns and sessions are served locally. Entries are
+cached per datalab instance and API key with per-endpoint TTLs, stale entries are revalidated with
+`ETag`/`Last-Modified` where the server provides them, and any write request
+invalidates the entries it can affect.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import httpx
+
+from tracing import Tracer
+
+DATALAB_CACHE_PROXY = os.environ.get("DATALAB_CACHE_PROXY", "1") not in ("0", "false", "")
+DATALAB_CACHE_MAX_BYTES = int(os.environ.get("DATALAB_CACHE_MAX_BYTES", 256 * 1024**2))
+# Larger responses are streamed through without being cached
+DATALAB_CACHE_MAX_ENTRY_BYTES = int(
+    os.environ.get("DATALAB_CACHE_MAX_ENTRY_BYTES", 32 * 1024**2)
+)
+
+# (path regex, TTL in seconds) for cacheable GET endpoints; first match wins
+CACHE_TTLS: list[tuple[re.Pattern, float]] = [
+    (re.compile(r"^/info(/blocks)?/?$"), 3600),
+    # file ids are immutable
+    (re.compile(r"^/files/"), 24 * 3600),
+    (re.compile(r"^/get-current-user/?$"), 300),
+    (re.compile(r"^/get-item-data/"), 60),
+    (re.compile(r"^/item-graph(/|$)"), 60),
+    (re.compile(r"^/search-items"), 60),
+    (re.compile(r"^/(samples|starting-materials|cells|equipment|collections)(/|$)"), 60),
+]
+# Entries under these paths are never invalidated by writes
+IMMUTABLE_PATHS = re.compile(r"^/(info|files)(/|$)")
+# Entries that may change whenever any item changes
+LISTING_PATHS = re.compile(
+    r"^/(item-graph|search-items|samples|starting-materials|cells|equipment|collections)(/|$)"
+)
+
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+    # httpx has already decoded the body
+    "content-encoding",
+}
+
+_API_URL_META = re.compile(r'<meta name="x_datalab_api_url" content="(.*?)">', re.IGNORECASE)
+
+
+def _ttl_for(path: str) -> float | None:
+    for pattern, ttl in CACHE_TTLS:
+        if pattern.search(path):
+            return ttl
+    return None
+
+
+@dataclass
+class CacheEntry:
+    status: int
+    headers: list[tuple[str, str]]
+    body: bytes
+    expires: float
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidated: int = 0
+    invalidated: int = 0
+    passthrough: int = 0
+    bytes_served_from_cache: int = 0
+    started: float = field(default_factory=time.time)
+
+
+class DatalabCache:
+    """A thread-safe, size-bounded LRU of datalab API responses."""
+
+    def __init__(self, max_bytes: int = DATALAB_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # (upstream URL, API key digest, path) -> entry
+        self._entries: OrderedDict[tuple[str, str, str], CacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get(self, key: tuple[str, str, str]) -> CacheEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple[str, str, str], entry: CacheEntry) -> None:
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self._bytes -= len(old.body)
+            self._entries[key] = entry
+            self._bytes += len(entry.body)
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def invalidate(self, upstream: str, user: str, item_ids: set[str] | None = None) -> None:
+        """Drop the entries a write by `user` to the `upstream` instance may have
+        changed: everything mutable if we don't know which items were written,
+        otherwise those items and any listings.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                entry_upstream, entry_user, path = key
+                if (entry_upstream, entry_user) != (upstream, user) or IMMUTABLE_PATHS.search(path):
+                    continue
+                if (
+                    item_ids is None
+                    or LISTING_PATHS.search(path)
+                    or any(f"/{item_id}" in path for item_id in item_ids)
+                ):
+                    self._bytes -= len(self._entries.pop(key).body)
+                    self.stats.invalidated += 1
+
+    def metrics(self) -> dict[str, float | int]:
+        with self._lock:
+            lookups = self.stats.hits + self.stats.misses + self.stats.revalidated
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.stats.hits,
+                "misses": self.stats.misses,
+                "revalidated": self.stats.revalidated,
+                "invalidated": self.stats.invalidated,
+                "passthrough": self.stats.passthrough,
+                "hit_rate": (self.stats.hits + self.stats.revalidated) / lookups
+                if lookups
+                else 0.0,
+                "bytes_served_from_cache": self.stats.bytes_served_from_cache,
+            }
+
+
+def _written_item_ids(body: bytes) -> set[str] | None:
+    """The item ids a write request refers to, if we can tell."""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        # e.g. multipart file uploads
+        match = re.search(rb'name="item_id"\r\n\r\n([^\r\n]+)', body)
+        return {match.group(1).decode()} if match else None
+    ids = set()
+    if isinstance(payload, dict):
+        for key in ("item_id", "refcode"):
+            if isinstance(payload.get(key), str):
+                ids.add(payload[key])
+        for key in ("new_sample_data", "data"):
+            if isinstance(payload.get(key), dict) and payload[key].get("item_id"):
+                ids.add(payload[key]["item_id"])
+    return ids or None
+
+
+def resolve_api_url(url: str) -> str:
+    """Datalab UI URLs advertise their API URL in a meta tag; the client follows
+    it, so the proxy must point at the API itself.
+    """
+    try:
+        response = httpx.get(url, follow_redirects=True, timeout=10)
+    except httpx.HTTPError:
+        return url
+    if match := _API_URL_META.search(response.text):
+        return match.group(1)
+    return url
+
+
+class DatalabCachingProxy:
+    """Serves `upstream_url` from `http://127.0.0.1:<port>` through a `DatalabCache`."""
+
+    def __init__(
+        self,
+        upstream_url: str,
+        cache: DatalabCache | None = None,
+        port: int = 0,
+        resolve: bool = True,
+    ):
+        if resolve:
+            upstream_url = resolve_api_url(upstream_url.rstrip("/"))
+        self.upstream_url = upstream_url.rstrip("/")
+        self.cache = cache or DatalabCache()
+        self._client = httpx.Client(timeout=httpx.Timeout(10.0, read=60.0))
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="datalab-cache-proxy", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._client.close()
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):  # noqa: A002
+                pass
+
+            def do_GET(self):
+                tracer = Tracer.instance()
+                # requests come from the kernels, so belong to the code running there
+                with tracer.span(
+                    "datalab.http",
+                    tracer.enclosing("kernel.run"),
+                    method=self.command,
+                    path=urlsplit(self.path).path,
+                ) as span:
+                    span.attributes["cache"] = proxy._handle(self)
+
+            do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+        return Handler
+
+    def _forward_headers(self, request: BaseHTTPRequestHandler) -> dict[str, str]:
+        return {
+            key: value
+            for key, value in request.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != "accept-encoding"
+        }
+
+    def _send(
+        self,
+        request: BaseHTTPRequestHandler,
+        status: int,
+        headers: list[tuple[str, str]],
+        body: bytes,
+    ) -> None:
+        request.send_response(status)
+        for key, value in headers:
+            if key.lower() == "location" and value.startswith(self.upstream_url):
+                value = self.url + value[len(self.upstream_url) :]
+            request.send_header(key, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        if request.command != "HEAD":
+            request.wfile.write(body)
+
+    @staticmethod
+    def _response_headers(response: httpx.Response) -> list[tuple[str, str]]:
+        return [
+            (key, value)
+            for key, value in response.headers.multi_items()
+            if key.lower() not in HOP_BY_HOP_HEADERS
+        ]
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> str:
+        """Answer a request; returns how: "hit", "revalidated", "miss",
+        "passthrough", "write" or "error" (the datalab instance could not be
+        reached, which is answered with a 502).
+        """
+        try:
+            return self._answer(request)
+        except httpx.HTTPError as exc:
+            print(f"Datalab proxy request to {self.upstream_url} failed: {exc}")
+            body = json.dumps(
+                {"status": "error", "message": f"Bad gateway: {type(exc).__name__}: {exc}"}
+            ).encode()
+            self._send(request, 502, [("Content-Type", "application/json")], body)
+            return "error"
+
+    def _answer(self, request: BaseHTTPRequestHandler) -> str:
+        path = request.path
+        upstream = self.upstream_url + path
+        headers = self._forward_headers(request)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        user = hashlib.sha256(
+            (request.headers.get("DATALAB-API-KEY") or "").encode()
+        ).hexdigest()
+        url_path = urlsplit(path).path
+
+        if request.command not in ("GET", "HEAD"):
+            response = self._client.request(
+                request.command, upstream, headers=headers, content=body
+            )
+            if response.is_success:
+                self.cache.invalidate(self.upstream_url, user, _written_item_ids(body))
+            self._send(request, response.status_code, self._response_headers(response), response.content)
+            return "write"
+
+        ttl = _ttl_for(url_path)
+        key = (self.upstream_url, user, path)
+        entry = self.cache.get(key) if ttl is not None else None
+        if entry is not None and entry.expires > time.monotonic():
+            self.cache.stats.hits += 1
+            self.cache.stats.bytes_served_from_cache += len(entry.body)
+            self._send(request, entry.status, entry.headers, entry.body)
+            return "hit"
+
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        with self._client.stream("GET", upstream, headers=headers) as response:
+            if response.status_code == 304 and entry is not None:
+                self.cache.stats.revalidated += 1
+                entry.expires = time.monotonic() + ttl
+                self.cache.put(key, entry)
+                self._send(request, entry.status, entry.headers, entry.body)
+                return "revalidated"
+
+            size = int(response.headers.get("Content-Length") or 0)
+            if ttl is None or size > DATALAB_CACHE_MAX_ENTRY_BYTES:
+                self.cache.stats.passthrough += 1
+                self._stream_through(request, response)
+                return "passthrough"
+
+            content = response.read()
+            response_headers = self._response_headers(response)
+
+        self.cache.stats.misses += 1
+        if response.status_code == 200 and len(content) <= DATALAB_CACHE_MAX_ENTRY_BYTES:
+            self.cache.put(
+                key,
+                CacheEntry(
+                    status=response.status_code,
+                    headers=response_headers,
+                    body=content,
+                    expires=time.monotonic() + ttl,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                ),
+            )
+        self._send(request, response.status_code, response_headers, content)
+        return "miss"
+
+    def _stream_through(self, request: BaseHTTPRequestHandler, response: httpx.Response) -> None:
+        request.send_response(response.status_code)
+        for key, value in self._response_headers(response):
+            request.send_header(key, value)
+        request.send_header("Transfer-Encoding", "chunked")
+        request.end_headers()
+        if request.command == "HEAD":
+            return
+        try:
+            for chunk in response.iter_bytes():
+                if chunk:
+                    request.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        except httpx.HTTPError as exc:
+            # the status has already been sent; end the connection without the final
+            # chunk, so that the client sees the response is incomplete
+            print(f"Datalab proxy stream from {self.upstream_url} failed: {exc}")
+            request.close_connection = True
+            return
+        request.wfile.write(b"0\r\n\r\n")
+
+
+_proxies: dict[str, DatalabCachingProxy] = {}
+_proxies_lock = threading.Lock()
+# shared by the proxies of every instance, so one byte budget covers them all
+_shared_cache = DatalabCache()
+
+
+def get_datalab_proxy(upstream_url: str) -> DatalabCachingProxy:
+    """The process-wide proxy for `upstream_url`, shared by every session."""
+    with _proxies_lock:
+        if (proxy := _proxies.get(upstream_url)) is not None:
+            return proxy
+    # a network round trip, so not while holding the lock
+    api_url = resolve_api_url(upstream_url.rstrip("/"))
+    with _proxies_lock:
+        if upstream_url not in _proxies:
+            _proxies[upstream_url] = DatalabCachingProxy(
+                api_url, cache=_shared_cache, resolve=False
+            )
+        return _proxies[upstream_url]
+
+
+__all__ = ("DatalabCache", "DatalabCachingProxy", "get_datalab_proxy")
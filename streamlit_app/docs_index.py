@@ -0,0 +1,334 @@
+"""An offline BM25 index over the datalab API documentation.
+
+Instead of pasting the whole of `prompts/datalab-api-prompt.md` into every
+request, only its preamble stays in the system prompt. The rest is split into
+chunks (one per section, per example in the code listings, and per part of the
+sample JSON schema), the chunks most relevant to each question are attached to
+it, and the agent can look up more with the `datalab_docs` tool. Markdown files in
+`DOCS_EXTRA_DIR` are indexed too, so more documentation and worked examples can
+be added without making every request longer.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from langchain_core.tools import StructuredTool
+from pydantic.v1 import BaseModel, Field
+
+PROMPTS_DIR = Path(__file__).parent.parent / "prompts"
+DATALAB_API_DOCS = PROMPTS_DIR / "datalab-api-prompt.md"
+DOCS_EXTRA_DIR = Path(os.environ.get("DOCS_EXTRA_DIR", PROMPTS_DIR / "docs"))
+
+DOCS_RETRIEVAL = os.environ.get("DOCS_RETRIEVAL", "1") not in ("0", "false", "")
+# Chunks attached to each question, and the most characters they may take
+DOCS_TOP_K = int(os.environ.get("DOCS_TOP_K", 3))
+DOCS_MAX_CHARS = int(os.environ.get("DOCS_MAX_CHARS", 6000))
+# Starts the text block of documentation attached to a question
+DOCS_BLOCK_HEADING = "Relevant datalab API documentation (look up more with the `datalab_docs` tool):\n\n"
+# Longer code listings are split into one chunk per example
+DOCS_CHUNK_MAX_CHARS = 1200
+
+# The heading the preamble of the API docs ends at; it stays in the system prompt
+DOCS_PREAMBLE_END = "\n## Usage"
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from",
+    "how", "i", "in", "is", "it", "me", "my", "of", "on", "or", "please", "show", "that",
+    "the", "this", "to", "what", "which", "with", "you",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-case words; identifiers are also split into their parts, so that
+    `get_item_files` matches "item files" and vice versa.
+    """
+    tokens = []
+    for word in re.findall(r"[A-Za-z0-9_]+", text):
+        parts = [part.lower() for part in re.findall(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])", word)]
+        lowered = word.lower()
+        if lowered not in STOPWORDS:
+            tokens.append(lowered)
+        if len(parts) > 1:
+            tokens += [part for part in parts if part not in STOPWORDS]
+    return tokens
+
+
+@dataclass(frozen=True)
+class DocChunk:
+    title: str
+    text: str
+
+    def render(self) -> str:
+        return f"### {self.title}\n\n{self.text.strip()}"
+
+
+def _code_chunks(title: str, code: str, language: str) -> list[DocChunk]:
+    """One chunk per blank-line separated example of a code listing."""
+    lines = code.strip("\n").splitlines()
+    # e.g. the import and `with DatalabClient(...) as client:` every example relies on
+    opening = next(
+        (idx for idx, line in enumerate(lines[:5]) if line.rstrip().endswith(":")), None
+    )
+    setup = None
+    if opening is not None:
+        setup = "\n".join(line for line in lines[: opening + 1] if line.strip())
+        lines = lines[opening + 1 :]
+    body = "\n".join(lines)
+    chunks = []
+    for example in re.split(r"\n\s*\n", body):
+        if not example.strip():
+            continue
+        text = "\n".join(filter(None, [setup, example.rstrip()]))
+        chunks.append(DocChunk(title, f"```{language}\n{text}\n```"))
+    return chunks
+
+
+def _schema_chunks(schema: dict[str, Any], lead: str = "") -> list[DocChunk]:
+    """An overview of the schema's properties, then one chunk per nested
+    property and per definition.
+    """
+    name = f"{schema.get('title', 'Item')} schema"
+    overview = [lead, f"{schema.get('description', '')} Required: {', '.join(schema.get('required', []))}."]
+    chunks = []
+    for key, value in schema.get("properties", {}).items():
+        kind = value.get("type") or value.get("$ref", "").split("/")[-1] or "any"
+        if value.get("type") == "array" and "items" in value:
+            items = value["items"]
+            kind = f"array of {items.get('type') or items.get('$ref', '').split('/')[-1]}"
+        overview.append(f"- {key}: {kind}" + (f" ({value['description']})" if value.get("description") else ""))
+        if len(json.dumps(value, separators=(",", ":"))) > 200:
+            chunks.append(DocChunk(f"{name}: {key}", f"```json\n{json.dumps(value, indent=1)}\n```"))
+    for key, value in schema.get("definitions", {}).items():
+        chunks.append(DocChunk(f"{name}: {key}", f"```json\n{json.dumps(value, indent=1)}\n```"))
+    return [DocChunk(name, "\n".join(filter(None, overview))), *chunks]
+
+
+CODE_BLOCK = re.compile(r"^```(\w*)[ \t]*\n(.*?)^```[ \t]*$", re.MULTILINE | re.DOTALL)
+
+
+def chunk_markdown(text: str, source: str = "") -> list[DocChunk]:
+    """Split markdown into chunks: the prose of each section, each example of its
+    code listings, and each part of any JSON schema.
+    """
+    # (heading, body) pairs, starting with the text before the first heading;
+    # comments in code listings look like headings too
+    pairs: list[tuple[str, list[str]]] = [(source or "Overview", [])]
+    in_code = False
+    for line in text.splitlines():
+        if line.startswith("```"):
+            in_code = not in_code
+        elif not in_code and re.match(r"#{1,4} ", line):
+            pairs.append((line.lstrip("#").strip(), []))
+            continue
+        pairs[-1][1].append(line)
+
+    chunks = []
+    for title, lines in pairs:
+        body = "\n".join(lines) + "\n"
+        position = 0
+        for match in CODE_BLOCK.finditer(body):
+            # the prose leading up to a listing usually says what it is for
+            lead = body[position : match.start()].strip()
+            position = match.end()
+            language, code = match.group(1) or "python", match.group(2)
+            schema = None
+            if language == "json":
+                try:
+                    schema = json.loads(code)
+                except json.JSONDecodeError:
+                    pass
+            if isinstance(schema, dict) and "properties" in schema:
+                chunks += _schema_chunks(schema, lead)
+            elif len(code) <= DOCS_CHUNK_MAX_CHARS:
+                chunks.append(DocChunk(title, f"{lead}\n\n```{language}\n{code.strip()}\n```".strip()))
+            else:
+                if lead:
+                    chunks.append(DocChunk(title, lead))
+                chunks += _code_chunks(title, code, language)
+        if rest := body[position:].strip():
+            chunks.append(DocChunk(title, rest))
+    return chunks
+
+
+class DocsIndex:
+    """BM25 over documentation chunks.
+
+    Parameters
+    ----------
+    chunks
+        The chunks to index.
+
+    """
+
+    _instance: DocsIndex | None = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, chunks: list[DocChunk]):
+        self.chunks = chunks
+        self._tokens = [Counter(tokenize(f"{chunk.title} {chunk.text}")) for chunk in chunks]
+        self._lengths = [sum(tokens.values()) for tokens in self._tokens]
+        self._mean_length = sum(self._lengths) / len(self._lengths) if chunks else 0.0
+        frequencies = Counter(token for tokens in self._tokens for token in tokens)
+        self._idf = {
+            token: math.log(1 + (len(chunks) - count + 0.5) / (count + 0.5))
+            for token, count in frequencies.items()
+        }
+
+    @classmethod
+    def instance(cls) -> DocsIndex:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(default_chunks())
+            return cls._instance
+
+    def scores(self, query: str) -> list[float]:
+        terms = tokenize(query)
+        scores = []
+        for tokens, length in zip(self._tokens, self._lengths):
+            score = 0.0
+            for term in terms:
+                if (count := tokens.get(term)) is None:
+                    continue
+                norm = count + BM25_K1 * (1 - BM25_B + BM25_B * length / self._mean_length)
+                score += self._idf[term] * count * (BM25_K1 + 1) / norm
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, k: int = DOCS_TOP_K, max_chars: int | None = None) -> list[DocChunk]:
+        """The (at most) `k` chunks that match `query` best, most relevant first,
+        within `max_chars` characters.
+        """
+        ranked = sorted(
+            (
+                (score, idx)
+                for idx, score in enumerate(self.scores(query))
+                if score > 0
+            ),
+            reverse=True,
+        )
+        results: list[DocChunk] = []
+        total = 0
+        for _, idx in ranked:
+            chunk = self.chunks[idx]
+            if max_chars is not None and results and total + len(chunk.text) > max_chars:
+                continue
+            results.append(chunk)
+            total += len(chunk.text)
+            if len(results) == k:
+                break
+        return results
+
+    def titles(self) -> list[str]:
+        return list(dict.fromkeys(chunk.title for chunk in self.chunks))
+
+
+def docs_preamble() -> str:
+    """The part of the API docs kept in every system prompt."""
+    return DATALAB_API_DOCS.read_text().partition(DOCS_PREAMBLE_END)[0].strip()
+
+
+def default_chunks() -> list[DocChunk]:
+    """The API docs after their preamble, and any extra documentation."""
+    _, heading, rest = DATALAB_API_DOCS.read_text().partition(DOCS_PREAMBLE_END)
+    chunks = chunk_markdown(heading.lstrip("\n") + rest)
+    if DOCS_EXTRA_DIR.is_dir():
+        for path in sorted(DOCS_EXTRA_DIR.glob("*.md")):
+            chunks += chunk_markdown(path.read_text(), source=path.stem.replace("-", " "))
+    return chunks
+
+
+def _question(message: dict[str, Any]) -> str:
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return " ".join(
+        block.get("text", "") for block in content if isinstance(block, dict) and block.get("type") == "text"
+    )
+
+
+def inject_docs(
+    messages: list[dict[str, Any]],
+    index: DocsIndex | None = None,
+    k: int = DOCS_TOP_K,
+    max_chars: int = DOCS_MAX_CHARS,
+) -> list[dict[str, Any]]:
+    """Attach to each user message the documentation retrieved for it.
+
+    Documentation is only retrieved for the latest user message, once, and is
+    stored on that message (under `docs`), so every later turn resends the
+    earlier messages exactly as they were sent, and the provider's prompt cache
+    keeps matching them. The system prompt is the same for every question.
+    """
+    users = [idx for idx, message in enumerate(messages) if message["role"] == "user"]
+    if not users:
+        return messages
+    latest = messages[users[-1]]
+    if "docs" not in latest:
+        # a follow-up question ("and the other one?") relies on the one before it
+        query = " ".join(_question(messages[idx]) for idx in users[-2:])
+        chunks = (index or DocsIndex.instance()).search(query, k, max_chars)
+        latest["docs"] = (
+            DOCS_BLOCK_HEADING + "\n\n".join(chunk.render() for chunk in chunks) if chunks else ""
+        )
+    injected = []
+    for message in messages:
+        if "docs" not in message:
+            injected.append(message)
+            continue
+        message = dict(message)
+        docs = message.pop("docs")
+        if docs:
+            content = message["content"]
+            blocks = [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+            message["content"] = [*blocks, {"type": "text", "text": docs}]
+        injected.append(message)
+    return injected
+
+
+def _lookup(query: str, k: int = DOCS_TOP_K) -> str:
+    """Search the datalab API documentation."""
+    chunks = DocsIndex.instance().search(query, k)
+    if not chunks:
+        return f"No documentation matches {query!r}. Sections: {', '.join(DocsIndex.instance().titles())}"
+    return "\n\n".join(chunk.render() for chunk in chunks)
+
+
+class DocsLookupInput(BaseModel):
+    query: str = Field(description="What to look up, e.g. a method name or a schema field.")
+    k: int = Field(default=DOCS_TOP_K, description="How many sections to return.")
+
+
+docs_lookup_tool = StructuredTool(
+    name="datalab_docs",
+    description=(
+        "Search the datalab Python API documentation (client methods, helper modules, "
+        "item JSON schemas and examples) when the documentation attached to the "
+        "question is not enough."
+    ),
+    func=_lookup,
+    args_schema=DocsLookupInput,  # type: ignore
+)
+
+
+__all__ = (
+    "DOCS_BLOCK_HEADING",
+    "DOCS_RETRIEVAL",
+    "DocChunk",
+    "DocsIndex",
+    "chunk_markdown",
+    "docs_lookup_tool",
+    "docs_preamble",
+    "inject_docs",
+)
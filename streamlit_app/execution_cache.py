@@ -0,0 +1,334 @@
+"""Optionally memoises code interpreter results for code that doesn't change
+kernel state (off unless `CODEBOX_MEMOIZE` is set).
+
+Agents often re-run identical snippets (re-importing, re-listing items, re-plotting
+the same data). Each result is cached under a hash of the normalised code and the
+session's kernel-state generation, which is bumped whenever code that mutates
+state actually runs. Code is classified statically:
+
+- *pure* code (e.g. `print(df.head())`, plotting) doesn't change the namespace,
+  so the generation is unchanged;
+- *idempotent* code only (re)binds names from values it doesn't read back (e.g.
+  `import numpy as np`, `items = client.get_items()`); running it changes the
+  state once, but running it again straight after changes nothing;
+- anything else (attribute/item assignment, augmented assignment, magics, and
+  any call that isn't known to be free of side effects) is *mutating* and is
+  never served from the cache.
+
+Code may read files, so a result is only reused while the files in `.codebox`
+are as they were after it ran.
+"""
+
+from __future__ import annotations
+
+import ast
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from enum import Enum
+from pathlib import Path
+from typing import Any
+
+from file_browser import CODEBOX_DIR
+
+CODEBOX_MEMOIZE = os.environ.get("CODEBOX_MEMOIZE", "0") not in ("0", "false", "")
+# Cached reads of remote data (e.g. the datalab API) may go stale; bound how long
+CODEBOX_MEMO_TTL = float(os.environ.get("CODEBOX_MEMO_TTL", 600))
+CODEBOX_MEMO_MAX_ENTRIES = int(os.environ.get("CODEBOX_MEMO_MAX_ENTRIES", 64))
+
+# Calls (by function or method name) known not to have side effects; code that
+# calls anything else (`requests.post`, `subprocess.run`, `random.random`...) is
+# never served from the cache
+SIDE_EFFECT_FREE_CALLS = {
+    # builtins
+    "abs", "all", "any", "bool", "dict", "dir", "divmod", "enumerate", "filter", "float",
+    "format", "frozenset", "getattr", "hasattr", "hash", "int", "isinstance", "issubclass",
+    "iter", "len", "list", "map", "max", "min", "open", "pow", "print", "range", "repr",
+    "reversed", "round", "set", "slice", "sorted", "str", "sum", "tuple", "type", "zip",
+    # str, dict, path and file reads
+    "count", "endswith", "exists", "find", "get", "index", "is_dir", "is_file", "items",
+    "join", "keys", "listdir", "lower", "read", "read_bytes", "read_text", "readlines",
+    "split", "startswith", "strip", "upper", "values", "Path",
+    # json, numpy and pandas
+    "array", "loads", "load", "DataFrame", "Series", "arange", "linspace", "zeros", "ones",
+    "read_csv", "read_excel", "read_json", "read_parquet", "head", "tail", "describe",
+    "mean", "median", "std", "var", "unique", "nunique", "value_counts", "groupby", "agg",
+    "loc", "iloc", "query", "merge", "concat", "reshape", "astype", "dropna", "fillna",
+    "sort_values", "set_index", "reset_index", "to_numpy", "tolist", "corr",
+    # plotting (the inline backend closes figures once they are shown)
+    "plot", "scatter", "hist", "bar", "barh", "imshow", "errorbar", "subplots", "figure",
+    "xlabel", "ylabel", "title", "legend", "grid", "xlim", "ylim", "tight_layout",
+    "set_xlabel", "set_ylabel", "set_title", "show", "savefig",
+    # datalab API reads
+    "DatalabClient", "get_info", "get_items", "get_item", "search_items", "get_item_graph",
+    "get_item_files", "get_collection",
+}
+
+
+class CodeKind(str, Enum):
+    PURE = "pure"
+    IDEMPOTENT = "idempotent"
+    MUTATING = "mutating"
+
+
+def normalise_code(code: str) -> str:
+    """A canonical form of the code, insensitive to formatting and comments."""
+    try:
+        return ast.dump(ast.parse(code))
+    except SyntaxError:
+        return "\n".join(line.strip() for line in code.strip().splitlines() if line.strip())
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(normalise_code(code).encode()).hexdigest()
+
+
+def _call_name(node: ast.Call) -> str:
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return ""
+
+
+def _is_mutating_call(node: ast.Call) -> bool:
+    name = _call_name(node)
+    if name not in SIDE_EFFECT_FREE_CALLS:
+        return True
+    if any(
+        keyword.arg == "inplace" and not (isinstance(keyword.value, ast.Constant) and not keyword.value.value)
+        for keyword in node.keywords
+    ):
+        return True
+    if name == "open":
+        mode = node.args[1] if len(node.args) > 1 else next(
+            (keyword.value for keyword in node.keywords if keyword.arg == "mode"), None
+        )
+        return mode is not None and not (
+            isinstance(mode, ast.Constant) and not re.search(r"[wax+]", str(mode.value))
+        )
+    return False
+
+
+def _binding_names(target: ast.AST) -> list[str] | None:
+    """The names bound by an assignment target, or None if it stores into an
+    existing object (attribute, subscript).
+    """
+    if isinstance(target, ast.Name):
+        return [target.id]
+    if isinstance(target, (ast.Tuple, ast.List)):
+        names: list[str] = []
+        for element in target.elts:
+            element = element.value if isinstance(element, ast.Starred) else element
+            if (inner := _binding_names(element)) is None:
+                return None
+            names.extend(inner)
+        return names
+    return None
+
+
+def classify(code: str) -> CodeKind:
+    """Whether running `code` leaves the kernel state unchanged (pure), changes it
+    the same way every time (idempotent), or otherwise (mutating).
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # e.g. IPython magics and shell escapes
+        return CodeKind.MUTATING
+
+    bound: set[str] = set()
+    # (position, name, is_store) for top-level names, to check reads before writes
+    events: list[tuple[tuple[int, int], str, bool]] = []
+    scoped: set[int] = set()
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Global, ast.Nonlocal, ast.Delete, ast.AugAssign)):
+            return CodeKind.MUTATING
+        if isinstance(node, ast.Call) and _is_mutating_call(node):
+            return CodeKind.MUTATING
+        if isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if _binding_names(target) is None:
+                    return CodeKind.MUTATING
+        if isinstance(node, (ast.For, ast.AsyncFor, ast.With, ast.AsyncWith)):
+            targets = (
+                [node.target]
+                if isinstance(node, (ast.For, ast.AsyncFor))
+                else [item.optional_vars for item in node.items if item.optional_vars]
+            )
+            if any(_binding_names(target) is None for target in targets):
+                return CodeKind.MUTATING
+        if isinstance(
+            node,
+            (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda, ast.comprehension),
+        ):
+            # names inside these are local to them
+            for child in ast.walk(node):
+                if child is not node and isinstance(child, ast.Name):
+                    scoped.add(id(child))
+            if not isinstance(node, (ast.Lambda, ast.comprehension)):
+                bound.add(node.name)
+                events.append(((node.lineno, node.col_offset), node.name, True))
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                name = (alias.asname or alias.name).split(".")[0]
+                bound.add(name)
+                events.append(((node.lineno, node.col_offset), name, True))
+
+    # a store takes effect once the value assigned is evaluated, i.e. at the end of
+    # the expression it comes from
+    store_positions: dict[int, tuple[int, int]] = {}
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Assign, ast.AnnAssign, ast.NamedExpr)):
+            value, targets = node.value, (
+                node.targets if isinstance(node, ast.Assign) else [node.target]
+            )
+        elif isinstance(node, (ast.For, ast.AsyncFor)):
+            value, targets = node.iter, [node.target]
+        elif isinstance(node, ast.withitem) and node.optional_vars is not None:
+            value, targets = node.context_expr, [node.optional_vars]
+        else:
+            continue
+        end = (value.end_lineno, value.end_col_offset) if value is not None else (0, 0)
+        for target in targets:
+            for child in ast.walk(target):
+                store_positions[id(child)] = end
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and id(node) not in scoped:
+            is_store = isinstance(node.ctx, ast.Store)
+            if is_store:
+                bound.add(node.id)
+            position = store_positions.get(id(node), (node.lineno, node.col_offset))
+            events.append((position, node.id, is_store))
+
+    if not bound:
+        return CodeKind.PURE
+
+    # Re-running only reproduces the same state if no bound name is read before
+    # the code (re)binds it, e.g. not `x = x + 1`
+    assigned: set[str] = set()
+    for _, name, is_store in sorted(events, key=lambda event: (event[0], not event[2])):
+        if is_store:
+            assigned.add(name)
+        elif name in bound and name not in assigned:
+            return CodeKind.MUTATING
+    return CodeKind.IDEMPOTENT
+
+
+def files_state(directory: Path = CODEBOX_DIR) -> str:
+    """A digest of the names, sizes and modification times of the files under
+    `directory` (hidden ones aside), which changes whenever one of them does.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            digest.update(f"{path}\0{info.st_size}\0{info.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class ExecutionCache:
+    """One session's memoised results and kernel-state generation.
+
+    Parameters
+    ----------
+    ttl
+        Results older than this many seconds are not reused.
+    max_entries
+        The number of results kept, least recently used first out.
+    directory
+        The kernels' working directory; results are only reused while its files
+        are unchanged.
+
+    """
+
+    def __init__(
+        self,
+        ttl: float = CODEBOX_MEMO_TTL,
+        max_entries: int = CODEBOX_MEMO_MAX_ENTRIES,
+        directory: Path = CODEBOX_DIR,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (time cached, files state after the run, result)
+        self._entries: OrderedDict[
+            tuple[str, int, int], tuple[float, str, dict[str, Any]]
+        ] = OrderedDict()
+
+    def get(self, code: str, kernel_generation: int) -> dict[str, Any] | None:
+        key = (code_hash(code), self.generation, kernel_generation)
+        entry = self._entries.get(key)
+        if (
+            entry is None
+            or time.monotonic() - entry[0] > self.ttl
+            # e.g. a file was uploaded, or rewritten by other code, since it ran
+            or entry[1] != files_state(self.directory)
+        ):
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry[2])
+
+    def record(
+        self, code: str, kernel_generation: int, result: dict[str, Any], failed: bool
+    ) -> None:
+        """Update the generation after `code` has run, and cache its result if it
+        can be reused.
+        """
+        kind = classify(code)
+        digest = code_hash(code)
+        if kind is CodeKind.MUTATING or failed:
+            # failed code may have stopped half-way through changing the state
+            if kind is not CodeKind.PURE:
+                self.generation += 1
+            return
+        keys = [(digest, self.generation, kernel_generation)]
+        if kind is CodeKind.IDEMPOTENT:
+            self.generation += 1
+            # running it again straight away changes nothing and prints the same
+            keys.append((digest, self.generation, kernel_generation))
+        files = files_state(self.directory)
+        for key in keys:
+            self._entries[key] = (time.monotonic(), files, dict(result))
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def memory_usage(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes_in_memory": sum(
+                len(value)
+                for _, _, result in self._entries.values()
+                for value in result.values()
+                if isinstance(value, str)
+            ),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def invalidate(self) -> None:
+        """Forget everything, e.g. after the kernel was restarted."""
+        self._entries.clear()
+        self.generation += 1
+
+
+__all__ = ("CODEBOX_MEMOIZE", "CodeKind", "ExecutionCache", "classify")
@@ -0,0 +1,163 @@
+"""The sidebar browser for the files in a session's working directory.
+
+Only file metadata (name, size, modification time, MIME type) is listed on each
+rerun; a file's bytes are read only once the user asks to download it, and the
+listing is filtered and paginated so that sessions with hundreds of generated
+files stay responsive.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import mimetypes
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import streamlit as st
+
+CODEBOX_DIR = Path(".codebox")
+FILE_BROWSER_PAGE_SIZE = int(os.environ.get("FILE_BROWSER_PAGE_SIZE", 20))
+
+
+@dataclass(frozen=True)
+class FileEntry:
+    name: str
+    size: int
+    mtime: float
+    mime: str
+    directory: Path = CODEBOX_DIR
+
+    @property
+    def path(self) -> Path:
+        return self.directory / self.name
+
+
+def _format_size(size: float) -> str:
+    if size < 1024:
+        return f"{size:.0f} B"
+    for unit in ("kB", "MB", "GB"):
+        size /= 1024
+        if size < 1024:
+            break
+    return f"{size:.1f} {unit}"
+
+
+def _select(name: str | None) -> None:
+    st.session_state.file_browser_selected = name
+
+
+class FileIndex:
+    """Metadata of the files in a directory, updated from one `scandir` per
+    listing; entries whose size and mtime are unchanged are reused.
+
+    Parameters
+    ----------
+    directory
+        The directory to index (not recursively).
+
+    """
+
+    _instance: FileIndex | None = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, directory: Path = CODEBOX_DIR):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._entries: dict[str, FileEntry] = {}
+
+    @classmethod
+    def instance(cls) -> FileIndex:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def entries(self) -> list[FileEntry]:
+        """All files, most recently modified first."""
+        if not self.directory.is_dir():
+            # e.g. a session that hasn't run any code yet
+            return []
+        with self._lock:
+            entries = {}
+            with os.scandir(self.directory) as scan:
+                for item in scan:
+                    if item.name.startswith(".") or not item.is_file():
+                        continue
+                    try:
+                        info = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    entry = self._entries.get(item.name)
+                    if entry is None or (entry.size, entry.mtime) != (info.st_size, info.st_mtime):
+                        mime = mimetypes.guess_type(item.name)[0] or "application/octet-stream"
+                        entry = FileEntry(item.name, info.st_size, info.st_mtime, mime, self.directory)
+                    entries[item.name] = entry
+            self._entries = entries
+            return sorted(entries.values(), key=lambda entry: entry.mtime, reverse=True)
+
+    def filter(self, pattern: str = "") -> list[FileEntry]:
+        """Files whose name contains `pattern`, or matches it as a glob (`*.png`)."""
+        entries = self.entries()
+        pattern = pattern.strip()
+        if not pattern:
+            return entries
+        if any(char in pattern for char in "*?["):
+            return [entry for entry in entries if fnmatch.fnmatch(entry.name, pattern)]
+        return [entry for entry in entries if pattern.lower() in entry.name.lower()]
+
+
+def render_file_browser(index: FileIndex | None = None) -> None:
+    """Render the browser in the current container (e.g. the sidebar)."""
+    index = index or FileIndex.instance()
+    pattern = st.text_input(
+        "Filter files", key="file_browser_filter", placeholder="name or *.png"
+    )
+    entries = index.filter(pattern)
+    if not entries:
+        st.caption("No files yet." if not pattern else "No matching files.")
+        return
+
+    pages = (len(entries) - 1) // FILE_BROWSER_PAGE_SIZE + 1
+    page = 1
+    if pages > 1:
+        page = st.number_input(
+            f"Page (of {pages})", min_value=1, max_value=pages, step=1, key="file_browser_page"
+        )
+        page = min(int(page), pages)
+    start = (page - 1) * FILE_BROWSER_PAGE_SIZE
+    st.caption(f"{start + 1}–{min(start + FILE_BROWSER_PAGE_SIZE, len(entries))} of {len(entries)} files")
+
+    selected = st.session_state.get("file_browser_selected")
+    for entry in entries[start : start + FILE_BROWSER_PAGE_SIZE]:
+        modified = datetime.fromtimestamp(entry.mtime).strftime("%Y-%m-%d %H:%M")
+        label = f"{entry.name} · {_format_size(entry.size)} · {modified}"
+        if entry.name == selected:
+            # only the file the user picked is read, until it has been downloaded
+            try:
+                data = entry.path.read_bytes()
+            except FileNotFoundError:
+                st.session_state.file_browser_selected = None
+                continue
+            st.download_button(
+                label=f"⬇ {label}",
+                data=data,
+                file_name=entry.name,
+                mime=entry.mime,
+                key=f"file_browser_download_{entry.name}",
+                on_click=_select,
+                args=(None,),
+            )
+        else:
+            st.button(
+                label,
+                key=f"file_browser_select_{entry.name}",
+                help="Prepare for download",
+                on_click=_select,
+                args=(entry.name,),
+            )
+
+
+__all__ = ("FileEntry", "FileIndex", "render_file_browser")
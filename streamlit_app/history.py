@@ -0,0 +1,171 @@
+"""Keeps the chat history sent to the LLM within a per-model token budget.
+
+Older turns are folded into a short running summary once the budget is exceeded,
+while the system prompt and the latest uploaded-file context are always kept.
+Token counts are estimated locally, so compaction never needs a network call.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Any
+
+# Rough cost of an image input, independent of its byte size
+IMAGE_TOKENS = 1600
+# Per-message framing overhead (role markers etc.)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Characters of each dropped message kept in the running summary
+SUMMARY_LINE_CHARS = 200
+
+SUMMARY_HEADING = "\n\n## Earlier conversation (summarised)\n\n"
+
+
+def estimate_tokens(content: str | list[Any]) -> int:
+    """Estimate the number of tokens in message content, without a tokenizer.
+
+    About four characters per token is close enough for English text and code
+    with both the Anthropic and OpenAI tokenizers.
+    """
+    if isinstance(content, str):
+        return math.ceil(len(content) / 4)
+    tokens = 0
+    for block in content:
+        if isinstance(block, str):
+            tokens += estimate_tokens(block)
+        elif isinstance(block, dict):
+            if block.get("type") in ("image_url", "image", "attachment"):
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += estimate_tokens(str(block.get("text", "")))
+    return tokens
+
+
+def _message_tokens(message: dict[str, Any]) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _content_text(content: str | list[Any]) -> str:
+    if isinstance(content, str):
+        return content
+    return " ".join(
+        block if isinstance(block, str) else str(block.get("text", ""))
+        for block in content
+        if isinstance(block, str) or block.get("type") == "text"
+    )
+
+
+def _is_file_context(message: dict[str, Any]) -> bool:
+    if message.get("file"):
+        return True
+    content = message["content"]
+    return isinstance(content, list) and any(
+        isinstance(block, dict) and block.get("type") in ("image_url", "attachment")
+        for block in content
+    )
+
+
+class ChatHistoryManager:
+    """Compacts `st.session_state.messages` before each turn.
+
+    Session messages are only ever appended to, so the manager remembers how many
+    leading messages it has already folded into the summary and only ever
+    summarises the messages that have newly fallen out of the budget.
+
+    Parameters
+    ----------
+    summary_token_budget
+        The maximum size of the running summary of dropped turns; the oldest
+        summary lines are discarded beyond this.
+    min_recent_messages
+        Never drop the latest this-many messages, even if they exceed the budget.
+
+    """
+
+    def __init__(self, summary_token_budget: int = 1000, min_recent_messages: int = 2):
+        self.summary_token_budget = summary_token_budget
+        self.min_recent_messages = min_recent_messages
+        self._summary_lines: list[str] = []
+        self._summarised_upto = 0
+
+    def _summarise(self, message: dict[str, Any]) -> None:
+        text = " ".join(_content_text(message["content"]).split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS] + "..."
+        self._summary_lines.append(f"- {message['role']}: {text}")
+        while (
+            len(self._summary_lines) > 1
+            and estimate_tokens("\n".join(self._summary_lines)) > self.summary_token_budget
+        ):
+            self._summary_lines.pop(0)
+
+    @property
+    def summary(self) -> str:
+        return "\n".join(self._summary_lines)
+
+    def compact(self, messages: list[dict[str, Any]], token_budget: int) -> list[dict[str, Any]]:
+        """Return the messages to send, keeping their estimated size under `token_budget`.
+
+        Extra keys on the session messages (e.g. `file`) are only used here and
+        are stripped from the returned messages.
+        """
+        if not messages:
+            return []
+
+        has_system = messages[0]["role"] == "system"
+        first = 1 if has_system else 0
+        if self._summarised_upto > len(messages) or self._summarised_upto < first:
+            # the history was reset underneath us
+            self._summary_lines = []
+            self._summarised_upto = first
+
+        pinned = None
+        for idx in range(len(messages) - 1, first - 1, -1):
+            if _is_file_context(messages[idx]):
+                pinned = idx
+                break
+
+        fixed = _message_tokens(messages[0]) if has_system else 0
+        body = list(range(self._summarised_upto, len(messages)))
+        total = fixed + sum(_message_tokens(messages[idx]) for idx in body)
+        if pinned is not None and pinned < self._summarised_upto:
+            total += _message_tokens(messages[pinned])
+        if self._summary_lines:
+            total += estimate_tokens(SUMMARY_HEADING + self.summary)
+
+        def droppable() -> bool:
+            return len(body) > self.min_recent_messages
+
+        while droppable() and (
+            total > token_budget
+            # don't start the kept history with an assistant message
+            or messages[body[0]]["role"] != "user"
+        ):
+            idx = body.pop(0)
+            # the pinned message is still sent in full, but is summarised too so
+            # that it isn't lost once a newer file context replaces it
+            if idx != pinned:
+                total -= _message_tokens(messages[idx])
+            before = estimate_tokens(self.summary)
+            self._summarise(messages[idx])
+            total += estimate_tokens(self.summary) - before
+            self._summarised_upto = idx + 1
+
+        if total > token_budget:
+            print(f"Chat history is ~{total} tokens, over its budget of {token_budget}")
+
+        compacted: list[dict[str, Any]] = []
+        if has_system:
+            system = messages[0]["content"]
+            if self._summary_lines and isinstance(system, str):
+                system += SUMMARY_HEADING + self.summary
+            compacted.append({"role": "system", "content": system})
+        if pinned is not None and pinned not in body:
+            body.insert(0, pinned)
+        compacted.extend(
+            {"role": messages[idx]["role"], "content": messages[idx]["content"]}
+            for idx in body
+        )
+        return compacted
+
+
+__all__ = ("ChatHistoryManager", "estimate_tokens")
@@ -0,0 +1,346 @@
+"""Concurrent bulk retrieval from the datalab API, for use inside the code interpreter.
+
+`DatalabClient` makes one blocking request at a time, so loops over many samples
+spend most of their time waiting on the network. These helpers issue the
+requests concurrently over one pooled HTTP connection, with bounded concurrency
+and retries:
+
+    from datalab_bulk import fetch_items, fetch_item_files, walk_descendants
+
+    items = fetch_items(client, ["sample-1", "sample-2"])
+    paths = fetch_item_files(client, ["sample-1", "sample-2"])
+    descendants = walk_descendants(client, "AJ0002")
+
+The kernel already runs an event loop, so the requests run on a private loop in
+a background thread and every helper is a plain blocking function.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections.abc import Awaitable, Callable, Iterable
+from pathlib import Path
+from typing import Any, TypeVar
+
+import httpx
+
+from file_cache import FileCache, default_cache
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RETRIES = 3
+# seconds, doubled after every failed attempt
+RETRY_BACKOFF = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _run(coro: Awaitable[T]) -> T:
+    global _loop
+    with _loop_lock:
+        if _loop is None or not _loop.is_running():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="datalab-bulk", daemon=True
+            ).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
+class BulkFetchError(RuntimeError):
+    """Raised when some requests still failed after retrying; the successful
+    results are kept on `results`.
+    """
+
+    def __init__(self, message: str, results: dict[str, Any], errors: dict[str, Exception]):
+        super().__init__(message)
+        self.results = results
+        self.errors = errors
+
+
+class _Session:
+    """An `httpx.AsyncClient` for the client's API, with a concurrency limit."""
+
+    def __init__(self, client: Any, concurrency: int, retries: int):
+        self.api_url = client.datalab_api_url.rstrip("/")
+        self.headers = dict(client.headers)
+        self.timeout = getattr(client, "timeout", None) or httpx.Timeout(30.0)
+        self.concurrency = max(concurrency, 1)
+        self.retries = max(retries, 0)
+
+    async def __aenter__(self) -> _Session:
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._http = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+        )
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self._http.aclose()
+
+    async def request(
+        self,
+        path: str,
+        handle: Callable[[httpx.Response], Awaitable[T]] | None = None,
+    ) -> Any:
+        """GET `path`, retrying transient failures; `handle` consumes a streamed
+        response, otherwise the JSON body is returned.
+        """
+        url = f"{self.api_url}/{path.lstrip('/')}"
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self._http.stream("GET", url) as response:
+                        if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                            raise httpx.HTTPStatusError(
+                                f"{response.status_code} from {url}",
+                                request=response.request,
+                                response=response,
+                            )
+                        if response.status_code != 200:
+                            await response.aread()
+                            raise RuntimeError(
+                                f"Request to {url} failed: {response.status_code=}: {response.text[:200]}"
+                            )
+                        if handle is not None:
+                            return await handle(response)
+                        await response.aread()
+                        return response.json()
+                except (httpx.TransportError, httpx.HTTPStatusError):
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+    async def gather(
+        self, keys: Iterable[str], fetch: Callable[[str], Awaitable[T]]
+    ) -> dict[str, T]:
+        keys = list(dict.fromkeys(keys))
+        outcomes = await asyncio.gather(*(fetch(key) for key in keys), return_exceptions=True)
+        results = {}
+        errors = {}
+        for key, outcome in zip(keys, outcomes):
+            if isinstance(outcome, Exception):
+                errors[key] = outcome
+            else:
+                results[key] = outcome
+        if errors:
+            details = "; ".join(f"{key}: {exc}" for key, exc in list(errors.items())[:5])
+            raise BulkFetchError(
+                f"{len(errors)} of {len(keys)} requests failed: {details}", results, errors
+            )
+        return results
+
+
+def _item_data(payload: dict[str, Any], item_id: str) -> dict[str, Any]:
+    if payload.get("status") != "success":
+        raise RuntimeError(f"Failed to get item {item_id!r}: {payload.get('status')!r}.")
+    item = payload["item_data"]
+    # as `DatalabClient.get_item`, drop deleted blocks
+    item["blocks_obj"] = {
+        block_id: block
+        for block_id, block in item.get("blocks_obj", {}).items()
+        if block_id in item.get("display_order", [])
+    }
+    return item
+
+
+async def _fetch_items(session: _Session, item_ids: Iterable[str]) -> dict[str, dict[str, Any]]:
+    async def fetch(item_id: str) -> dict[str, Any]:
+        return _item_data(await session.request(f"get-item-data/{item_id}"), item_id)
+
+    return await session.gather(item_ids, fetch)
+
+
+def fetch_items(
+    client: Any,
+    item_ids: Iterable[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    retries: int = DEFAULT_RETRIES,
+) -> dict[str, dict[str, Any]]:
+    """Fetch many items at once, as `client.get_item(item_id)` would.
+
+    Parameters
+    ----------
+    client
+        An authenticated `DatalabClient`.
+    item_ids
+        The ids of the items to fetch.
+    concurrency
+        The maximum number of requests in flight.
+    retries
+        How many times to retry a request after a network error or a 429/5xx.
+
+    Returns
+    -------
+    A dictionary of item data keyed by item id, in the order requested.
+
+    Raises
+    ------
+    BulkFetchError
+        If any item could not be fetched; the others are on `exc.results`.
+
+    """
+
+    async def main() -> dict[str, dict[str, Any]]:
+        async with _Session(client, concurrency, retries) as session:
+            return await _fetch_items(session, item_ids)
+
+    return _run(main())
+
+
+async def _download(
+    session: _Session, cache: FileCache, file: dict[str, Any], path: Path, overwrite: bool
+) -> Path:
+    if (blob := cache.lookup(file)) is None:
+
+        async def save(response: httpx.Response) -> Path | None:
+            with cache.writer(file) as writer:
+                async for chunk in response.aiter_bytes():
+                    writer.write(chunk)
+            return writer.path
+
+        blob = await session.request(f"files/{file['immutable_id']}/{file['name']}", save)
+    return cache.expose(blob, path, overwrite=overwrite)
+
+
+def fetch_item_files(
+    client: Any,
+    item_ids: Iterable[str],
+    directory: str | Path = ".",
+    overwrite: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    retries: int = DEFAULT_RETRIES,
+) -> dict[str, list[Path]]:
+    """Download every file attached to each of the items, as
+    `client.get_item_files(item_id)` would, but concurrently. Files that were
+    downloaded before (by any session) are linked from the shared file cache.
+
+    Parameters
+    ----------
+    client
+        An authenticated `DatalabClient`.
+    item_ids
+        The ids of the items whose files to download.
+    directory
+        Where to save the files; files with the same name on different items are
+        saved under a subdirectory named after the item.
+    overwrite
+        Whether to replace files that already exist locally.
+    concurrency
+        The maximum number of requests in flight.
+    retries
+        How many times to retry a request after a network error or a 429/5xx.
+
+    Returns
+    -------
+    The local paths of each item's files, keyed by item id.
+
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    cache = default_cache()
+
+    async def main() -> dict[str, list[Path]]:
+        async with _Session(client, concurrency, retries) as session:
+            items = await _fetch_items(session, item_ids)
+
+            names: dict[str, int] = {}
+            for item in items.values():
+                for file in item.get("files", []):
+                    names[file["name"]] = names.get(file["name"], 0) + 1
+
+            downloads: dict[str, tuple[dict[str, Any], Path]] = {}
+            paths: dict[str, list[Path]] = {}
+            for item_id, item in items.items():
+                paths[item_id] = []
+                for file in item.get("files", []):
+                    path = directory / file["name"]
+                    if names[file["name"]] > 1:
+                        path = directory / item_id / file["name"]
+                        path.parent.mkdir(exist_ok=True)
+                    paths[item_id].append(path)
+                    downloads[str(path)] = (file, path)
+
+            await session.gather(
+                downloads,
+                lambda key: _download(session, cache, *downloads[key], overwrite),
+            )
+            return paths
+
+    return _run(main())
+
+
+def walk_descendants(
+    client: Any,
+    item_id: str,
+    max_depth: int | None = None,
+    fetch: bool = True,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    retries: int = DEFAULT_RETRIES,
+) -> dict[str, dict[str, Any]]:
+    """Find every item made from `item_id`, directly or indirectly (e.g. all samples
+    synthesised from a starting material, and the cells made from those samples).
+
+    The item graph is walked one generation at a time, fetching the graphs of all
+    items in a generation concurrently.
+
+    Parameters
+    ----------
+    client
+        An authenticated `DatalabClient`.
+    item_id
+        The item to start from; it is not included in the results.
+    max_depth
+        How many generations to follow; all of them by default.
+    fetch
+        Whether to fetch the full item data of the descendants; otherwise only
+        their graph nodes (id, name and type) are returned.
+    concurrency
+        The maximum number of requests in flight.
+    retries
+        How many times to retry a request after a network error or a 429/5xx.
+
+    Returns
+    -------
+    The descendants keyed by item id, nearest generation first.
+
+    """
+
+    async def main() -> dict[str, dict[str, Any]]:
+        async with _Session(client, concurrency, retries) as session:
+            nodes: dict[str, dict[str, Any]] = {}
+            seen = {item_id}
+            frontier = [item_id]
+            depth = 0
+            while frontier and (max_depth is None or depth < max_depth):
+                graphs = await session.gather(
+                    frontier, lambda node: session.request(f"item-graph/{node}")
+                )
+                children = []
+                for node, graph in graphs.items():
+                    data = {n["data"]["id"]: n["data"] for n in graph.get("nodes", [])}
+                    for edge in graph.get("edges", []):
+                        child = edge["data"]["target"]
+                        if edge["data"]["source"] == node and child not in seen:
+                            seen.add(child)
+                            children.append(child)
+                            nodes[child] = data.get(child, {"id": child})
+                frontier = children
+                depth += 1
+            if fetch:
+                return await _fetch_items(session, nodes)
+            return nodes
+
+    return _run(main())
+
+
+__all__ = ("BulkFetchError", "fetch_items", "fetch_item_files", "walk_descendants")
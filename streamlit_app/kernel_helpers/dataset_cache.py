@@ -0,0 +1,357 @@
+"""A persistent cache of parsed datasets (XRD patterns, echem cycles...), stored as
+Arrow IPC files and loaded by memory-mapping them.
+
+Parsing raw text data into DataFrames is repeated on every run otherwise. Parsed
+results are keyed by the SHA-256 of the raw file plus the parser name and version,
+so they are shared by every kernel and session and invalidated when either the
+data or the parser changes:
+
+    from dataset_cache import load, load_many, load_item_datasets
+
+    df = load("sample-1_xrd.xy")
+    patterns = load_item_datasets(client, ["sample-1", "sample-2"], parser="xrd")
+
+Numeric columns are backed directly by a private (copy-on-write) memory map of
+the cache file: loading doesn't copy or parse anything, pages are shared between
+processes, and modifying a DataFrame never changes the cached copy.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import re
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+DATASET_CACHE_DIR = Path(
+    os.environ.get("DATALAB_DATASET_CACHE_DIR", Path.home() / ".cache" / "datalab-datasets")
+)
+DATASET_CACHE_MAX_BYTES = int(
+    os.environ.get("DATALAB_DATASET_CACHE_MAX_BYTES", 5 * 1024**3)
+)
+DEFAULT_MAX_WORKERS = 4
+
+
+@dataclass(frozen=True)
+class Parser:
+    name: str
+    version: str
+    extensions: tuple[str, ...]
+    parse: Callable[[Path], pd.DataFrame]
+
+
+PARSERS: dict[str, Parser] = {}
+
+
+def register_parser(
+    name: str, version: str, extensions: Iterable[str] = ()
+) -> Callable[[Callable[[Path], pd.DataFrame]], Callable[[Path], pd.DataFrame]]:
+    """Register a function parsing a file into a DataFrame; bump `version` whenever
+    its output changes, so that stale cached results are not used.
+    """
+
+    def decorator(func: Callable[[Path], pd.DataFrame]) -> Callable[[Path], pd.DataFrame]:
+        PARSERS[name] = Parser(name, version, tuple(ext.lower() for ext in extensions), func)
+        return func
+
+    return decorator
+
+
+_NUMERIC_LINE = re.compile(r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?[\s,;]")
+
+
+@register_parser("xrd", "1", (".xy", ".xye", ".dat"))
+def parse_xrd(path: Path) -> pd.DataFrame:
+    """Two or three columns of 2θ, intensity and (optionally) error, after any header."""
+    with open(path, errors="replace") as handle:
+        for skip, line in enumerate(handle):
+            if _NUMERIC_LINE.match(line):
+                break
+        else:
+            raise ValueError(f"No numeric data found in {path}")
+    sep = "," if "," in line else ";" if ";" in line else r"\s+"
+    df = pd.read_csv(path, sep=sep, header=None, skiprows=skip, comment="#")
+    names = ["twotheta", "intensity", "error"][: df.shape[1]]
+    df = df.iloc[:, : len(names)]
+    df.columns = names
+    return df
+
+
+@register_parser("csv", "1", (".csv",))
+def parse_csv(path: Path) -> pd.DataFrame:
+    return pd.read_csv(path)
+
+
+def _package_version(name: str) -> str:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unavailable"
+
+
+@register_parser("echem", f"1-navani-{_package_version('navani')}", (".mpr", ".res", ".idf"))
+def parse_echem(path: Path) -> pd.DataFrame:
+    """Electrochemistry cycling data, via datalab's `navani` loaders."""
+    from navani.echem import echem_file_loader
+
+    return echem_file_loader(str(path))
+
+
+def parser_for(path: Path, parser: str = "auto") -> Parser:
+    if parser != "auto":
+        return PARSERS[parser]
+    suffix = Path(path).suffix.lower()
+    for candidate in PARSERS.values():
+        if suffix in candidate.extensions:
+            return candidate
+    raise ValueError(f"No parser registered for {suffix!r} files; pass `parser=`.")
+
+
+_digests: dict[tuple[int, int, int, int], str] = {}
+
+
+def file_digest(path: Path) -> str:
+    """The SHA-256 of the file, remembered for as long as the file is unchanged."""
+    info = os.stat(path)
+    key = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+    if key not in _digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as handle:
+            while chunk := handle.read(1024 * 1024):
+                digest.update(chunk)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+def _zero_copy_frame(table: pa.Table, mapped: mmap.mmap, base: int) -> pd.DataFrame:
+    """Columns of fixed-width numbers without nulls are numpy views of `mapped`;
+    anything else is converted (copied) by Arrow.
+    """
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        chunk = column.chunk(0) if column.num_chunks == 1 else None
+        if (
+            chunk is not None
+            and chunk.null_count == 0
+            and (pa.types.is_integer(chunk.type) or pa.types.is_floating(chunk.type))
+        ):
+            data = chunk.buffers()[1]
+            width = chunk.type.bit_width // 8
+            values = np.frombuffer(
+                mapped,
+                dtype=chunk.type.to_pandas_dtype(),
+                count=len(chunk),
+                offset=data.address - base + chunk.offset * width,
+            )
+            columns.append(pd.Series(values, name=name, copy=False))
+        else:
+            columns.append(column.to_pandas().rename(name))
+    if not columns:
+        return pd.DataFrame(index=range(table.num_rows))
+    # concatenating keeps one block per column, so nothing is consolidated (copied)
+    return pd.concat(columns, axis=1, copy=False)
+
+
+class DatasetCache:
+    """Parsed datasets stored as `<file sha256>-<parser>-<version>.arrow`.
+
+    Parameters
+    ----------
+    root
+        Where to keep the cache.
+    max_bytes
+        Least recently used datasets are deleted once the cache grows beyond this.
+
+    """
+
+    def __init__(self, root: Path = DATASET_CACHE_DIR, max_bytes: int = DATASET_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, digest: str, parser: Parser) -> Path:
+        return self.root / f"{digest}-{parser.name}-{parser.version}.arrow"
+
+    def read(self, path: Path) -> pd.DataFrame:
+        with open(path, "rb") as handle:
+            # ACCESS_COPY: writes go to private pages, never to the file
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_COPY)
+        buffer = pa.py_buffer(mapped)
+        table = pa.ipc.open_file(pa.BufferReader(buffer)).read_all()
+        df = _zero_copy_frame(table, mapped, buffer.address)
+        if index := (table.schema.metadata or {}).get(b"index"):
+            df = df.set_index(index.decode())
+        return df
+
+    def write(self, path: Path, df: pd.DataFrame) -> None:
+        metadata = {}
+        if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+            name = df.index.name or "index"
+            df = df.reset_index(names=name)
+            metadata[b"index"] = name.encode()
+        table = pa.Table.from_pandas(df, preserve_index=False).combine_chunks()
+        table = table.replace_schema_metadata(metadata)
+        tmp = path.with_name(f".{path.name}.{uuid4().hex}")
+        with pa.OSFile(str(tmp), "wb") as sink:
+            # one record batch, so that every column is a single contiguous buffer
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+        tmp.replace(path)
+        self.evict(keep=path)
+
+    def load(self, path: str | Path, parser: str = "auto") -> pd.DataFrame:
+        """Parse the file at `path`, or load the cached result of parsing it."""
+        chosen = parser_for(Path(path), parser)
+        cached = self.path(file_digest(path), chosen)
+        try:
+            df = self.read(cached)
+            os.utime(cached)
+            self.hits += 1
+            return df
+        except (FileNotFoundError, pa.ArrowInvalid):
+            pass
+        self.misses += 1
+        self.write(cached, chosen.parse(Path(path)))
+        return self.read(cached)
+
+    def evict(self, keep: Path | None = None) -> None:
+        entries = []
+        for entry in self.root.glob("*.arrow"):
+            try:
+                entries.append((entry, entry.stat()))
+            except FileNotFoundError:
+                continue
+        entries.sort(key=lambda item: item[1].st_mtime)
+        total = sum(info.st_size for _, info in entries)
+        for entry, info in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            # mapped DataFrames keep working; the pages stay until they are closed
+            entry.unlink(missing_ok=True)
+            total -= info.st_size
+
+    def stats(self) -> dict[str, int]:
+        sizes = [entry.stat().st_size for entry in self.root.glob("*.arrow")]
+        return {
+            "datasets": len(sizes),
+            "bytes": sum(sizes),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_default_cache: DatasetCache | None = None
+
+
+def default_cache() -> DatasetCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DatasetCache()
+    return _default_cache
+
+
+def load(path: str | Path, parser: str = "auto") -> pd.DataFrame:
+    """Load a raw data file as a DataFrame, parsing it only if no session has
+    parsed this exact file with this version of the parser before.
+
+    Parameters
+    ----------
+    path
+        The raw data file.
+    parser
+        The name of a registered parser (e.g. "xrd", "csv", "echem"); by default
+        chosen from the file extension.
+
+    """
+    return default_cache().load(path, parser)
+
+
+def load_many(
+    paths: Iterable[str | Path], parser: str = "auto", max_workers: int = DEFAULT_MAX_WORKERS
+) -> dict[str, pd.DataFrame]:
+    """`load` many files, parsing any uncached ones in parallel.
+
+    Returns
+    -------
+    The DataFrames keyed by path, in the order given.
+
+    """
+    paths = [str(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = executor.map(lambda path: load(path, parser), paths)
+        return dict(zip(paths, frames))
+
+
+def load_item_datasets(
+    client: Any,
+    item_ids: Iterable[str],
+    parser: str = "auto",
+    directory: str | Path = ".",
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> dict[str, dict[str, pd.DataFrame]]:
+    """Download (see `datalab_bulk.fetch_item_files`) and load the data files of many
+    items at once, e.g. the XRD patterns of every sample made from a starting material.
+
+    Parameters
+    ----------
+    client
+        An authenticated `DatalabClient`.
+    item_ids
+        The items whose files to load.
+    parser
+        The name of a registered parser; by default chosen from each file's
+        extension, skipping files that no parser handles.
+    directory
+        Where to download the files.
+    max_workers
+        How many files to parse in parallel.
+
+    Returns
+    -------
+    `{item_id: {file name: DataFrame}}`
+
+    """
+    from datalab_bulk import fetch_item_files
+
+    item_paths = fetch_item_files(client, item_ids, directory=directory)
+    wanted = {
+        item_id: [
+            path
+            for path in paths
+            if parser != "auto"
+            or any(path.suffix.lower() in p.extensions for p in PARSERS.values())
+        ]
+        for item_id, paths in item_paths.items()
+    }
+    frames = load_many(
+        [path for paths in wanted.values() for path in paths], parser, max_workers
+    )
+    return {
+        item_id: {path.name: frames[str(path)] for path in paths}
+        for item_id, paths in wanted.items()
+    }
+
+
+__all__ = (
+    "DatasetCache",
+    "load",
+    "load_item_datasets",
+    "load_many",
+    "register_parser",
+)
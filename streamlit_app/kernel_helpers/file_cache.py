@@ -0,0 +1,264 @@
+"""A persistent, content-addressed cache of files downloaded from datalab.
+
+Raw data files are stored once under their SHA-256 digest, and indexed by the
+datalab file id plus whatever version information the server gives for the file.
+Code gets its own copy of each file (a reflink, sharing the blob's data until
+either is written to, where the filesystem supports it), so rewriting a file in
+place can't corrupt the blob for everyone else. The cache lives outside the
+kernel working directory so that every kernel, session and user shares it, and
+it is kept under a size cap by evicting the least recently used files.
+
+`install()` makes `DatalabClient.get_item_files` use the cache; it is called
+when the kernel warms up.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import warnings
+from pathlib import Path
+from typing import Any, Iterator
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+FILE_CACHE_DIR = Path(
+    os.environ.get("DATALAB_FILE_CACHE_DIR", Path.home() / ".cache" / "datalab-files")
+)
+FILE_CACHE_MAX_BYTES = int(os.environ.get("DATALAB_FILE_CACHE_MAX_BYTES", 5 * 1024**3))
+
+# Fields of a datalab file entry that change when the file contents do
+VERSION_FIELDS = ("checksum", "sha256", "version", "size", "last_modified", "last_modified_remote")
+
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl cloning a file's extents (btrfs, XFS, ...), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def version_key(file: dict[str, Any]) -> str:
+    """Identifies a version of a datalab file: its id and the fields that change
+    with its contents.
+    """
+    version = {key: file[key] for key in VERSION_FIELDS if file.get(key) is not None}
+    digest = hashlib.sha256(json.dumps(version, sort_keys=True, default=str).encode())
+    return f"{file['immutable_id']}-{digest.hexdigest()[:16]}"
+
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        while chunk := handle.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _clone(source: Path, dest: Path) -> None:
+    """Copy `source` to `dest`, as a reflink if the filesystem can make one."""
+    if fcntl is not None:
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, dest)
+
+
+class FileCache:
+    """Blobs are stored as `blobs/<sha256>`, read-only and only ever handed out as
+    copies; `entries/<version key>` holds the digest of the blob for each file
+    version.
+
+    Parameters
+    ----------
+    root
+        Where to keep the cache.
+    max_bytes
+        Least recently used blobs are deleted once the cache grows beyond this.
+
+    """
+
+    def __init__(self, root: Path = FILE_CACHE_DIR, max_bytes: int = FILE_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.blobs = self.root / "blobs"
+        self.entries = self.root / "entries"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.entries.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, file: dict[str, Any]) -> Path | None:
+        """The cached blob for this version of the file, if any."""
+        entry = self.entries / version_key(file)
+        try:
+            blob = self.blobs / entry.read_text().strip()
+            # mark as recently used
+            os.utime(blob)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return blob
+
+    def writer(self, file: dict[str, Any]) -> _BlobWriter:
+        """Stream a download into the cache, hashing it as it is written:
+
+            with cache.writer(file) as blob:
+                for chunk in response.iter_bytes():
+                    blob.write(chunk)
+            path = blob.path
+
+        """
+        return _BlobWriter(self, version_key(file))
+
+    def _commit(self, key: str, tmp: Path, digest: str) -> Path:
+        blob = self.blobs / digest
+        if blob.exists():
+            # identical contents under another id or version
+            tmp.unlink()
+            os.utime(blob)
+        else:
+            tmp.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            tmp.replace(blob)
+        entry_tmp = self.entries / f".{key}.{uuid4().hex}"
+        entry_tmp.write_text(digest)
+        entry_tmp.replace(self.entries / key)
+        self.evict(keep=blob)
+        return blob
+
+    def _blobs(self) -> Iterator[tuple[Path, os.stat_result]]:
+        for blob in self.blobs.iterdir():
+            if not blob.name.startswith("."):
+                try:
+                    yield blob, blob.stat()
+                except FileNotFoundError:
+                    continue
+
+    def evict(self, keep: Path | None = None) -> None:
+        """Delete least recently used blobs (except `keep`) until the cache fits
+        `max_bytes`. Entries pointing to deleted blobs are treated as misses.
+        """
+        blobs = sorted(self._blobs(), key=lambda item: item[1].st_mtime)
+        total = sum(info.st_size for _, info in blobs)
+        for blob, info in blobs:
+            if total <= self.max_bytes:
+                break
+            if blob == keep:
+                continue
+            blob.unlink(missing_ok=True)
+            total -= info.st_size
+
+    def expose(self, blob: Path, dest: Path, overwrite: bool = False) -> Path:
+        """Copy `blob` to `dest`, without duplicating its data if the filesystem
+        supports reflinks.
+        """
+        dest = Path(dest)
+        if dest.exists() or dest.is_symlink():
+            if (
+                dest.is_file()
+                and dest.stat().st_size == blob.stat().st_size
+                and _file_digest(dest) == blob.name
+            ):
+                # e.g. the same file fetched again
+                return dest
+            if not overwrite:
+                warnings.warn(f"Will not overwrite existing file {dest}")
+                return dest
+            dest.unlink()
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{uuid4().hex}.part")
+        try:
+            _clone(blob, tmp)
+            tmp.replace(dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return dest
+
+    def stats(self) -> dict[str, int]:
+        blobs = list(self._blobs())
+        return {
+            "files": len(blobs),
+            "bytes": sum(info.st_size for _, info in blobs),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class _BlobWriter:
+    def __init__(self, cache: FileCache, key: str):
+        self._cache = cache
+        self._key = key
+        self._tmp = cache.blobs / f".{uuid4().hex}.part"
+        self._hash = hashlib.sha256()
+        self.path: Path | None = None
+
+    def __enter__(self) -> _BlobWriter:
+        self._handle = open(self._tmp, "wb")
+        return self
+
+    def write(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+        self._handle.write(chunk)
+
+    def __exit__(self, exc_type, *_) -> None:
+        self._handle.close()
+        if exc_type is not None:
+            self._tmp.unlink(missing_ok=True)
+            return
+        self.path = self._cache._commit(self._key, self._tmp, self._hash.hexdigest())
+
+
+_default_cache: FileCache | None = None
+
+
+def default_cache() -> FileCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FileCache()
+    return _default_cache
+
+
+def get_item_files(self, item_id: str) -> list[Path]:
+    """Download all the files for a given item and save them locally
+    in the current working directory, reusing cached downloads.
+
+    Parameters:
+        item_id: The ID of the item to search for.
+
+    Returns:
+        The paths of the files.
+
+    """
+    cache = default_cache()
+    paths = []
+    for file in self.get_item(item_id).get("files", []):
+        if (blob := cache.lookup(file)) is None:
+            url = f"{self.datalab_api_url}/files/{file['immutable_id']}/{file['name']}"
+            with cache.writer(file) as writer:
+                with self.session.stream("GET", url, follow_redirects=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_bytes(chunk_size=CHUNK_SIZE):
+                        writer.write(chunk)
+            blob = writer.path
+        paths.append(cache.expose(blob, Path(file["name"])))
+    return paths
+
+
+def install() -> None:
+    """Make `DatalabClient.get_item_files` use the file cache."""
+    from datalab_api import DatalabClient
+
+    DatalabClient.get_item_files = get_item_files
+
+
+__all__ = ("FileCache", "default_cache", "install", "version_key")
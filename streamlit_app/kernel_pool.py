@@ -0,0 +1,349 @@
+"""A pool of pre-started, pre-warmed codebox kernels.
+
+Starting a kernel gateway and importing the scientific stack dominates the
+latency of a single tool call, so we keep a few kernels hot and hand them out
+on demand.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+from codeboxapi import CodeBox, settings
+from codeboxapi.box.localbox import LocalBox
+
+# Helper modules written for generated code (e.g. `datalab_bulk`), importable in every kernel
+KERNEL_HELPERS_DIR = Path(__file__).parent / "kernel_helpers"
+
+# Run before the warm-up code, so that it applies even with a custom warm-up script
+KERNEL_SETUP_CODE = f"""
+import sys as _sys
+if {str(KERNEL_HELPERS_DIR.resolve())!r} not in _sys.path:
+    _sys.path.insert(0, {str(KERNEL_HELPERS_DIR.resolve())!r})
+del _sys
+"""
+
+# Run in every kernel straight after it starts (and again after each reset), so that
+# the heavy imports are already in `sys.modules` by the time user code arrives.
+DEFAULT_WARMUP_CODE = """
+for _module in ("numpy", "pandas", "matplotlib", "matplotlib.pyplot", "datalab_api", "datalab_bulk", "dataset_cache"):
+    try:
+        __import__(_module)
+    except Exception:
+        pass
+del _module
+try:
+    # serve `DatalabClient.get_item_files` from the shared download cache
+    import file_cache
+    file_cache.install()
+    del file_cache
+except Exception:
+    pass
+"""
+
+# Where (local) kernels start, and go back to whenever they are reset
+KERNEL_HOME = Path(".codebox")
+
+
+def chdir_code(directory: Path) -> str:
+    """Code that makes `directory` (created if need be) the kernel's working directory."""
+    path = str(directory.resolve())
+    return f"import os as _os; _os.makedirs({path!r}, exist_ok=True); _os.chdir({path!r}); del _os"
+
+
+# Wipe the user namespace between checkouts; imported modules stay cached.
+RESET_CODE = f"""%reset -f
+import matplotlib.pyplot as _plt; _plt.close("all"); del _plt
+{chdir_code(KERNEL_HOME)}
+"""
+
+KERNEL_POOL_MIN_IDLE = int(os.environ.get("KERNEL_POOL_MIN_IDLE", 1))
+KERNEL_POOL_MAX_SIZE = int(os.environ.get("KERNEL_POOL_MAX_SIZE", 4))
+KERNEL_POOL_IDLE_TIMEOUT = float(os.environ.get("KERNEL_POOL_IDLE_TIMEOUT", 600))
+
+
+def _default_warmup_code() -> str:
+    if script := os.environ.get("KERNEL_WARMUP_SCRIPT"):
+        return Path(script).read_text()
+    return DEFAULT_WARMUP_CODE
+
+
+class PooledLocalBox(LocalBox):
+    """`LocalBox` is a process-wide singleton upstream; the pool needs one
+    kernel gateway per box, each tracking only its own process.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, /, **kwargs) -> None:
+        super().__init__(**kwargs)
+        # upstream keeps this on the class and `stop()` can kill every pid in it
+        self._jupyter_pids = []
+
+
+def spawn_codebox() -> LocalBox | CodeBox:
+    """Create a new, not yet started, codebox."""
+    if settings.CODEBOX_API_KEY in (None, "local"):
+        return PooledLocalBox()
+    return CodeBox()
+
+
+class KernelPool:
+    """Hands out started kernels that have already run the warm-up script.
+
+    Parameters
+    ----------
+    min_idle
+        The number of idle kernels to keep started in the background.
+    max_size
+        The maximum number of kernels (idle and checked out) at any one time.
+    idle_timeout
+        Idle kernels beyond `min_idle` are stopped after this many seconds.
+    warmup_code
+        Code run in every kernel after it starts and after every reset.
+    box_factory
+        Callable returning a new, unstarted codebox.
+
+    """
+
+    _instance: KernelPool | None = None
+    _instance_lock = threading.Lock()
+    # kernel gateways pick their port by probing, so only start one at a time
+    _start_lock = threading.Lock()
+
+    def __init__(
+        self,
+        min_idle: int = KERNEL_POOL_MIN_IDLE,
+        max_size: int = KERNEL_POOL_MAX_SIZE,
+        idle_timeout: float = KERNEL_POOL_IDLE_TIMEOUT,
+        warmup_code: str | None = None,
+        box_factory: Callable[[], LocalBox | CodeBox] = spawn_codebox,
+    ):
+        self.min_idle = max(min_idle, 0)
+        self.max_size = max(max_size, 1, self.min_idle)
+        self.idle_timeout = idle_timeout
+        self.warmup_code = warmup_code if warmup_code is not None else _default_warmup_code()
+        self._box_factory = box_factory
+
+        self._cond = threading.Condition()
+        # (box, time it was returned to the pool)
+        self._idle: list[tuple[LocalBox | CodeBox, float]] = []
+        self._size = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+        self._started = 0
+        self._evicted = 0
+
+        self._maintainer = threading.Thread(
+            target=self._maintain, name="kernel-pool", daemon=True
+        )
+        self._maintainer.start()
+
+    @classmethod
+    def instance(cls) -> KernelPool:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _start_box(self) -> LocalBox | CodeBox:
+        box = self._box_factory()
+        with self._start_lock:
+            box.start()
+        box.run(KERNEL_SETUP_CODE)
+        if self.warmup_code.strip():
+            box.run(self.warmup_code)
+        return box
+
+    def _stop_box(self, box: LocalBox | CodeBox) -> None:
+        try:
+            box.stop()
+        except Exception as exc:
+            print(f"Failed to stop kernel {box.session_id}: {exc}")
+
+    def acquire(self, timeout: float | None = None) -> LocalBox | CodeBox:
+        """Check out a warm kernel, starting a new one if the pool has room,
+        otherwise wait for one to be released.
+        """
+        start = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Kernel pool has been shut down.")
+                if self._idle:
+                    box, _ = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    box = None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(
+                        f"No kernel became available within {timeout} seconds."
+                    )
+                self._cond.wait(remaining)
+
+        if box is None:
+            try:
+                box = self._start_box()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            self._started += 1
+
+        self._record_wait(time.perf_counter() - start)
+        # top the idle set back up for the next caller
+        with self._cond:
+            self._cond.notify_all()
+        return box
+
+    def acquire_idle(self) -> LocalBox | CodeBox | None:
+        """Check out a warm kernel if one is idle, without waiting or starting one."""
+        with self._cond:
+            if self._closed or not self._idle:
+                return None
+            box, _ = self._idle.pop()
+            # top the idle set back up for the next caller
+            self._cond.notify_all()
+        self._record_wait(0.0)
+        return box
+
+    def reset(self, box: LocalBox | CodeBox) -> None:
+        """Wipe a kernel's namespace and re-run the warm-up script."""
+        box.run(RESET_CODE)
+        if self.warmup_code.strip():
+            box.run(self.warmup_code)
+
+    def release(self, box: LocalBox | CodeBox, reset: bool = True) -> None:
+        """Return a kernel to the pool, wiping its namespace first by default."""
+        if reset:
+            try:
+                self.reset(box)
+            except Exception as exc:
+                print(f"Kernel reset failed, discarding it: {exc}")
+                self.discard(box)
+                return
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                stop = True
+            else:
+                self._idle.append((box, time.monotonic()))
+                stop = False
+            self._cond.notify_all()
+        if stop:
+            self._stop_box(box)
+
+    def discard(self, box: LocalBox | CodeBox) -> None:
+        """Stop a checked-out kernel instead of returning it to the pool."""
+        with self._cond:
+            self._size -= 1
+            self._cond.notify_all()
+        self._stop_box(box)
+
+    @contextmanager
+    def checkout(self, timeout: float | None = None) -> Iterator[LocalBox | CodeBox]:
+        box = self.acquire(timeout=timeout)
+        try:
+            yield box
+        except BaseException:
+            # the kernel may be mid-execution; don't hand it to anyone else
+            self.discard(box)
+            raise
+        else:
+            self.release(box)
+
+    def _record_wait(self, wait: float) -> None:
+        with self._cond:
+            self._checkouts += 1
+            self._total_wait += wait
+            self._last_wait = wait
+            self._max_wait = max(self._max_wait, wait)
+        print(f"Kernel checkout waited {wait * 1000:.1f} ms")
+
+    def stats(self) -> dict[str, float | int]:
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+                "started": self._started,
+                "evicted": self._evicted,
+                "checkouts": self._checkouts,
+                "last_wait_s": self._last_wait,
+                "max_wait_s": self._max_wait,
+                "mean_wait_s": self._total_wait / self._checkouts
+                if self._checkouts
+                else 0.0,
+            }
+
+    def _maintain(self) -> None:
+        """Keep `min_idle` kernels warm and stop those idle for too long."""
+        while True:
+            to_stop = []
+            with self._cond:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                # oldest first, never dropping below the idle floor
+                self._idle.sort(key=lambda entry: entry[1])
+                while (
+                    len(self._idle) > self.min_idle
+                    and now - self._idle[0][1] > self.idle_timeout
+                ):
+                    to_stop.append(self._idle.pop(0)[0])
+                    self._size -= 1
+                    self._evicted += 1
+                grow = len(self._idle) < self.min_idle and self._size < self.max_size
+                if grow:
+                    self._size += 1
+
+            for box in to_stop:
+                self._stop_box(box)
+
+            if grow:
+                try:
+                    box = self._start_box()
+                except Exception as exc:
+                    print(f"Failed to pre-start kernel: {exc}")
+                    with self._cond:
+                        self._size -= 1
+                    time.sleep(5)
+                    continue
+                with self._cond:
+                    self._started += 1
+                    self._idle.append((box, time.monotonic()))
+                    self._cond.notify_all()
+                continue
+
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(timeout=min(self.idle_timeout, 30))
+
+    def shutdown(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle = [box for box, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for box in idle:
+            self._stop_box(box)
+
+
+__all__ = ("KernelPool", "chdir_code", "spawn_codebox")
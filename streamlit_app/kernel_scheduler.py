@@ -0,0 +1,341 @@
+"""Gives each Streamlit session its own kernel from a bounded pool.
+
+Sessions keep their kernel (and therefore their variables) between tool calls.
+When every kernel is taken, new sessions queue in arrival order and the least
+recently used idle session loses its kernel to the head of the queue. Each
+session's code runs in a working directory of its own (`session_workdir`), so
+that sessions neither see nor overwrite each other's files.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator
+from uuid import uuid4
+
+import httpx
+from codeboxapi import CodeBox
+from codeboxapi.box.localbox import LocalBox
+
+from kernel_pool import KERNEL_HOME, KernelPool
+
+KERNEL_SCHEDULER_MAX_KERNELS = int(os.environ.get("KERNEL_SCHEDULER_MAX_KERNELS", 4))
+# Sessions that have not run anything for this long give their kernel back
+KERNEL_SCHEDULER_SESSION_IDLE_TIMEOUT = float(
+    os.environ.get("KERNEL_SCHEDULER_SESSION_IDLE_TIMEOUT", 1800)
+)
+
+KERNEL_SESSIONS_DIR = KERNEL_HOME / "sessions"
+
+
+def session_workdir(session_id: str) -> Path:
+    """The directory the session's code runs in, and where its files go."""
+    return KERNEL_SESSIONS_DIR / re.sub(r"[^\w.-]", "_", session_id)
+
+
+@dataclass
+class SessionKernel:
+    # None until the kernel has been started or taken over from another session
+    box: LocalBox | CodeBox | None = None
+    busy: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class KernelScheduler:
+    """Leases one kernel per session id out of at most `max_kernels` kernels."""
+
+    _instance: KernelScheduler | None = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        max_kernels: int = KERNEL_SCHEDULER_MAX_KERNELS,
+        session_idle_timeout: float = KERNEL_SCHEDULER_SESSION_IDLE_TIMEOUT,
+        pool: KernelPool | None = None,
+    ):
+        self.max_kernels = max(max_kernels, 1)
+        self.session_idle_timeout = session_idle_timeout
+        self.pool = pool or KernelPool(max_size=self.max_kernels)
+
+        self._cond = threading.Condition()
+        # ordered least -> most recently used
+        self._sessions: OrderedDict[str, SessionKernel] = OrderedDict()
+        self._queue: deque[object] = deque()
+        self._assigned = 0
+        # identifies the kernel each session holds; unique across sessions, so it
+        # can be forgotten once the session is released
+        self._generations: dict[str, int] = {}
+        self._next_generation = 0
+        # called with the id of each session whose kernel is taken away
+        self._release_callbacks: list[Callable[[str], None]] = []
+
+        self._evictions = 0
+        self._leases = 0
+        # kernels lent out for one-off runs, outside of any session
+        self._borrowed = 0
+        self._borrows = 0
+        self._queued = 0
+        self._total_queue_wait = 0.0
+        self._max_queue_wait = 0.0
+        self._busy_time = 0.0
+        self._created = time.monotonic()
+
+    @classmethod
+    def instance(cls) -> KernelScheduler:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def on_session_released(self, callback: Callable[[str], None]) -> None:
+        """Call `callback(session_id)` whenever a session's kernel is taken away
+        (it went idle, was evicted or was released), so that whatever else is
+        kept for the session can be dropped too.
+        """
+        with self._cond:
+            self._release_callbacks.append(callback)
+
+    def _released(self, session_ids: list[str]) -> None:
+        """Must be called without the lock held."""
+        with self._cond:
+            callbacks = list(self._release_callbacks)
+        for session_id in session_ids:
+            for callback in callbacks:
+                try:
+                    callback(session_id)
+                except Exception as exc:
+                    print(f"Failed to release session {session_id}: {exc}")
+
+    def _forget(self, session_id: str) -> SessionKernel:
+        """Take a session's kernel away. Must be called with the lock held."""
+        self._generations.pop(session_id, None)
+        return self._sessions.pop(session_id)
+
+    def _sweep_idle_sessions(self) -> dict[str, LocalBox | CodeBox]:
+        """Detach kernels from sessions that have been idle for too long.
+        Must be called with the lock held.
+        """
+        now = time.monotonic()
+        expired = [
+            session_id
+            for session_id, entry in self._sessions.items()
+            if not entry.busy and now - entry.last_used > self.session_idle_timeout
+        ]
+        boxes = {}
+        for session_id in expired:
+            boxes[session_id] = self._forget(session_id).box
+            self._assigned -= 1
+            self._evictions += 1
+        return boxes
+
+    def _lru_idle_session(self) -> str | None:
+        for session_id, entry in self._sessions.items():
+            if not entry.busy:
+                return session_id
+        return None
+
+    @contextmanager
+    def lease(self, session_id: str) -> Iterator[LocalBox | CodeBox]:
+        """Hold the session's kernel for the duration of the block."""
+        entry = self._acquire(session_id)
+        start = time.monotonic()
+        try:
+            yield entry.box
+        finally:
+            with self._cond:
+                entry.busy = False
+                entry.last_used = time.monotonic()
+                self._busy_time += entry.last_used - start
+                self._cond.notify_all()
+
+    def _acquire(self, session_id: str) -> SessionKernel:
+        start = time.monotonic()
+        ticket = None
+        victim = None
+        victim_entry = None
+        with self._cond:
+            expired = self._sweep_idle_sessions()
+            while True:
+                entry = self._sessions.get(session_id)
+                if entry is not None:
+                    if entry.busy:
+                        # another call from the same session; wait for it
+                        self._cond.wait()
+                        continue
+                    entry.busy = True
+                    self._sessions.move_to_end(session_id)
+                    self._leases += 1
+                    break
+
+                if ticket is None:
+                    ticket = object()
+                    self._queue.append(ticket)
+                    self._queued += 1
+
+                if self._queue[0] is ticket:
+                    if self._assigned < self.max_kernels:
+                        self._assigned += 1
+                    elif (victim := self._lru_idle_session()) is not None:
+                        victim_entry = self._forget(victim)
+                        self._evictions += 1
+                    else:
+                        self._cond.wait()
+                        continue
+                    self._queue.popleft()
+                    entry = SessionKernel(busy=True)
+                    self._sessions[session_id] = entry
+                    self._generations[session_id] = self._next_generation
+                    self._next_generation += 1
+                    self._leases += 1
+                    self._cond.notify_all()
+                    break
+
+                self._cond.wait()
+
+        for box in expired.values():
+            self.pool.release(box)
+        self._released([*expired, *([victim] if victim_entry is not None else [])])
+
+        if entry.box is None:
+            wait = time.monotonic() - start
+            try:
+                if victim_entry is not None:
+                    print(f"Evicting kernel of idle session {victim} for {session_id}")
+                    self.pool.reset(victim_entry.box)
+                    entry.box = victim_entry.box
+                else:
+                    entry.box = self.pool.acquire()
+            except Exception:
+                with self._cond:
+                    self._sessions.pop(session_id, None)
+                    self._assigned -= 1
+                    self._cond.notify_all()
+                if victim_entry is not None:
+                    self.pool.discard(victim_entry.box)
+                raise
+            with self._cond:
+                self._total_queue_wait += wait
+                self._max_queue_wait = max(self._max_queue_wait, wait)
+        return entry
+
+    def release_session(self, session_id: str) -> None:
+        """Give a session's kernel back to the pool, e.g. when the session ends."""
+        with self._cond:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry.busy:
+                return
+            self._forget(session_id)
+            self._assigned -= 1
+            self._cond.notify_all()
+        self.pool.release(entry.box)
+        self._released([session_id])
+
+    def borrow(self) -> LocalBox | CodeBox | None:
+        """A clean kernel for a one-off run outside of any session (e.g. a tool
+        call run in parallel with the session's own), or None unless one is idle
+        in the pool and no session is waiting for a kernel. It counts against
+        `max_kernels` until it is given back with `give_back`.
+        """
+        with self._cond:
+            if self._queue or self._assigned >= self.max_kernels:
+                return None
+            self._assigned += 1
+        box = self.pool.acquire_idle()
+        with self._cond:
+            if box is None:
+                self._assigned -= 1
+                self._cond.notify_all()
+            else:
+                self._borrowed += 1
+                self._borrows += 1
+        return box
+
+    def give_back(self, box: LocalBox | CodeBox) -> None:
+        """Return a borrowed kernel; it is reset before anyone else gets it."""
+        self.pool.release(box)
+        with self._cond:
+            self._borrowed -= 1
+            self._assigned -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def checkout(self) -> Iterator[LocalBox | CodeBox]:
+        """A clean kernel for one stateless run: a borrowed one if the pool has
+        one idle, otherwise one leased (queueing with the sessions) for a
+        one-off session.
+        """
+        if (box := self.borrow()) is not None:
+            try:
+                yield box
+            finally:
+                self.give_back(box)
+            return
+        session_id = f"checkout-{uuid4().hex}"
+        try:
+            with self.lease(session_id) as box:
+                yield box
+        finally:
+            self.release_session(session_id)
+
+    def interrupt(self, session_id: str) -> bool:
+        """Interrupt whatever the session's kernel is running (like Ctrl-C in a
+        notebook), keeping its state. Returns whether anything was interrupted.
+        """
+        with self._cond:
+            entry = self._sessions.get(session_id)
+            if entry is None or not entry.busy or entry.box is None:
+                return False
+            box = entry.box
+        kernel_id = getattr(box, "kernel_id", None)
+        if kernel_id is None:
+            return False
+        try:
+            response = httpx.post(f"{box.kernel_url}/kernels/{kernel_id}/interrupt", timeout=10)
+        except httpx.HTTPError as exc:
+            print(f"Failed to interrupt kernel of session {session_id}: {exc}")
+            return False
+        return response.status_code == 204
+
+    def has_kernel(self, session_id: str) -> bool:
+        with self._cond:
+            return session_id in self._sessions
+
+    def generation(self, session_id: str) -> int:
+        """Identifies the session's current kernel: it changes whenever the session
+        is given a fresh one; -1 if it has none.
+        """
+        with self._cond:
+            return self._generations.get(session_id, -1)
+
+    def metrics(self) -> dict[str, float | int]:
+        with self._cond:
+            busy = sum(entry.busy for entry in self._sessions.values())
+            elapsed = time.monotonic() - self._created
+            return {
+                "sessions": len(self._sessions),
+                "busy_kernels": busy,
+                "borrowed_kernels": self._borrowed,
+                "max_kernels": self.max_kernels,
+                "queue_depth": len(self._queue),
+                "utilisation": busy / self.max_kernels,
+                "mean_utilisation": self._busy_time / (elapsed * self.max_kernels)
+                if elapsed
+                else 0.0,
+                "leases": self._leases,
+                "evictions": self._evictions,
+                "borrows": self._borrows,
+                "mean_queue_wait_s": self._total_queue_wait / self._queued
+                if self._queued
+                else 0.0,
+                "max_queue_wait_s": self._max_queue_wait,
+            }
+
+
+__all__ = ("KernelScheduler", "session_workdir")
@@ -0,0 +1,219 @@
+"""Shrinks large codebox outputs before they reach the agent scratchpad.
+
+Common output shapes (tracebacks, DataFrame reprs, JSON/dict dumps of datalab items,
+runs of repeated lines) are summarised structurally down to a token budget. The
+full output is written to a file in the kernel working directory, so that later
+code can still read it; the least recently written of those are deleted once they
+add up to `OUTPUT_DIR_MAX_BYTES`, and the rest go with the session's directory.
+"""
+
+from __future__ import annotations
+
+import ast
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any
+
+from history import estimate_tokens
+
+OUTPUT_TOKEN_BUDGET = int(os.environ.get("CODEBOX_OUTPUT_TOKEN_BUDGET", 2000))
+# The most output codebox keeps from one run (its `MAX_OUTPUT_LENGTH`); only a
+# safeguard against runaway output, as `reduce_output` decides what the agent sees
+CODEBOX_MAX_OUTPUT_CHARS = int(os.environ.get("CODEBOX_MAX_OUTPUT_CHARS", 10 * 1024**2))
+
+# Relative to the kernel working directory, so the path we report works from code
+OUTPUT_DIR = "outputs"
+# Older full outputs are deleted once a session's outputs grow beyond this
+OUTPUT_DIR_MAX_BYTES = int(os.environ.get("CODEBOX_OUTPUT_DIR_MAX_BYTES", 50 * 1024**2))
+CODEBOX_DIR = Path(".codebox")
+
+# Items/rows shown at each end of long sequences
+EDGE_ITEMS = 3
+MAX_STRING_CHARS = 200
+MAX_LINE_CHARS = 300
+TRACEBACK_TAIL_LINES = 12
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+_DATAFRAME_SHAPE = re.compile(r"^\[(\d+) rows x (\d+) columns\]$", re.MULTILINE)
+
+
+def _strip_ansi(text: str) -> str:
+    return _ANSI_ESCAPE.sub("", text)
+
+
+def _collapse_repeats(text: str) -> str:
+    """Collapse runs of identical lines into one line with a count."""
+    lines = text.splitlines()
+    collapsed: list[str] = []
+    idx = 0
+    while idx < len(lines):
+        run = 1
+        while idx + run < len(lines) and lines[idx + run] == lines[idx]:
+            run += 1
+        collapsed.append(lines[idx])
+        if run > 2:
+            collapsed.append(f"... (previous line repeated {run - 1} more times)")
+        elif run == 2:
+            collapsed.append(lines[idx])
+        idx += run
+    return "\n".join(collapsed)
+
+
+def _reduce_traceback(text: str) -> str | None:
+    if "Traceback (most recent call last)" not in text and not re.search(
+        r"^\w+(Error|Exception): ", text, re.MULTILINE
+    ):
+        return None
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) <= TRACEBACK_TAIL_LINES:
+        return "\n".join(lines)
+    # the last frames and the exception message are what the model needs
+    return "\n".join(
+        [f"... ({len(lines) - TRACEBACK_TAIL_LINES} traceback lines omitted)"]
+        + lines[-TRACEBACK_TAIL_LINES:]
+    )
+
+
+def _reduce_dataframe(text: str) -> str | None:
+    if not (shape := _DATAFRAME_SHAPE.search(text)):
+        return None
+    # pandas wraps wide frames over several blank-line separated blocks; keep the first
+    lines = text[: shape.start()].strip("\n").split("\n\n")[0].splitlines()
+    header, rows = lines[:1], lines[1:]
+    if len(rows) > 2 * EDGE_ITEMS:
+        rows = rows[:EDGE_ITEMS] + ["..."] + rows[-EDGE_ITEMS:]
+    rows = [
+        row if len(row) <= MAX_LINE_CHARS else row[:MAX_LINE_CHARS] + "..."
+        for row in header + rows
+    ]
+    return "\n".join(rows + [shape.group(0)])
+
+
+def _shorten(value: Any, depth: int = 0) -> Any:
+    if isinstance(value, str) and len(value) > MAX_STRING_CHARS:
+        return value[:MAX_STRING_CHARS] + f"... ({len(value)} chars)"
+    if isinstance(value, dict):
+        if depth > 3:
+            return f"{{... {len(value)} keys}}"
+        return {key: _shorten(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if depth > 3:
+            return f"[... {len(value)} items]"
+        items = [_shorten(item, depth + 1) for item in value[:EDGE_ITEMS]]
+        if len(value) > EDGE_ITEMS:
+            items.append(f"... {len(value) - EDGE_ITEMS} more items")
+        return items
+    return value
+
+
+def _reduce_structured(text: str) -> str | None:
+    """JSON, or the repr of a dict/list as printed by Python."""
+    stripped = text.strip()
+    if not stripped or stripped[0] not in "[{":
+        return None
+    try:
+        value = json.loads(stripped)
+    except ValueError:
+        try:
+            value = ast.literal_eval(stripped)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            return None
+    summary = []
+    if isinstance(value, list):
+        summary.append(f"A list of {len(value)} items.")
+        if value and all(isinstance(item, dict) for item in value):
+            keys = sorted({key for item in value for key in item})
+            summary.append(f"Item keys: {', '.join(map(str, keys))}")
+    elif isinstance(value, dict):
+        summary.append(f"A dict with keys: {', '.join(map(str, value))}")
+    summary.append(json.dumps(_shorten(value), indent=1, default=str))
+    return "\n".join(summary)
+
+
+def _head_and_tail(text: str, token_budget: int) -> str:
+    # ~4 characters per token, split between the start and the end
+    keep = max(token_budget * 4 // 2, 1)
+    if len(text) <= 2 * keep:
+        return text
+    return (
+        text[:keep]
+        + f"\n... ({len(text) - 2 * keep} characters omitted) ...\n"
+        + text[-keep:]
+    )
+
+
+def _evict_outputs(directory: Path, keep: Path) -> None:
+    """Delete the least recently written outputs (except `keep`) until the
+    directory fits `OUTPUT_DIR_MAX_BYTES`.
+    """
+    outputs = []
+    for path in directory.glob("output-*.txt"):
+        try:
+            outputs.append((path, path.stat()))
+        except FileNotFoundError:
+            continue
+    outputs.sort(key=lambda item: item[1].st_mtime)
+    total = sum(info.st_size for _, info in outputs)
+    for path, info in outputs:
+        if total <= OUTPUT_DIR_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        path.unlink(missing_ok=True)
+        total -= info.st_size
+
+
+def _save_full_output(text: str, directory: Path) -> str:
+    data = text.encode()
+    # named by content, so the same output printed again is stored once
+    relative = f"{OUTPUT_DIR}/output-{hashlib.sha256(data).hexdigest()[:16]}.txt"
+    path = directory / relative
+    if path.exists():
+        os.utime(path)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    _evict_outputs(path.parent, keep=path)
+    return relative
+
+
+def reduce_output(
+    text: str,
+    token_budget: int = OUTPUT_TOKEN_BUDGET,
+    source_limit: int = CODEBOX_MAX_OUTPUT_CHARS,
+    directory: Path = CODEBOX_DIR,
+) -> str:
+    """Return `text` if it fits `token_budget`, otherwise a structural summary of it
+    that points to a file holding the full output, in the kernel working directory
+    `directory`.
+
+    Output of `source_limit` characters or more is taken to have been cut off by
+    codebox already, and the summary says so.
+    """
+    cleaned = _strip_ansi(text)
+    if estimate_tokens(cleaned) <= token_budget:
+        return cleaned
+
+    reduced = _collapse_repeats(cleaned)
+    if estimate_tokens(reduced) > token_budget:
+        for reducer in (_reduce_traceback, _reduce_dataframe, _reduce_structured):
+            if (candidate := reducer(reduced)) is not None:
+                reduced = candidate
+                break
+    reduced = _head_and_tail(reduced, token_budget)
+
+    saved = _save_full_output(cleaned, directory)
+    if len(text) >= source_limit:
+        where = (
+            f" The kernel cut the output off at {source_limit} characters; what it kept"
+            f" is in the file '{saved}'.]"
+        )
+    else:
+        where = f" The full output is in the file '{saved}'.]"
+    return f"{reduced}\n\n[Output reduced from ~{estimate_tokens(cleaned)} tokens.{where}"
+
+
+__all__ = ("CODEBOX_MAX_OUTPUT_CHARS", "reduce_output")
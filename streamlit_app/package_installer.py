@@ -0,0 +1,378 @@
+"""Installs the packages generated code imports before it runs.
+
+The imports each snippet is certain to run are found statically, mapped from
+module names to distribution names, and any missing ones are installed (batched
+into one pip run) while the kernel is being leased. Imports that may never run,
+such as fallbacks in `try`/`except ImportError` or imports inside functions, are
+left to the kernel: only if one fails is its package installed. Kernels run with
+the app's interpreter, so installing into it is enough: the kernel only needs its
+import caches invalidated, not a restart, and keeps its variables.
+
+Module names come from code the model wrote, so they are never trusted as
+distribution names to fetch from the network. Packages are installed from the
+wheels in `CODEBOX_WHEEL_CACHE` (e.g. made with `pip wheel -w <dir> <packages>`
+or `pip download -d <dir> <packages>`), without network access. Installing from
+the package index has to be turned on with `CODEBOX_INSTALL_FROM_INDEX`, and is
+then limited to the distributions in `MODULE_DISTRIBUTIONS` and
+`CODEBOX_INSTALL_ALLOWLIST`. Anything else is left for the kernel to fail on.
+"""
+
+from __future__ import annotations
+
+import ast
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+
+from kernel_pool import KERNEL_HELPERS_DIR, KERNEL_HOME
+from preflight import to_python
+
+CODEBOX_AUTO_INSTALL = os.environ.get("CODEBOX_AUTO_INSTALL", "1") not in ("0", "false", "")
+CODEBOX_WHEEL_CACHE = os.environ.get("CODEBOX_WHEEL_CACHE")
+CODEBOX_INSTALL_FROM_INDEX = os.environ.get("CODEBOX_INSTALL_FROM_INDEX", "0") not in ("0", "false", "")
+# Comma-separated distributions that may also be installed from the package index
+CODEBOX_INSTALL_ALLOWLIST = {
+    name.strip().lower()
+    for name in os.environ.get("CODEBOX_INSTALL_ALLOWLIST", "").split(",")
+    if name.strip()
+}
+CODEBOX_INSTALL_TIMEOUT = float(os.environ.get("CODEBOX_INSTALL_TIMEOUT", 300))
+
+# Run in the kernel after installing, so that it finds the new packages
+INVALIDATE_IMPORT_CACHES_CODE = "import importlib as _importlib; _importlib.invalidate_caches(); del _importlib"
+
+# Import names that differ from the name of the distribution providing them
+MODULE_DISTRIBUTIONS = {
+    "Bio": "biopython",
+    "bs4": "beautifulsoup4",
+    "Crypto": "pycryptodome",
+    "cv2": "opencv-python",
+    "dateutil": "python-dateutil",
+    "docx": "python-docx",
+    "dotenv": "python-dotenv",
+    "fitz": "pymupdf",
+    "jose": "python-jose",
+    "magic": "python-magic",
+    "mp_api": "mp-api",
+    "OpenSSL": "pyopenssl",
+    "PIL": "pillow",
+    "pptx": "python-pptx",
+    "serial": "pyserial",
+    "skimage": "scikit-image",
+    "sklearn": "scikit-learn",
+    "yaml": "pyyaml",
+}
+
+
+def _unguarded_statements(body: list[ast.stmt]) -> list[ast.stmt]:
+    """The statements that run whenever `body` does: not those in function or
+    class bodies, branches, loops, or `try` blocks with handlers.
+    """
+    statements = []
+    for node in body:
+        if isinstance(node, (ast.With, ast.AsyncWith)):
+            statements += _unguarded_statements(node.body)
+        elif isinstance(node, ast.Try) and not node.handlers:
+            statements += _unguarded_statements(node.body) + _unguarded_statements(node.finalbody)
+        elif not isinstance(
+            node,
+            (
+                ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.If, ast.For,
+                ast.AsyncFor, ast.While, ast.Try, ast.Match,
+                # `try`/`except*`, Python 3.11+
+                getattr(ast, "TryStar", ast.Try),
+            ),
+        ):
+            statements.append(node)
+    return statements
+
+
+def imported_modules(code: str) -> set[str]:
+    """The top-level modules `code` is certain to import when it runs, including
+    `importlib.import_module` and `__import__` calls with a literal name.
+    """
+    python = to_python(code)
+    if python is None:
+        python = "\n".join(line for line in code.splitlines() if not line.lstrip().startswith(("%", "!")))
+    try:
+        tree = ast.parse(python)
+    except SyntaxError:
+        return set()
+    modules = set()
+    nodes = (
+        node
+        for statement in _unguarded_statements(tree.body)
+        for node in ast.walk(statement)
+    )
+    for node in nodes:
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module.split(".")[0])
+        elif (
+            isinstance(node, ast.Call)
+            and (
+                (isinstance(node.func, ast.Name) and node.func.id == "__import__")
+                or (isinstance(node.func, ast.Attribute) and node.func.attr == "import_module")
+            )
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)
+        ):
+            modules.add(node.args[0].value.split(".")[0])
+    return modules
+
+
+def imports_first(code: str, module: str) -> bool:
+    """Whether `code` imports `module` before doing anything but other imports,
+    so that running it again after a failed import of `module` repeats nothing.
+    """
+    python = to_python(code)
+    try:
+        tree = ast.parse(python) if python is not None else None
+    except SyntaxError:
+        tree = None
+    if tree is None:
+        return False
+    for statement in tree.body:
+        if isinstance(statement, ast.Import):
+            names = [alias.name for alias in statement.names]
+        elif isinstance(statement, ast.ImportFrom) and statement.level == 0 and statement.module:
+            names = [statement.module]
+        else:
+            return False
+        if module in (name.split(".")[0] for name in names):
+            return True
+    return False
+
+
+def _wheel_modules(wheel: Path) -> set[str]:
+    """The top-level modules a wheel provides."""
+    with zipfile.ZipFile(wheel) as archive:
+        names = archive.namelist()
+        for name in names:
+            if name.endswith(".dist-info/top_level.txt"):
+                return set(archive.read(name).decode().split())
+    modules = set()
+    for name in names:
+        top = name.split("/")[0]
+        if top.endswith((".dist-info", ".data")):
+            continue
+        modules.add(top.split(".")[0] if top.endswith((".py", ".so", ".pyd")) else top)
+    return modules
+
+
+class PackageInstaller:
+    """Installs missing distributions into the kernels' environment, one pip
+    resolution at a time; concurrent requests for a distribution that is already
+    being installed wait for that install.
+
+    Parameters
+    ----------
+    wheel_cache
+        A directory of wheels to install from without network access.
+    from_index
+        Whether to install the distributions in `allowlist` from the index pip is
+        configured with, when the wheel cache doesn't have them.
+    allowlist
+        The distributions that may be installed from the index; by default those
+        in `MODULE_DISTRIBUTIONS` and `CODEBOX_INSTALL_ALLOWLIST`.
+    timeout
+        How long to let pip run, in seconds.
+
+    """
+
+    _instance: PackageInstaller | None = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        wheel_cache: str | Path | None = CODEBOX_WHEEL_CACHE,
+        from_index: bool = CODEBOX_INSTALL_FROM_INDEX,
+        allowlist: set[str] | None = None,
+        timeout: float = CODEBOX_INSTALL_TIMEOUT,
+    ):
+        self.wheel_cache = Path(wheel_cache) if wheel_cache else None
+        self.from_index = from_index
+        if allowlist is None:
+            allowlist = {name.lower() for name in MODULE_DISTRIBUTIONS.values()} | CODEBOX_INSTALL_ALLOWLIST
+        self.allowlist = allowlist
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="package-installer")
+        self._lock = threading.Lock()
+        # pip must not run twice at once against the same environment
+        self._pip_lock = threading.Lock()
+        self._pending: dict[str, Future[str | None]] = {}
+        self._failed: dict[str, str] = {}
+        self._wheel_index: dict[str, str] = {}
+        self._wheel_index_mtime: float | None = None
+
+    @classmethod
+    def instance(cls) -> PackageInstaller:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def wheel_index(self) -> dict[str, str]:
+        """Top-level module -> distribution name, for the wheels in the cache."""
+        if self.wheel_cache is None or not self.wheel_cache.is_dir():
+            return {}
+        mtime = self.wheel_cache.stat().st_mtime
+        if mtime != self._wheel_index_mtime:
+            index = {}
+            for wheel in sorted(self.wheel_cache.glob("*.whl")):
+                distribution = wheel.name.split("-")[0].replace("_", "-").lower()
+                try:
+                    modules = _wheel_modules(wheel)
+                except (OSError, zipfile.BadZipFile):
+                    continue
+                for module in modules:
+                    index.setdefault(module, distribution)
+            self._wheel_index, self._wheel_index_mtime = index, mtime
+        return self._wheel_index
+
+    def distribution(self, module: str) -> str | None:
+        """The name of the distribution to install for a top-level module, or
+        None if it may not be installed.
+        """
+        if distribution := self.wheel_index().get(module):
+            return distribution
+        distribution = MODULE_DISTRIBUTIONS.get(module, module.replace("_", "-")).lower()
+        return distribution if self.from_index and distribution in self.allowlist else None
+
+    @staticmethod
+    def is_available(module: str, workdir: Path = KERNEL_HOME) -> bool:
+        """Whether a kernel working in `workdir` can import `module` without
+        installing anything.
+        """
+        if module in sys.stdlib_module_names or module in sys.builtin_module_names:
+            return True
+        # helper modules and files the code created itself are importable in the kernel
+        for directory in (KERNEL_HELPERS_DIR, workdir):
+            if (directory / f"{module}.py").exists() or (directory / module).is_dir():
+                return True
+        try:
+            return importlib.util.find_spec(module) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def missing(self, code: str, workdir: Path = KERNEL_HOME) -> dict[str, str]:
+        """The modules `code` (run in `workdir`) imports that are not installed but
+        may be, with the distributions to install for them.
+        """
+        importlib.invalidate_caches()
+        missing = {}
+        for module in sorted(imported_modules(code)):
+            if not self.is_available(module, workdir) and (distribution := self.distribution(module)):
+                missing[module] = distribution
+        return missing
+
+    def install(self, distributions: list[str]) -> dict[str, Future[str | None]]:
+        """Start installing the distributions that are not already being
+        installed; each future gives None on success, or pip's error.
+        """
+        futures = {}
+        todo = []
+        with self._lock:
+            for distribution in dict.fromkeys(distributions):
+                if distribution in self._failed:
+                    # don't retry (and wait for) a failed install on every call
+                    future: Future[str | None] = Future()
+                    future.set_result(self._failed[distribution])
+                elif (future := self._pending.get(distribution)) is None:
+                    future = Future()
+                    self._pending[distribution] = future
+                    todo.append(distribution)
+                futures[distribution] = future
+        if todo:
+            self._executor.submit(self._pip_install, todo)
+        return futures
+
+    def _pip(self, distributions: list[str]) -> str | None:
+        command = [sys.executable, "-m", "pip", "install", "--quiet", "--disable-pip-version-check"]
+        if self.wheel_cache is not None:
+            command += ["--find-links", str(self.wheel_cache)]
+        if not self.from_index:
+            command.append("--no-index")
+        try:
+            process = subprocess.run(
+                command + distributions, capture_output=True, text=True, timeout=self.timeout
+            )
+        except (OSError, subprocess.TimeoutExpired) as exc:
+            return str(exc)
+        if process.returncode:
+            return process.stderr.strip()[-500:] or "pip failed"
+        return None
+
+    def _pip_install(self, distributions: list[str]) -> None:
+        start = time.perf_counter()
+        with self._pip_lock:
+            error = self._pip(distributions)
+            if error is not None and len(distributions) > 1:
+                # one unavailable distribution fails the whole resolution; try the rest alone
+                errors = {distribution: self._pip([distribution]) for distribution in distributions}
+            else:
+                errors = dict.fromkeys(distributions, error)
+        print(f"pip install {distributions} took {time.perf_counter() - start:.1f} s; errors: {errors}")
+        with self._lock:
+            for distribution, error in errors.items():
+                if error is not None:
+                    self._failed[distribution] = error
+                self._pending.pop(distribution).set_result(error)
+
+    def prepare(self, code: str, workdir: Path = KERNEL_HOME) -> dict[str, Future[str | None]]:
+        """Start installing whatever `code` (run in `workdir`) needs; wait for the
+        futures before running it.
+        """
+        missing = self.missing(code, workdir)
+        if not missing:
+            return {}
+        print(f"Installing missing packages {sorted(set(missing.values()))} for modules {sorted(missing)}")
+        return self.install(list(missing.values()))
+
+    def wait(self, futures: dict[str, Future[str | None]]) -> tuple[list[str], dict[str, str]]:
+        """Wait for installs; returns the installed distributions and the errors
+        of those that failed.
+        """
+        installed = []
+        errors = {}
+        deadline = time.monotonic() + self.timeout
+        for distribution, future in futures.items():
+            try:
+                error = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                error = "timed out"
+            if error is None:
+                installed.append(distribution)
+            else:
+                errors[distribution] = error
+        if installed:
+            importlib.invalidate_caches()
+        return installed, errors
+
+
+def missing_module(error: str) -> str | None:
+    """The module named by a `ModuleNotFoundError` traceback."""
+    if match := re.search(r"ModuleNotFoundError: No module named '([^']+)'", error):
+        return match.group(1).split(".")[0]
+    return None
+
+
+__all__ = (
+    "CODEBOX_AUTO_INSTALL",
+    "CODEBOX_INSTALL_FROM_INDEX",
+    "INVALIDATE_IMPORT_CACHES_CODE",
+    "PackageInstaller",
+    "imported_modules",
+    "imports_first",
+    "missing_module",
+)
@@ -0,0 +1,116 @@
+"""Where the time of each answer went: latency percentiles across sessions and a
+waterfall of the spans of any recent turn.
+"""
+
+from datetime import datetime
+
+import altair as alt
+import pandas as pd
+import streamlit as st
+
+from tools import current_session_id
+from tracing import Span, Tracer, percentile
+
+st.title("Diagnostics")
+
+tracer = Tracer.instance()
+if not tracer.enabled:
+    st.info("Tracing is disabled; set `TRACING=1` to record turns.")
+    st.stop()
+
+spans = tracer.spans()
+if st.toggle("Only this session", value=False):
+    session_id = current_session_id()
+    spans = [span for span in spans if span.session_id == session_id]
+if not spans:
+    st.caption("No turns recorded yet.")
+    st.stop()
+
+st.header("Latency")
+durations: dict[str, list[float]] = {}
+for span in spans:
+    durations.setdefault(span.name, []).append(span.duration)
+st.dataframe(
+    pd.DataFrame(
+        [
+            {
+                "span": name,
+                "count": len(values),
+                "p50 (s)": percentile(values, 50),
+                "p95 (s)": percentile(values, 95),
+                "max (s)": max(values),
+                "total (s)": sum(values),
+            }
+            for name, values in sorted(durations.items())
+        ]
+    ),
+    hide_index=True,
+    use_container_width=True,
+)
+
+st.header("Turns")
+traces: dict[str, list[Span]] = {}
+for span in sorted(spans, key=lambda span: span.start):
+    traces.setdefault(span.trace_id, []).append(span)
+turns = {
+    trace_id: trace
+    for trace_id, trace in reversed(traces.items())
+    if any(span.name == "turn" and span.parent_id is None for span in trace)
+}
+if not turns:
+    st.caption("No complete turns recorded yet.")
+    st.stop()
+
+
+def _turn_label(trace_id: str) -> str:
+    turn = next(span for span in turns[trace_id] if span.name == "turn")
+    started = datetime.fromtimestamp(turn.start).strftime("%H:%M:%S")
+    return (
+        f"{started} · {turn.duration:.1f} s · {turn.attributes.get('model', '')}"
+        f" · session {(turn.session_id or '')[:8]} · {turn.status}"
+    )
+
+
+trace_id = st.selectbox("Turn", list(turns), format_func=_turn_label)
+trace = turns[trace_id]
+turn = next(span for span in trace if span.name == "turn")
+
+by_id = {span.span_id: span for span in trace}
+
+
+def _depth(span: Span) -> int:
+    depth = 0
+    while span.parent_id in by_id:
+        span = by_id[span.parent_id]
+        depth += 1
+    return depth
+
+
+rows = [
+    {
+        "span": f"{idx:02d} {'  ' * _depth(span)}{span.name}",
+        "name": span.name,
+        "start (s)": span.start - turn.start,
+        "end (s)": (span.end or span.start) - turn.start,
+        "duration (s)": span.duration,
+        "status": span.status,
+        **{key: str(value) for key, value in span.attributes.items()},
+    }
+    for idx, span in enumerate(trace)
+]
+waterfall = pd.DataFrame(rows)
+st.altair_chart(
+    alt.Chart(waterfall)
+    .mark_bar()
+    .encode(
+        x=alt.X("start (s):Q", title="seconds since the question"),
+        x2="end (s):Q",
+        y=alt.Y("span:N", sort=None, title=None),
+        color=alt.Color("name:N", title=None),
+        tooltip=list(waterfall.columns),
+    ),
+    use_container_width=True,
+)
+
+st.json(turn.attributes)
+st.dataframe(waterfall.drop(columns=["name"]), hide_index=True, use_container_width=True)
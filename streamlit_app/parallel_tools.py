@@ -0,0 +1,266 @@
+"""Runs the independent tool calls of one agent step at the same time.
+
+Models often answer with several tool calls at once, e.g. one per sample to
+fetch. `AgentExecutor` runs them one after another (or, asynchronously, all at
+once, only to queue them on the session's single kernel). `ParallelAgentExecutor`
+plans each step instead:
+
+- the first code run, every run that reads what the session's kernel (or an
+  earlier run of the step) defines, and every run that defines names (which
+  later steps may read), run in order on the session's kernel;
+- self-contained runs that only print or plot go to clean kernels borrowed from
+  the scheduler, while it has some to spare (otherwise they join the session's
+  kernel too);
+- other tools, such as documentation look-ups, run alongside.
+
+At most `PARALLEL_TOOL_MAX_CONCURRENCY` calls run at once, and the results are
+handed back in the order the model asked for them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from typing import Any, AsyncIterator, Iterator, Sequence
+
+from codeboxapi import CodeBox
+from codeboxapi.box.localbox import LocalBox
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+
+from kernel_scheduler import KernelScheduler
+from preflight import bound_names, free_names, preflight
+from tools import SCRATCH_KERNEL, local_codebox_tool
+
+PARALLEL_TOOL_CALLS = os.environ.get("PARALLEL_TOOL_CALLS", "0") not in ("0", "false", "")
+# Tool calls of one step that may run at once, the session's kernel included
+PARALLEL_TOOL_MAX_CONCURRENCY = int(os.environ.get("PARALLEL_TOOL_MAX_CONCURRENCY", 3))
+
+# While set, `AgentExecutor` only collects a step's tool calls; they are run
+# once the whole step is known
+_DEFERRED: ContextVar[bool] = ContextVar("parallel_tools_deferred", default=False)
+_PENDING = object()
+
+
+def _code(action: AgentAction) -> str | None:
+    if action.tool != local_codebox_tool.name:
+        return None
+    tool_input = action.tool_input
+    code = tool_input.get("code") if isinstance(tool_input, dict) else tool_input
+    return code if isinstance(code, str) else None
+
+
+def plan_step(actions: Sequence[AgentAction], kernel_names: set[str] | None) -> list[str]:
+    """Where each tool call of a step runs: "session" (in order, on the session's
+    kernel), "scratch" (on a clean kernel of its own) or "free" (not code).
+
+    Parameters
+    ----------
+    actions
+        The tool calls, in the order the model made them.
+    kernel_names
+        The names a clean kernel defines (by its warm-up code); None if unknown.
+
+    """
+    placements = []
+    for action in actions:
+        if (code := _code(action)) is None:
+            placements.append("free")
+            continue
+        code = preflight(code).code
+        reads, defines = free_names(code), bound_names(code)
+        self_contained = reads is not None and kernel_names is not None and reads <= kernel_names
+        # a scratch kernel is reset afterwards, so whatever a run defines there
+        # would be missing from the session's kernel, in this step or the next
+        placements.append(
+            "scratch" if "session" in placements and self_contained and defines == set() else "session"
+        )
+    return placements
+
+
+def _is_pending(output: Any) -> bool:
+    return isinstance(output, AgentStep) and output.observation is _PENDING
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """An `AgentExecutor` that runs the independent tool calls of each step
+    concurrently, on kernels borrowed from the `KernelScheduler`.
+    """
+
+    max_concurrency: int = PARALLEL_TOOL_MAX_CONCURRENCY
+
+    def _plan(
+        self, actions: Sequence[AgentAction]
+    ) -> tuple[list[str], dict[int, LocalBox | CodeBox]]:
+        """Plan a step and borrow the kernels for its scratch runs; runs that
+        can't get one go to the session's kernel instead.
+        """
+        scheduler = KernelScheduler.instance()
+        placements = plan_step(actions, bound_names(scheduler.pool.warmup_code))
+        boxes: dict[int, LocalBox | CodeBox] = {}
+        for idx, placement in enumerate(placements):
+            if placement != "scratch":
+                continue
+            # one of the slots is the session's kernel
+            if len(boxes) + 1 >= self.max_concurrency or (box := scheduler.borrow()) is None:
+                placements[idx] = "session"
+                continue
+            boxes[idx] = box
+        if len(actions) > 1:
+            print(f"Tool calls of this step run on: {', '.join(placements)}")
+        return placements, boxes
+
+    def _perform_agent_action(
+        self,
+        name_to_tool_map: dict[str, Any],
+        color_mapping: dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Any = None,
+    ) -> AgentStep:
+        if _DEFERRED.get():
+            return AgentStep(action=agent_action, observation=_PENDING)
+        return super()._perform_agent_action(
+            name_to_tool_map, color_mapping, agent_action, run_manager
+        )
+
+    async def _aperform_agent_action(
+        self,
+        name_to_tool_map: dict[str, Any],
+        color_mapping: dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Any = None,
+    ) -> AgentStep:
+        if _DEFERRED.get():
+            return AgentStep(action=agent_action, observation=_PENDING)
+        return await super()._aperform_agent_action(
+            name_to_tool_map, color_mapping, agent_action, run_manager
+        )
+
+    def _iter_next_step(
+        self,
+        name_to_tool_map: dict[str, Any],
+        color_mapping: dict[str, str],
+        inputs: dict[str, str],
+        intermediate_steps: list[tuple[AgentAction, str]],
+        run_manager: Any = None,
+    ) -> Iterator[AgentFinish | AgentAction | AgentStep]:
+        token = _DEFERRED.set(True)
+        try:
+            outputs = list(
+                super()._iter_next_step(
+                    name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+                )
+            )
+        finally:
+            _DEFERRED.reset(token)
+        actions = [output.action for output in outputs if _is_pending(output)]
+        steps = iter(self._run_step(actions, name_to_tool_map, color_mapping, run_manager))
+        for output in outputs:
+            yield next(steps) if _is_pending(output) else output
+
+    async def _aiter_next_step(
+        self,
+        name_to_tool_map: dict[str, Any],
+        color_mapping: dict[str, str],
+        inputs: dict[str, str],
+        intermediate_steps: list[tuple[AgentAction, str]],
+        run_manager: Any = None,
+    ) -> AsyncIterator[AgentFinish | AgentAction | AgentStep]:
+        token = _DEFERRED.set(True)
+        try:
+            outputs = [
+                output
+                async for output in super()._aiter_next_step(
+                    name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+                )
+            ]
+        finally:
+            _DEFERRED.reset(token)
+        actions = [output.action for output in outputs if _is_pending(output)]
+        steps = iter(await self._arun_step(actions, name_to_tool_map, color_mapping, run_manager))
+        for output in outputs:
+            yield next(steps) if _is_pending(output) else output
+
+    def _run_step(
+        self,
+        actions: list[AgentAction],
+        name_to_tool_map: dict[str, Any],
+        color_mapping: dict[str, str],
+        run_manager: Any,
+    ) -> list[AgentStep]:
+        if not actions:
+            return []
+        placements, boxes = self._plan(actions)
+        scheduler = KernelScheduler.instance()
+        results: list[AgentStep | None] = [None] * len(actions)
+
+        def perform(idx: int) -> None:
+            token = SCRATCH_KERNEL.set(boxes.get(idx))
+            try:
+                results[idx] = super(ParallelAgentExecutor, self)._perform_agent_action(
+                    name_to_tool_map, color_mapping, actions[idx], run_manager
+                )
+            finally:
+                SCRATCH_KERNEL.reset(token)
+                if idx in boxes:
+                    scheduler.give_back(boxes[idx])
+
+        def perform_in_order(indices: list[int]) -> None:
+            for idx in indices:
+                perform(idx)
+
+        session = [idx for idx, placement in enumerate(placements) if placement == "session"]
+        others = [idx for idx, placement in enumerate(placements) if placement != "session"]
+        with ThreadPoolExecutor(max_workers=max(self.max_concurrency, 1)) as pool:
+            # each call gets its own copy of the context (e.g. `SESSION_ID`)
+            futures = [pool.submit(copy_context().run, perform_in_order, session)]
+            futures += [pool.submit(copy_context().run, perform, idx) for idx in others]
+            for future in futures:
+                future.result()
+        return results  # type: ignore[return-value]
+
+    async def _arun_step(
+        self,
+        actions: list[AgentAction],
+        name_to_tool_map: dict[str, Any],
+        color_mapping: dict[str, str],
+        run_manager: Any,
+    ) -> list[AgentStep]:
+        if not actions:
+            return []
+        placements, boxes = self._plan(actions)
+        scheduler = KernelScheduler.instance()
+        slots = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        async def perform(idx: int) -> AgentStep:
+            # runs as its own task, so setting the kernel only affects this call
+            SCRATCH_KERNEL.set(boxes.get(idx))
+            try:
+                async with slots:
+                    return await super(ParallelAgentExecutor, self)._aperform_agent_action(
+                        name_to_tool_map, color_mapping, actions[idx], run_manager
+                    )
+            finally:
+                if idx in boxes:
+                    await asyncio.to_thread(scheduler.give_back, boxes[idx])
+
+        async def perform_in_order(indices: list[int]) -> list[AgentStep]:
+            return [await perform(idx) for idx in indices]
+
+        session = [idx for idx, placement in enumerate(placements) if placement == "session"]
+        others = [idx for idx, placement in enumerate(placements) if placement != "session"]
+        session_steps, *other_steps = await asyncio.gather(
+            perform_in_order(session), *(perform(idx) for idx in others)
+        )
+        results = dict(zip(session, session_steps)) | dict(zip(others, other_steps))
+        return [results[idx] for idx in range(len(actions))]
+
+
+__all__ = (
+    "PARALLEL_TOOL_CALLS",
+    "PARALLEL_TOOL_MAX_CONCURRENCY",
+    "ParallelAgentExecutor",
+    "plan_step",
+)
@@ -0,0 +1,71 @@
+"""Content-addressed storage for the plots code produces.
+
+Each `image/png` output is decoded once and written to the session's working
+directory under a name derived from its SHA-256 digest, so re-plotting the same
+figure reuses the file, and the kernel can open it by name. A compressed, size-capped preview is made
+next to it (in a hidden directory, so that the file browser doesn't list it) and
+is all the chat shows; the full-resolution file is only read when downloaded
+from the file browser. Tool results carry the plot's file name, not its bytes.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import os
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
+
+from PIL import Image
+
+from file_browser import CODEBOX_DIR
+
+PLOT_PREVIEW_DIR = CODEBOX_DIR / ".previews"
+# Longest side of the previews shown in the chat
+PLOT_PREVIEW_MAX_SIDE = int(os.environ.get("PLOT_PREVIEW_MAX_SIDE", 800))
+PLOT_PREVIEW_QUALITY = int(os.environ.get("PLOT_PREVIEW_QUALITY", 80))
+
+
+def _write(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique, as parallel runs may save the same plot at the same time
+    tmp = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+def preview_path(name: str) -> Path:
+    return PLOT_PREVIEW_DIR / f"{Path(name).stem}.webp"
+
+
+def save_plot(b64_png: str, directory: Path = CODEBOX_DIR) -> str:
+    """Store a base64-encoded PNG output in `directory` unless the same plot is
+    already stored there, and make its preview; returns the plot's file name.
+    """
+    data = base64.b64decode(b64_png)
+    name = f"plot-{hashlib.sha256(data).hexdigest()[:16]}.png"
+    path = directory / name
+    if not path.exists():
+        _write(path, data)
+    preview = preview_path(name)
+    if not preview.exists():
+        with Image.open(BytesIO(data)) as image:
+            image.thumbnail((PLOT_PREVIEW_MAX_SIDE, PLOT_PREVIEW_MAX_SIDE))
+            buffer = BytesIO()
+            image.save(buffer, format="WEBP", quality=PLOT_PREVIEW_QUALITY, method=4)
+        _write(preview, buffer.getvalue())
+    return name
+
+
+def plot_preview(name: str, directory: Path = CODEBOX_DIR) -> Path | None:
+    """The file to show for a plot saved in `directory`: its preview, or the plot
+    itself if the preview is gone; None if neither exists any more.
+    """
+    for path in (preview_path(name), directory / name):
+        if path.exists():
+            return path
+    return None
+
+
+__all__ = ("plot_preview", "save_plot")
@@ -0,0 +1,294 @@
+"""Checks generated code locally before it is sent to a kernel.
+
+Code that cannot run (a syntax error, or a name that was never defined in the
+session) is rejected with a short diagnostic instead of a kernel round trip, and
+common escaping mistakes in the single-line code the tool asks for (literal `\\n`
+sequences, leading newlines or indentation) are repaired.
+
+The names defined in each kernel are tracked statically from the code that ran
+in it, so the undefined-name check is skipped whenever they can't be known (star
+imports, `exec`, `%run`...).
+"""
+
+from __future__ import annotations
+
+import ast
+import builtins
+import difflib
+import os
+import re
+import textwrap
+from dataclasses import dataclass, field
+
+CODEBOX_PREFLIGHT = os.environ.get("CODEBOX_PREFLIGHT", "1") not in ("0", "false", "")
+
+# Defined by IPython in every kernel
+IPYTHON_NAMES = {
+    "get_ipython", "display", "exit", "quit", "In", "Out",
+    "_", "__", "___", "_i", "_ii", "_iii", "_ih", "_oh", "_dh",
+}
+MODULE_NAMES = {"__name__", "__doc__", "__builtins__", "__spec__", "__loader__", "__package__"}
+_IPYTHON_HISTORY_NAME = re.compile(r"_i?\d+$")
+
+# Calls after which the kernel namespace can't be known statically
+DYNAMIC_NAMESPACE_CALLS = {"exec", "eval", "globals", "locals", "vars"}
+DYNAMIC_NAMESPACE_MAGICS = re.compile(r"run_(line|cell)_magic\(\s*['\"](run|store|load|load_ext|macro)['\"]")
+
+try:
+    from IPython.core.inputtransformer2 import TransformerManager
+except ImportError:
+    TransformerManager = None
+
+
+@dataclass
+class PreflightResult:
+    # the code to run, after any repairs
+    code: str
+    repairs: list[str] = field(default_factory=list)
+    # a compact diagnostic for the model if the code should not be run
+    error: str | None = None
+
+
+def to_python(code: str) -> str | None:
+    """The plain Python IPython would run for `code` (magics and shell escapes
+    become function calls); None if magics are used but IPython is unavailable.
+    """
+    if TransformerManager is not None:
+        return TransformerManager().transform_cell(code)
+    if re.search(r"^\s*[%!]", code, re.MULTILINE):
+        return None
+    return code
+
+
+def _parse(code: str) -> ast.Module:
+    return compile(
+        code, "<cell>", "exec", flags=ast.PyCF_ONLY_AST | ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+    )
+
+
+def unescape_newlines(code: str) -> str:
+    """Replace literal `\\n` (and `\\t`) sequences outside of string literals, where
+    they can only be escaping mistakes, by real newlines (and tabs).
+    """
+    out = []
+    i = 0
+    quote = None
+    while i < len(code):
+        char = code[i]
+        if quote is not None:
+            if char == "\\":
+                out.append(code[i : i + 2])
+                i += 2
+                continue
+            if code.startswith(quote, i):
+                out.append(quote)
+                i += len(quote)
+                quote = None
+                continue
+            if char == "\n" and len(quote) == 1:
+                # unterminated single-quoted string; let the compiler report it
+                quote = None
+            out.append(char)
+            i += 1
+            continue
+        if char == "#":
+            # a comment runs up to the next (real or escaped) newline
+            end = min(
+                (pos for pos in (code.find("\n", i), code.find("\\n", i)) if pos != -1),
+                default=len(code),
+            )
+            out.append(code[i:end])
+            i = end
+            continue
+        if code.startswith(("\\n", "\\t"), i):
+            out.append("\n" if code[i + 1] == "n" else "\t")
+            i += 2
+            continue
+        if char in "'\"":
+            quote = code[i : i + 3] if code.startswith(char * 3, i) else char
+            out.append(quote)
+            i += len(quote)
+            continue
+        out.append(char)
+        i += 1
+    return "".join(out)
+
+
+def _syntax_error(exc: SyntaxError) -> str:
+    lines = [f"SyntaxError: {exc.msg} (line {exc.lineno})"]
+    if exc.text:
+        text = exc.text.rstrip("\n")
+        stripped = text.lstrip()
+        lines.append(f"    {stripped}")
+        if exc.offset:
+            lines.append("    " + " " * max(exc.offset - 1 - (len(text) - len(stripped)), 0) + "^")
+    return "\n".join(lines)
+
+
+def _is_dynamic(tree: ast.AST, python: str) -> bool:
+    if DYNAMIC_NAMESPACE_MAGICS.search(python):
+        return True
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and any(alias.name == "*" for alias in node.names):
+            return True
+        if isinstance(node, ast.Call):
+            name = node.func.id if isinstance(node.func, ast.Name) else None
+            if name in DYNAMIC_NAMESPACE_CALLS:
+                return True
+    return False
+
+
+def _bound_names(tree: ast.AST) -> set[str]:
+    """Every name bound anywhere in the code, in any scope."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+    return names
+
+
+def bound_names(code: str) -> set[str] | None:
+    """The names `code` may define in the kernel namespace; None if they can't be
+    determined statically.
+    """
+    python = to_python(code)
+    if python is None:
+        return None
+    try:
+        tree = _parse(python)
+    except SyntaxError:
+        return set()
+    if _is_dynamic(tree, python):
+        return None
+    return _bound_names(tree)
+
+
+def free_names(code: str) -> set[str] | None:
+    """The names `code` reads without defining them, i.e. that the kernel must
+    already have; None if they can't be determined statically.
+    """
+    python = to_python(code)
+    if python is None:
+        return None
+    try:
+        tree = _parse(python)
+    except SyntaxError:
+        return None
+    if _is_dynamic(tree, python):
+        return None
+    return {node.id for node in _undefined_names(tree, set())}
+
+
+def _catches_name_error(tree: ast.AST) -> bool:
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ExceptHandler):
+            if node.type is None:
+                return True
+            types = node.type.elts if isinstance(node.type, ast.Tuple) else [node.type]
+            if any(isinstance(t, ast.Name) and t.id in ("NameError", "Exception", "BaseException") for t in types):
+                return True
+    return False
+
+
+def _undefined_names(tree: ast.AST, known: set[str]) -> list[ast.Name]:
+    defined = known | _bound_names(tree) | IPYTHON_NAMES | MODULE_NAMES | set(dir(builtins))
+    undefined = {}
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Name)
+            and isinstance(node.ctx, ast.Load)
+            and node.id not in defined
+            and not _IPYTHON_HISTORY_NAME.match(node.id)
+        ):
+            undefined.setdefault(node.id, node)
+    return sorted(undefined.values(), key=lambda node: (node.lineno, node.col_offset))
+
+
+def _name_error(undefined: list[ast.Name], known: set[str]) -> str:
+    lines = []
+    for node in undefined:
+        line = f"NameError: name {node.id!r} is not defined (line {node.lineno})"
+        if matches := difflib.get_close_matches(node.id, known, n=3):
+            line += f"; did you mean {', '.join(repr(match) for match in matches)}?"
+        lines.append(line)
+    names = sorted(name for name in known if not name.startswith("_"))
+    if names:
+        shown = ", ".join(names[:30]) + (", ..." if len(names) > 30 else "")
+        lines.append(f"Names defined in the kernel so far: {shown}")
+    else:
+        lines.append("Nothing has been defined in the kernel yet.")
+    return "\n".join(lines)
+
+
+def preflight(code: str, known_names: set[str] | None = None) -> PreflightResult:
+    """Check (and, if possible, repair) code before running it.
+
+    Parameters
+    ----------
+    code
+        The code the model wants to run.
+    known_names
+        The names defined in the kernel it will run in; None to skip the
+        undefined-name check.
+
+    """
+    result = PreflightResult(code=code)
+
+    stripped = textwrap.dedent(code.lstrip("\r\n"))
+    if stripped.strip() and stripped != code:
+        result.code = stripped
+        result.repairs.append("removed leading newlines/indentation")
+
+    python = to_python(result.code)
+    if python is None:
+        # magics without IPython to translate them; leave it to the kernel
+        return result
+
+    try:
+        tree = _parse(python)
+        if "\n" not in result.code and "#" in python:
+            # a comment in single-line code would swallow everything after it
+            repaired = unescape_newlines(result.code)
+            if repaired != result.code and (repaired_python := to_python(repaired)) is not None:
+                try:
+                    tree, python = _parse(repaired_python), repaired_python
+                    result.code = repaired
+                    result.repairs.append("replaced literal '\\n' sequences with newlines")
+                except SyntaxError:
+                    pass
+    except SyntaxError as exc:
+        repaired = unescape_newlines(result.code)
+        repaired_python = to_python(repaired) if repaired != result.code else None
+        try:
+            if repaired_python is None:
+                raise exc
+            tree = _parse(repaired_python)
+        except SyntaxError:
+            result.error = (
+                "The code was not run, it does not compile:\n" + _syntax_error(exc)
+            )
+            return result
+        result.code, python = repaired, repaired_python
+        result.repairs.append("replaced literal '\\n' sequences with newlines")
+
+    if known_names is not None and not _is_dynamic(tree, python) and not _catches_name_error(tree):
+        if undefined := _undefined_names(tree, known_names):
+            result.error = "The code was not run:\n" + _name_error(undefined, known_names)
+    return result
+
+
+__all__ = ("CODEBOX_PREFLIGHT", "PreflightResult", "bound_names", "free_names", "preflight")
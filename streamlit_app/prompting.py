@@ -0,0 +1,327 @@
+"""Assembles the system prompt so that providers can cache it, and records how
+much of each request was served from the provider's prompt cache.
+
+The system prompt (with the datalab API docs, or their preamble when the rest is
+retrieved per question) is re-sent on every agent step, so we keep it
+byte-identical across sessions and put anything session-specific after it:
+
+- Anthropic models cache explicitly marked prefixes, which `CachingChatAnthropic`
+  marks on the tool definitions, the static system prompt and the latest message,
+  and streams answers (tool calls included) as they are written.
+- OpenAI models cache long, unchanged prompt prefixes automatically; all we can do
+  is keep the static part first and stable.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator
+
+from langchain.callbacks.base import (  # type: ignore[import-not-found, unused-ignore]
+    BaseCallbackHandler,
+)
+from langchain.schema import LLMResult  # type: ignore[import-not-found, unused-ignore]
+from langchain_anthropic import ChatAnthropic
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import (
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from docs_index import DOCS_RETRIEVAL, DocsIndex, docs_preamble
+
+DATALAB_API_PROMPT: str = (
+    Path(__file__).parent.parent / "prompts" / "datalab-api-prompt.md"
+).read_text()
+
+if DOCS_RETRIEVAL:
+    # the rest is attached to each question as needed (see `docs_index`)
+    DATALAB_API_PROMPT = f"""{docs_preamble()}
+
+The rest of the documentation (client methods, helper modules, item JSON schemas
+and examples) is split into sections. The sections most relevant to each question
+are attached to it; look up any other method or field with the `datalab_docs` tool
+rather than guessing. Sections: {", ".join(DocsIndex.instance().titles())}."""
+
+SYSTEM_PROMPT_TEMPLATE = f"""You are a virtual data management assistant that helps materials chemists
+manage their experimental data and plan experiments.
+You can use a code interpreter tool to assist you (only if needed). If you use the code interpreter,
+DO NOT EXPLAIN THE CODE. Instead, just use the output of the code
+to answer the question the user asked.
+Here is some more info about the datalab API: {DATALAB_API_PROMPT}"""
+
+# Everything before this heading is identical for every session and gets cached;
+# everything after it may differ between sessions.
+SESSION_DETAILS_HEADING = "\n\n## Session details\n\n"
+
+ANTHROPIC_PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+# the SDK sends this for tool use, and a per-request beta header replaces any default
+ANTHROPIC_TOOLS_BETA = "tools-2024-04-04"
+EPHEMERAL_CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def build_system_prompt(datalab_api_url: str, code_api_url: str | None = None) -> str:
+    """The full system prompt for a session: the static, cacheable part followed by
+    the session details.
+
+    Parameters
+    ----------
+    datalab_api_url
+        The datalab instance chosen by the user.
+    code_api_url
+        The URL that code should use to reach `datalab_api_url` instead, if any
+        (e.g. the local caching proxy).
+
+    """
+    static = SYSTEM_PROMPT_TEMPLATE.replace(
+        "{{ DATALAB_API_URL }}", "given in the session details at the end of this prompt"
+    )
+    details = f"The `DATALAB_API_URL` has been chosen by the user to be: {datalab_api_url}."
+    if code_api_url and code_api_url != datalab_api_url:
+        details += (
+            f" In code, always use `DATALAB_API_URL = \"{code_api_url}\"` instead:"
+            f" it is a local caching proxy for {datalab_api_url}."
+            f" Use {datalab_api_url} in any links shown to the user."
+        )
+    return static + SESSION_DETAILS_HEADING + details
+
+
+def _split_system_prompt(system: str) -> list[dict[str, Any]]:
+    static, sep, dynamic = system.partition(SESSION_DETAILS_HEADING)
+    blocks: list[dict[str, Any]] = [
+        {"type": "text", "text": static, "cache_control": EPHEMERAL_CACHE_CONTROL}
+    ]
+    if sep and dynamic.strip():
+        blocks.append({"type": "text", "text": sep.lstrip() + dynamic})
+    return blocks
+
+
+def _mark_last_message(messages: list[dict[str, Any]]) -> None:
+    """Cache the conversation up to the latest message, so that the next step of
+    the tool-calling loop only pays for what was added since.
+    """
+    if not messages:
+        return
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        if content.strip():
+            last["content"] = [
+                {"type": "text", "text": content, "cache_control": EPHEMERAL_CACHE_CONTROL}
+            ]
+        return
+    for block in reversed(content):
+        if isinstance(block, dict) and (block.get("type") != "text" or block.get("text")):
+            block["cache_control"] = EPHEMERAL_CACHE_CONTROL
+            return
+
+
+class CachingChatAnthropic(ChatAnthropic):
+    """`ChatAnthropic` that marks the static prompt prefix as cacheable and keeps
+    the usage (including cache reads/writes) on each returned message.
+    """
+
+    def _format_params(
+        self,
+        *,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        **kwargs: Any,
+    ) -> dict:
+        params = super()._format_params(messages=messages, stop=stop, **kwargs)
+        betas = [ANTHROPIC_PROMPT_CACHING_BETA]
+        if tools := params.get("tools"):
+            betas.insert(0, ANTHROPIC_TOOLS_BETA)
+            # copy so that we never mutate the tools bound to the runnable
+            params["tools"] = [*tools[:-1], {**tools[-1], "cache_control": EPHEMERAL_CACHE_CONTROL}]
+        params["extra_headers"] = {"anthropic-beta": ",".join(betas)}
+        if isinstance(params.get("system"), str):
+            params["system"] = _split_system_prompt(params["system"])
+        _mark_last_message(params["messages"])
+        return params
+
+    def _format_output(self, data: Any, **kwargs: Any) -> ChatResult:
+        result = super()._format_output(data, **kwargs)
+        usage = result.llm_output.get("usage") if result.llm_output else None
+        if usage:
+            for generation in result.generations:
+                generation.message.response_metadata["usage"] = usage
+        return result
+
+    @staticmethod
+    def _event_chunk(event: dict[str, Any], usage: dict[str, Any]) -> ChatGenerationChunk | None:
+        """The chunk for one streamed event, if it carries any content; the token
+        counts reported along the way are collected in `usage`.
+        """
+        kind = event.get("type")
+        if kind == "message_start":
+            usage.update(event["message"].get("usage") or {})
+        elif kind == "message_delta":
+            usage.update(event.get("usage") or {})
+        elif kind == "content_block_start" and event["content_block"].get("type") == "tool_use":
+            block = event["content_block"]
+            # the arguments follow as partial JSON, merged by the block's index
+            tool_call = {"name": block["name"], "id": block["id"], "args": "", "index": event["index"]}
+            return ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[tool_call]))
+        elif kind == "content_block_delta":
+            delta = event["delta"]
+            if delta.get("type") == "text_delta":
+                return ChatGenerationChunk(message=AIMessageChunk(content=delta["text"]))
+            if delta.get("type") == "input_json_delta":
+                tool_call = {"name": None, "id": None, "args": delta["partial_json"], "index": event["index"]}
+                return ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[tool_call]))
+        return None
+
+    @staticmethod
+    def _usage_chunk(usage: dict[str, Any]) -> ChatGenerationChunk:
+        return ChatGenerationChunk(
+            message=AIMessageChunk(content="", response_metadata={"usage": usage})
+        )
+
+    # Upstream only streams without tools (and drops the usage); these stream text
+    # and tool calls alike, from the raw events, and keep the usage.
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        params = self._format_params(messages=messages, stop=stop, **kwargs)
+        client = self._client.beta.tools.messages if params.get("tools") else self._client.messages
+        usage: dict[str, Any] = {}
+        for event in client.create(**params, stream=True):
+            if (chunk := self._event_chunk(event.model_dump(), usage)) is None:
+                continue
+            if run_manager and chunk.message.content:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+        yield self._usage_chunk(usage)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        params = self._format_params(messages=messages, stop=stop, **kwargs)
+        client = (
+            self._async_client.beta.tools.messages
+            if params.get("tools")
+            else self._async_client.messages
+        )
+        usage: dict[str, Any] = {}
+        async for event in await client.create(**params, stream=True):
+            if (chunk := self._event_chunk(event.model_dump(), usage)) is None:
+                continue
+            if run_manager and chunk.message.content:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+        yield self._usage_chunk(usage)
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.streaming:
+            return generate_from_stream(
+                self._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            )
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.streaming:
+            return await agenerate_from_stream(
+                self._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            )
+        return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+@dataclass
+class PromptCacheTurnStats:
+    """Prompt-cache usage summed over every LLM call in one chat turn."""
+
+    started: float = field(default_factory=time.time)
+    calls: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+
+
+def extract_usage(response: LLMResult) -> dict[str, int]:
+    """Normalise the token usage reported by Anthropic and OpenAI models."""
+    usage: dict[str, Any] = {}
+    if response.llm_output:
+        usage = response.llm_output.get("usage") or response.llm_output.get("token_usage") or {}
+    if not usage:
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if isinstance(message, AIMessage) and message.response_metadata.get("usage"):
+                    usage = message.response_metadata["usage"]
+    if "prompt_tokens" in usage:
+        details = usage.get("prompt_tokens_details") or {}
+        return {
+            "input_tokens": usage.get("prompt_tokens") or 0,
+            "output_tokens": usage.get("completion_tokens") or 0,
+            "cached_tokens": details.get("cached_tokens") or 0,
+            "cache_write_tokens": 0,
+        }
+    return {
+        "input_tokens": usage.get("input_tokens") or 0,
+        "output_tokens": usage.get("output_tokens") or 0,
+        "cached_tokens": usage.get("cache_read_input_tokens") or 0,
+        "cache_write_tokens": usage.get("cache_creation_input_tokens") or 0,
+    }
+
+
+class PromptCacheStatsHandler(BaseCallbackHandler):
+    """Collects prompt-cache hits, misses and cached token counts for one turn."""
+
+    def __init__(self) -> None:
+        self.stats = PromptCacheTurnStats()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = extract_usage(response)
+        self.stats.calls += 1
+        if usage["cached_tokens"]:
+            self.stats.cache_hits += 1
+        else:
+            self.stats.cache_misses += 1
+        self.stats.input_tokens += usage["input_tokens"]
+        self.stats.output_tokens += usage["output_tokens"]
+        self.stats.cached_tokens += usage["cached_tokens"]
+        self.stats.cache_write_tokens += usage["cache_write_tokens"]
+        print(f"Prompt cache: {json.dumps(usage)}")
+
+    def as_dict(self) -> dict[str, Any]:
+        return asdict(self.stats)
+
+
+__all__ = (
+    "CachingChatAnthropic",
+    "PromptCacheStatsHandler",
+    "build_system_prompt",
+)
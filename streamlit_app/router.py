@@ -0,0 +1,363 @@
+"""Routes each LLM step of a turn to a fast or a strong model.
+
+Reading a tool result or answering a short question goes to a fast, cheap model;
+planning (long or illustrated questions), and reading the result of repeated
+code failures, go to a strong one. When a provider times out, rate-limits or is
+overloaded, the step is retried with the next candidate, preferring another
+provider. Every decision is logged with its latency, token usage and estimated
+cost, so that the policy can be tuned.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Sequence
+
+import anthropic
+import httpx
+import openai
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import ensure_config
+
+from docs_index import DOCS_BLOCK_HEADING
+from prompting import extract_usage
+from tools import current_session_id
+from tracing import TRACE_DIR, append_lines
+
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "0") not in ("0", "false", "")
+# Questions up to this long (without attachments) are answered by a fast model
+ROUTER_SIMPLE_MAX_CHARS = int(os.environ.get("ROUTER_SIMPLE_MAX_CHARS", 300))
+# Failed code runs in a row after which a strong model takes over
+ROUTER_ESCALATE_AFTER_FAILURES = int(os.environ.get("ROUTER_ESCALATE_AFTER_FAILURES", 2))
+# A step that takes longer than this (in seconds) is retried with another model
+ROUTER_TIMEOUT = float(os.environ.get("ROUTER_TIMEOUT", 120))
+ROUTER_LOG_MAX_ENTRIES = int(os.environ.get("ROUTER_LOG_MAX_ENTRIES", 1000))
+
+# In order of preference within each tier
+FAST_MODELS = ("claude-3-5-haiku-latest", "gpt-3.5-turbo", "o3-mini")
+STRONG_MODELS = ("claude-3-7-sonnet-latest", "gpt-4o")
+
+# USD per million (input, output) tokens; used to estimate the cost of each step
+MODEL_PRICES = {
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-3-5-haiku-latest": (0.80, 4.00),
+    "claude-3-7-sonnet-latest": (3.00, 15.00),
+    "gpt-4o": (2.50, 10.00),
+    "o3-mini": (1.10, 4.40),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+
+# HTTP statuses worth retrying with another provider
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504, 529}
+
+FAILED_RUN = re.compile(r"Traceback \(most recent call last\)|\b\w+(Error|Exception)\b: ")
+
+
+def provider(model_name: str) -> str:
+    return "anthropic" if model_name.startswith("claude") else "openai"
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether another provider might succeed where this call failed."""
+    if isinstance(
+        exc,
+        (
+            TimeoutError,
+            asyncio.TimeoutError,
+            httpx.TimeoutException,
+            anthropic.APITimeoutError,
+            anthropic.APIConnectionError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+        ),
+    ):
+        return True
+    return getattr(exc, "status_code", None) in TRANSIENT_STATUS_CODES
+
+
+def _text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(
+        block.get("text", "") if isinstance(block, dict) else str(block) for block in message.content
+    )
+
+
+def _question(message: BaseMessage) -> str:
+    """The text of a user message, without any documentation attached to it."""
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(
+        block.get("text", "")
+        for block in message.content
+        if isinstance(block, dict)
+        and block.get("type") == "text"
+        and not block.get("text", "").startswith(DOCS_BLOCK_HEADING)
+    )
+
+
+def _has_image(message: BaseMessage) -> bool:
+    return not isinstance(message.content, str) and any(
+        isinstance(block, dict) and block.get("type") == "image_url" for block in message.content
+    )
+
+
+def _failures_in_a_row(messages: Sequence[BaseMessage]) -> int:
+    """Tool results that look like failed runs, counted back from the latest
+    until a successful one or the start of the turn.
+    """
+    failures = 0
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            break
+        if isinstance(message, ToolMessage):
+            if not FAILED_RUN.search(_text(message)):
+                break
+            failures += 1
+    return failures
+
+
+@dataclass
+class RouteDecision:
+    tier: str
+    reason: str
+
+
+def classify_step(
+    messages: Sequence[BaseMessage],
+    simple_max_chars: int = ROUTER_SIMPLE_MAX_CHARS,
+    escalate_after: int = ROUTER_ESCALATE_AFTER_FAILURES,
+) -> RouteDecision:
+    """Which tier of model the next step needs."""
+    if not messages:
+        return RouteDecision("strong", "no messages")
+    last = messages[-1]
+    if isinstance(last, ToolMessage):
+        if (failures := _failures_in_a_row(messages)) >= escalate_after:
+            return RouteDecision("strong", f"{failures} failed runs in a row")
+        return RouteDecision("fast", "reading a tool result")
+    if isinstance(last, HumanMessage):
+        if _has_image(last):
+            return RouteDecision("strong", "question with an image")
+        if len(_question(last)) > simple_max_chars:
+            return RouteDecision("strong", "long question")
+        return RouteDecision("fast", "short question")
+    return RouteDecision("strong", "planning")
+
+
+@dataclass
+class RouteRecord:
+    model: str
+    tier: str
+    reason: str
+    session_id: str
+    started: float = field(default_factory=time.time)
+    latency_s: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost_usd: float = 0.0
+    # models that failed (timed out, were rate-limited...) before `model` answered
+    fell_back_from: list[str] = field(default_factory=list)
+    error: str | None = None
+
+
+class RoutingLog:
+    """The latest routing decisions of every session, also appended to
+    `TRACE_DIR/routes.jsonl` (rotated like the spans).
+    """
+
+    _instance: RoutingLog | None = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_entries: int = ROUTER_LOG_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self._records: deque[RouteRecord] = deque(maxlen=max_entries)
+        self.path = TRACE_DIR / "routes.jsonl"
+
+    @classmethod
+    def instance(cls) -> RoutingLog:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def add(self, record: RouteRecord) -> None:
+        line = json.dumps(asdict(record))
+        print(f"Route: {line}")
+        with self._lock:
+            self._records.append(record)
+            try:
+                append_lines(self.path, [line])
+            except OSError as exc:
+                print(f"Failed to log route: {exc}")
+
+    def records(self) -> list[RouteRecord]:
+        with self._lock:
+            return list(self._records)
+
+    def summary(self) -> dict[str, dict[str, float | int]]:
+        """Calls, failures, mean latency and total cost per model."""
+        summary: dict[str, dict[str, float | int]] = {}
+        for record in self.records():
+            model = summary.setdefault(
+                record.model, {"calls": 0, "errors": 0, "mean_latency_s": 0.0, "cost_usd": 0.0}
+            )
+            model["calls"] += 1
+            model["errors"] += record.error is not None
+            model["mean_latency_s"] += (record.latency_s - model["mean_latency_s"]) / model["calls"]
+            model["cost_usd"] += record.cost_usd
+        return summary
+
+
+def _usage(message: Any) -> dict[str, int]:
+    if not isinstance(message, AIMessage):
+        return {"input_tokens": 0, "output_tokens": 0}
+    return extract_usage(LLMResult(generations=[[ChatGeneration(message=message)]]))
+
+
+def _cost(model_name: str, usage: dict[str, int]) -> float:
+    input_price, output_price = MODEL_PRICES.get(model_name, (0.0, 0.0))
+    return (usage["input_tokens"] * input_price + usage["output_tokens"] * output_price) / 1e6
+
+
+class ModelRouter(Runnable):
+    """A chat model that sends each step to one of several models.
+
+    Parameters
+    ----------
+    primary
+        The model the user selected; it is preferred within its tier, and its
+        provider is preferred within the other tier.
+    llms
+        The models that can be used (those with an API key), by name.
+    timeout
+        How long a step may take before it is retried with another model. It is
+        the request timeout of the provider clients, and also bounds the whole
+        step when called asynchronously.
+
+    """
+
+    def __init__(
+        self,
+        primary: str,
+        llms: dict[str, Runnable],
+        timeout: float = ROUTER_TIMEOUT,
+        log: RoutingLog | None = None,
+    ):
+        self.primary = primary
+        self.llms = llms
+        self.timeout = timeout
+        self.log = log or RoutingLog.instance()
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> ModelRouter:
+        return ModelRouter(
+            self.primary,
+            {name: llm.bind_tools(tools, **kwargs) for name, llm in self.llms.items()},
+            self.timeout,
+            self.log,
+        )
+
+    def candidates(self, tier: str) -> list[str]:
+        """The models to try for a tier, in order: the best available one of the
+        tier, the same tier from other providers, then the rest.
+        """
+        tier_models = STRONG_MODELS if tier == "strong" else FAST_MODELS
+        ranked = [self.primary] if self.primary in tier_models else []
+        ranked += sorted(
+            (name for name in tier_models if name != self.primary),
+            key=lambda name: provider(name) != provider(self.primary),
+        )
+        ranked += [self.primary, *self.llms]
+        return [name for name in dict.fromkeys(ranked) if name in self.llms]
+
+    def _messages(self, input: Any) -> list[BaseMessage]:
+        if isinstance(input, PromptValue):
+            return input.to_messages()
+        if isinstance(input, list):
+            return input
+        return []
+
+    def _config(self, config: RunnableConfig, record: RouteRecord) -> RunnableConfig:
+        metadata = {**config.get("metadata", {}), "route": f"{record.tier}: {record.reason}"}
+        return {**config, "metadata": metadata}
+
+    def _kwargs(self, kwargs: dict[str, Any]) -> dict[str, Any]:
+        # passed on to the provider's client, so that a request that hangs fails
+        # with a timeout error, on the sync path too
+        return {"timeout": self.timeout, **kwargs}
+
+    def _finish(self, record: RouteRecord, model: str, start: float, result: Any) -> Any:
+        usage = _usage(result)
+        record.model = model
+        record.latency_s = time.monotonic() - start
+        record.input_tokens = usage["input_tokens"]
+        record.output_tokens = usage["output_tokens"]
+        record.cost_usd = _cost(model, usage)
+        self.log.add(record)
+        return result
+
+    def _failed(self, record: RouteRecord, model: str, start: float, exc: BaseException) -> None:
+        record.model = model
+        record.latency_s = time.monotonic() - start
+        record.error = f"{type(exc).__name__}: {exc}"[:300]
+        self.log.add(record)
+
+    def _record(self, input: Any) -> tuple[RouteRecord, list[str]]:
+        decision = classify_step(self._messages(input))
+        candidates = self.candidates(decision.tier)
+        record = RouteRecord(
+            model=candidates[0], tier=decision.tier, reason=decision.reason, session_id=current_session_id()
+        )
+        return record, candidates
+
+    def invoke(self, input: Any, config: RunnableConfig | None = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        record, candidates = self._record(input)
+        start = time.monotonic()
+        for idx, model in enumerate(candidates):
+            try:
+                result = self.llms[model].invoke(
+                    input, self._config(config, record), **self._kwargs(kwargs)
+                )
+            except Exception as exc:
+                if idx + 1 == len(candidates) or not is_transient(exc):
+                    self._failed(record, model, start, exc)
+                    raise
+                print(f"{model} failed ({type(exc).__name__}), falling back to {candidates[idx + 1]}")
+                record.fell_back_from.append(model)
+                continue
+            return self._finish(record, model, start, result)
+
+    async def ainvoke(self, input: Any, config: RunnableConfig | None = None, **kwargs: Any) -> Any:
+        config = ensure_config(config)
+        record, candidates = self._record(input)
+        start = time.monotonic()
+        for idx, model in enumerate(candidates):
+            try:
+                result = await asyncio.wait_for(
+                    self.llms[model].ainvoke(
+                        input, self._config(config, record), **self._kwargs(kwargs)
+                    ),
+                    self.timeout,
+                )
+            except Exception as exc:
+                if idx + 1 == len(candidates) or not is_transient(exc):
+                    self._failed(record, model, start, exc)
+                    raise
+                print(f"{model} failed ({type(exc).__name__}), falling back to {candidates[idx + 1]}")
+                record.fell_back_from.append(model)
+                continue
+            return self._finish(record, model, start, result)
+
+
+__all__ = ("MODEL_ROUTING", "ModelRouter", "RoutingLog", "classify_step")
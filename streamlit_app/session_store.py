@@ -0,0 +1,140 @@
+"""Bounded, spill-to-disk storage for per-session logs.
+
+Long-running app processes used to keep every code run and generated file name of
+every session in memory. Each session now keeps only its most recent entries in
+memory; older ones are moved to files under `SESSION_STORE_DIR/<session id>/`,
+where they can still be read back until the session ends (the directory is
+deleted then). `memory_usage()` reports what each store holds, so the
+process' growth can be attributed to sessions.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import resource
+import shutil
+import tempfile
+import threading
+from collections import deque
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+SESSION_STORE_DIR = Path(
+    os.environ.get("SESSION_STORE_DIR", Path(tempfile.gettempdir()) / "datalab-agent-sessions")
+)
+# Per session log
+SESSION_LOG_MAX_ENTRIES = int(os.environ.get("SESSION_LOG_MAX_ENTRIES", 200))
+SESSION_LOG_MAX_BYTES = int(os.environ.get("SESSION_LOG_MAX_BYTES", 2 * 1024**2))
+
+
+def session_dir(session_id: str) -> Path:
+    return SESSION_STORE_DIR / re.sub(r"[^\w.-]", "_", session_id)
+
+
+def delete_session_dir(session_id: str) -> None:
+    """Delete what a session spilled to disk, once it has ended."""
+    shutil.rmtree(session_dir(session_id), ignore_errors=True)
+
+
+class SpillingLog:
+    """An append-only log of JSON-serialisable entries. The most recent entries
+    are kept in memory, up to `max_entries` and `max_bytes` (of their JSON);
+    older ones are appended to a JSONL file.
+
+    Parameters
+    ----------
+    path
+        The JSONL file older entries are moved to; created on first use.
+    max_entries
+        The most entries to keep in memory.
+    max_bytes
+        The most bytes of entries to keep in memory; the latest entry is always
+        kept, however large.
+
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = SESSION_LOG_MAX_ENTRIES,
+        max_bytes: int = SESSION_LOG_MAX_BYTES,
+    ):
+        self.path = Path(path)
+        self.max_entries = max(max_entries, 1)
+        self.max_bytes = max_bytes
+        self._recent: deque[tuple[Any, int]] = deque()
+        self._bytes = 0
+        self.spilled = 0
+        # tool calls run in parallel may append at the same time
+        self._lock = threading.Lock()
+
+    def append(self, entry: Any) -> None:
+        with self._lock:
+            self._append(entry)
+
+    def _append(self, entry: Any) -> None:
+        line = json.dumps(entry, default=str)
+        self._recent.append((entry, len(line)))
+        self._bytes += len(line)
+        spill = []
+        while len(self._recent) > 1 and (
+            len(self._recent) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            old, size = self._recent.popleft()
+            self._bytes -= size
+            spill.append(json.dumps(old, default=str))
+        if spill:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as handle:
+                handle.write("\n".join(spill) + "\n")
+            self.spilled += len(spill)
+
+    def recent(self, n: int | None = None) -> list[Any]:
+        """The last `n` entries held in memory (all of them by default)."""
+        with self._lock:
+            entries = [entry for entry, _ in self._recent]
+        return entries if n is None else entries[-n:]
+
+    def __iter__(self) -> Iterator[Any]:
+        """Every entry, oldest first, reading spilled ones back from disk (as
+        they were decoded from JSON, so tuples come back as lists).
+        """
+        # a snapshot, so that entries appended meanwhile are neither missed nor
+        # read twice (from disk and from memory)
+        with self._lock:
+            spilled = self.spilled
+            recent = [entry for entry, _ in self._recent]
+        if spilled and self.path.exists():
+            with open(self.path) as handle:
+                for line, _ in zip(handle, range(spilled)):
+                    yield json.loads(line)
+        yield from recent
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.spilled + len(self._recent)
+
+    def memory_usage(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries_in_memory": len(self._recent),
+                "entries_spilled": self.spilled,
+                "bytes_in_memory": self._bytes,
+            }
+
+
+def process_memory() -> dict[str, int]:
+    """The resident set size of this process, now and at its peak, in bytes."""
+    usage = {"peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open("/proc/self/statm") as handle:
+            usage["rss_bytes"] = int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    return usage
+
+
+__all__ = ("SpillingLog", "delete_session_dir", "process_memory", "session_dir")
@@ -2,8 +2,10 @@
 
 from __future__ import annotations
 
+import threading
 import time
 from enum import Enum
+from pathlib import Path
 from typing import TYPE_CHECKING, Any, NamedTuple
 
 from langchain.callbacks.base import (  # type: ignore[import-not-found, unused-ignore]
@@ -17,6 +19,9 @@ from langchain.schema import (  # type: ignore[import-not-found, unused-ignore]
 
 from streamlit.runtime.metrics_util import gather_metrics
 
+from file_browser import CODEBOX_DIR
+from plots import plot_preview
+
 if TYPE_CHECKING:
     from streamlit.delta_generator import DeltaGenerator
     from streamlit.elements.lib.mutable_status_container import StatusContainer
@@ -33,6 +38,27 @@ def _convert_newlines(text: str) -> str:
 # Strings that are longer than this will be truncated with "..."
 MAX_TOOL_INPUT_STR_LENGTH = 60
 
+# Streamed tokens are batched and only rendered once this many seconds have passed
+# since the last render, or once this many characters are waiting, whichever is first.
+STREAM_RENDER_INTERVAL = 0.1
+STREAM_RENDER_CHARS = 256
+
+
+def _split_completed_blocks(text: str) -> tuple[str, str]:
+    """Split streamed markdown into the completed paragraphs, which will no longer
+    change, and the trailing paragraph that is still being written.
+
+    Paragraphs are only split outside of code fences, so that a fenced block is
+    always rendered by a single markdown element.
+    """
+    boundary = text.rfind("\n\n")
+    while boundary != -1:
+        head = text[:boundary]
+        if head.count("```") % 2 == 0:
+            return head, text[boundary + 2 :]
+        boundary = text.rfind("\n\n", 0, boundary)
+    return "", text
+
 
 class LLMThoughtState(Enum):
     # The LLM is thinking about what to do next. We don't know which tool we'll run.
@@ -114,17 +140,27 @@ class LLMThought:
         labeler: LLMThoughtLabeler,
         expanded: bool,
         collapse_on_complete: bool,
+        render_interval: float = STREAM_RENDER_INTERVAL,
+        render_chars: int = STREAM_RENDER_CHARS,
+        files_dir: Path = CODEBOX_DIR,
     ):
         self._container = parent_container.status(
             labeler.get_initial_label(), expanded=expanded
         )
 
         self._state = LLMThoughtState.THINKING
+        # Only the paragraph still being streamed is kept here; completed paragraphs
+        # are frozen into their own elements so they are not re-sent on every render.
         self._llm_token_stream = ""
         self._llm_token_stream_placeholder: DeltaGenerator | None = None
+        self._render_interval = render_interval
+        self._render_chars = render_chars
+        self._pending_chars = 0
+        self._last_render = 0.0
         self._last_tool: ToolRecord | None = None
         self._collapse_on_complete = collapse_on_complete
         self._labeler = labeler
+        self._files_dir = files_dir
 
     @property
     def container(self) -> StatusContainer:
@@ -137,21 +173,49 @@ class LLMThought:
         return self._last_tool
 
     def _reset_llm_token_stream(self) -> None:
+        # final flush of anything that arrived since the last throttled render
+        if self._llm_token_stream and self._llm_token_stream_placeholder is None:
+            self._llm_token_stream_placeholder = self._container.empty()
         if self._llm_token_stream_placeholder is not None:
-            self._llm_token_stream_placeholder.markdown(self._llm_token_stream)
+            self._llm_token_stream_placeholder.markdown(
+                _convert_newlines(self._llm_token_stream)
+            )
 
         self._llm_token_stream = ""
         self._llm_token_stream_placeholder = None
+        self._pending_chars = 0
+        self._last_render = 0.0
+
+    def _render_llm_token_stream(self) -> None:
+        if self._llm_token_stream_placeholder is None:
+            self._llm_token_stream_placeholder = self._container.empty()
+
+        completed, tail = _split_completed_blocks(self._llm_token_stream)
+        if completed:
+            # render the finished paragraphs one last time and start a new element
+            # for the tail, so that only the tail is re-sent from now on
+            self._llm_token_stream_placeholder.markdown(_convert_newlines(completed))
+            self._llm_token_stream_placeholder = self._container.empty()
+            self._llm_token_stream = tail
+
+        self._llm_token_stream_placeholder.markdown(
+            _convert_newlines(self._llm_token_stream) + "▕"
+        )
+        self._pending_chars = 0
+        self._last_render = time.monotonic()
 
     def on_llm_start(self, serialized: dict[str, Any], prompts: list[str]) -> None:
         self._reset_llm_token_stream()
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         # This is only called when the LLM is initialized with `streaming=True`
-        self._llm_token_stream += _convert_newlines(token)
-        if self._llm_token_stream_placeholder is None:
-            self._llm_token_stream_placeholder = self._container.empty()
-        self._llm_token_stream_placeholder.markdown(self._llm_token_stream + "▕")
+        self._llm_token_stream += token
+        self._pending_chars += len(token)
+        if (
+            self._pending_chars >= self._render_chars
+            or time.monotonic() - self._last_render >= self._render_interval
+        ):
+            self._render_llm_token_stream()
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         # `response` is the concatenation of all the tokens received by the LLM.
@@ -179,6 +243,9 @@ class LLMThought:
             state="running",
         )
         # output is printed later in on_tool_end
+        if tool_name != "localcodebox":
+            self._container.markdown(f"**Input:**\n\n```json\n{input_str}\n```\n\n")
+            return
         try:
             code_from_json = input_str[10:-2].replace(
                 "\\n", "\n"
@@ -200,12 +267,28 @@ class LLMThought:
     ) -> None:
         self._container.markdown("**Output**:\n\n")
 
+        if isinstance(output, str):
+            # e.g. documentation looked up by the agent
+            self._container.markdown(output)
+            self._container.update()
+            return
+
+        if isinstance(output, dict) and output.get("cached"):
+            self._container.caption(
+                "Cached: this code already ran with the same kernel state, so it was not run again."
+            )
+
         if "text" in output:
             self._container.markdown(output["text"])
             self._container.update()
 
-        if "b64-image" in output:
-            self._container.image(output["b64-image"])
+        for name in output.get("images", []) if isinstance(output, dict) else []:
+            # only a compressed preview is sent to the browser; the full-resolution
+            # plot can be downloaded from the file browser
+            if (preview := plot_preview(name, self._files_dir)) is None:
+                self._container.caption(f"{name} no longer exists.")
+            else:
+                self._container.image(str(preview), caption=f"{name} (full resolution in Files)")
             self._container.update()
 
         if "bokeh" in output:
@@ -253,6 +336,10 @@ class LLMThought:
 
 
 class CustomStreamlitCallbackHandler(BaseCallbackHandler):
+    # When the agent runs asynchronously, call us on the agent's thread (which has
+    # the Streamlit script context) in order, rather than from a thread pool
+    run_inline = True
+
     @gather_metrics("external.langchain.StreamlitCallbackHandler")
     def __init__(
         self,
@@ -262,6 +349,9 @@ class CustomStreamlitCallbackHandler(BaseCallbackHandler):
         expand_new_thoughts: bool = False,
         collapse_completed_thoughts: bool = False,
         thought_labeler: LLMThoughtLabeler | None = None,
+        stream_render_interval: float = STREAM_RENDER_INTERVAL,
+        stream_render_chars: int = STREAM_RENDER_CHARS,
+        files_dir: Path = CODEBOX_DIR,
     ):
         """Construct a new StreamlitCallbackHandler. This CallbackHandler is geared
         towards use with a LangChain Agent; it displays the Agent's LLM and tool-usage
@@ -275,14 +365,9 @@ class CustomStreamlitCallbackHandler(BaseCallbackHandler):
             Handler creates.
 
         max_thought_containers
-
-            .. note::
-                This parameter is deprecated and is ignored in the latest version of
-                the callback handler.
-
-            The max number of completed LLM thought containers to show at once. When
-            this threshold is reached, a new thought will cause the oldest thoughts to
-            be collapsed into a "History" expander. Defaults to 4.
+            The max number of completed LLM thoughts to keep track of. When this
+            threshold is reached, the oldest thoughts are collapsed and released, so
+            that their streamed text is no longer held in memory. Defaults to 4.
 
         expand_new_thoughts
             Each LLM "thought" gets its own `st.expander`. This param controls whether
@@ -295,15 +380,55 @@ class CustomStreamlitCallbackHandler(BaseCallbackHandler):
         thought_labeler
             An optional custom LLMThoughtLabeler instance. If unspecified, the handler
             will use the default thought labeling logic. Defaults to None.
+
+        stream_render_interval
+            When the LLM streams tokens, re-render at most this often (in seconds).
+            Defaults to 0.1.
+
+        stream_render_chars
+            When the LLM streams tokens, re-render early once this many characters
+            have arrived since the last render. Defaults to 256.
+
+        files_dir
+            The working directory of the session's kernel, where its plots are
+            saved. Defaults to `.codebox`.
         """
         self._parent_container = parent_container
         self._history_parent = parent_container.container()
         self._current_thought: LLMThought | None = None
+        # tool run id -> the thought showing it; tool calls run in parallel each
+        # get a thought of their own
+        self._tool_thoughts: dict[Any, LLMThought] = {}
+        # tool calls run in parallel report from several threads at once
+        self._lock = threading.RLock()
         self._completed_thoughts: list[LLMThought] = []
         self._max_thought_containers = max(max_thought_containers, 1)
         self._expand_new_thoughts = expand_new_thoughts
         self._collapse_completed_thoughts = collapse_completed_thoughts
         self._thought_labeler = thought_labeler or LLMThoughtLabeler()
+        self._stream_render_interval = stream_render_interval
+        self._files_dir = files_dir
+        self._stream_render_chars = stream_render_chars
+        self._detached = False
+
+    def detach(self) -> None:
+        """Stop rendering, e.g. once the script run that created our containers
+        has been replaced by a rerun and they no longer exist.
+        """
+        self._detached = True
+
+    @property
+    def ignore_llm(self) -> bool:
+        return self._detached
+
+    @property
+    def ignore_chain(self) -> bool:
+        return self._detached
+
+    @property
+    def ignore_agent(self) -> bool:
+        # also covers tool callbacks
+        return self._detached
 
     def _require_current_thought(self) -> LLMThought:
         """Return our current LLMThought. Raise an error if we have no current
@@ -323,40 +448,69 @@ class CustomStreamlitCallbackHandler(BaseCallbackHandler):
         """Complete the current thought, optionally assigning it a new label.
         Add it to our _completed_thoughts list.
         """
-        thought = self._require_current_thought()
+        self._complete_thought(self._require_current_thought(), final_label)
+
+    def _complete_thought(self, thought: LLMThought, final_label: str | None = None) -> None:
         thought.complete(final_label)
         self._completed_thoughts.append(thought)
-        self._current_thought = None
+        if thought is self._current_thought:
+            self._current_thought = None
+        self._prune_old_thought_containers()
+
+    def _new_thought(self) -> LLMThought:
+        return LLMThought(
+            parent_container=self._parent_container,
+            expanded=self._expand_new_thoughts,
+            collapse_on_complete=self._collapse_completed_thoughts,
+            labeler=self._thought_labeler,
+            render_interval=self._stream_render_interval,
+            render_chars=self._stream_render_chars,
+            files_dir=self._files_dir,
+        )
+
+    def _prune_old_thought_containers(self) -> None:
+        """Collapse and forget the oldest completed thoughts beyond
+        `max_thought_containers`; their elements stay on the page.
+        """
+        while len(self._completed_thoughts) > self._max_thought_containers:
+            thought = self._completed_thoughts.pop(0)
+            thought.container.update(expanded=False)
 
     def on_llm_start(
         self, serialized: dict[str, Any], prompts: list[str], **kwargs: Any
     ) -> None:
-        if self._current_thought is None:
-            self._current_thought = LLMThought(
-                parent_container=self._parent_container,
-                expanded=self._expand_new_thoughts,
-                collapse_on_complete=self._collapse_completed_thoughts,
-                labeler=self._thought_labeler,
-            )
+        with self._lock:
+            if self._current_thought is None:
+                self._current_thought = self._new_thought()
 
-        self._current_thought.on_llm_start(serialized, prompts)
+            self._current_thought.on_llm_start(serialized, prompts)
 
         # We don't prune_old_thought_containers here, because our container won't
         # be visible until it has a child.
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        self._require_current_thought().on_llm_new_token(token, **kwargs)
+        with self._lock:
+            self._require_current_thought().on_llm_new_token(token, **kwargs)
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        self._require_current_thought().on_llm_end(response, **kwargs)
+        with self._lock:
+            self._require_current_thought().on_llm_end(response, **kwargs)
 
     def on_llm_error(self, error: BaseException, *args: Any, **kwargs: Any) -> None:
-        self._require_current_thought().on_llm_error(error, **kwargs)
+        with self._lock:
+            self._require_current_thought().on_llm_error(error, **kwargs)
 
     def on_tool_start(
         self, serialized: dict[str, Any], input_str: str, **kwargs: Any
     ) -> None:
-        self._require_current_thought().on_tool_start(serialized, input_str, **kwargs)
+        with self._lock:
+            if self._tool_thoughts or self._current_thought is None:
+                # another tool call of the same step is still running
+                thought = self._new_thought()
+            else:
+                thought = self._current_thought
+            self._tool_thoughts[kwargs.get("run_id")] = thought
+            thought.on_tool_start(serialized, input_str, **kwargs)
 
     def on_tool_end(
         self,
@@ -366,24 +520,30 @@ class CustomStreamlitCallbackHandler(BaseCallbackHandler):
         llm_prefix: str | None = None,
         **kwargs: Any,
     ) -> None:
-        self._require_current_thought().on_tool_end(
-            output, color, observation_prefix, llm_prefix, **kwargs
-        )
-        self._complete_current_thought()
+        with self._lock:
+            thought = self._tool_thoughts.pop(kwargs.get("run_id"), None) or self._require_current_thought()
+            thought.on_tool_end(output, color, observation_prefix, llm_prefix, **kwargs)
+            self._complete_thought(thought)
 
     def on_tool_error(self, error: BaseException, *args: Any, **kwargs: Any) -> None:
-        self._require_current_thought().on_tool_error(error, **kwargs)
+        with self._lock:
+            thought = self._tool_thoughts.pop(kwargs.get("run_id"), None) or self._require_current_thought()
+            thought.on_tool_error(error, **kwargs)
 
     def on_agent_action(
         self, action: AgentAction, color: str | None = None, **kwargs: Any
     ) -> Any:
-        self._require_current_thought().on_agent_action(action, color, **kwargs)
+        with self._lock:
+            # parallel tool calls may start after the step's thought has completed
+            if self._current_thought is not None:
+                self._current_thought.on_agent_action(action, color, **kwargs)
 
     def on_agent_finish(
         self, finish: AgentFinish, color: str | None = None, **kwargs: Any
     ) -> None:
-        if self._current_thought is not None:
-            self._current_thought.complete(
-                self._thought_labeler.get_final_agent_thought_label()
-            )
-            self._current_thought = None
+        with self._lock:
+            if self._current_thought is not None:
+                self._current_thought.complete(
+                    self._thought_labeler.get_final_agent_thought_label()
+                )
+                self._current_thought = None
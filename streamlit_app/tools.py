@@ -1,21 +1,69 @@
+from concurrent.futures import Future
+from contextlib import nullcontext
+from contextvars import ContextVar
 from uuid import uuid4
-from io import BytesIO
+from pathlib import Path
+import os
 import re
-import base64
+import shutil
+import threading
+import time
 
 from pydantic.v1 import BaseModel, Field
+from langchain_core.callbacks import Callbacks
 from langchain_core.tools import tool, StructuredTool
 
 from codeboxapi import CodeBox, settings
 from codeboxapi.box.localbox import LocalBox
-from codeboxapi.schema import CodeBoxOutput
+from codeboxapi.schema import CodeBoxFile, CodeBoxOutput
 
 from codeinterpreterapi import File
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 # from codeinterpreterapi.chains import get_file_modifications
 
+from execution_cache import CODEBOX_MEMOIZE, CodeKind, ExecutionCache, classify
+from kernel_pool import chdir_code
+from kernel_scheduler import KernelScheduler, session_workdir
+from output_reducer import CODEBOX_MAX_OUTPUT_CHARS, reduce_output
+from plots import save_plot
+from package_installer import (
+    CODEBOX_AUTO_INSTALL,
+    INVALIDATE_IMPORT_CACHES_CODE,
+    PackageInstaller,
+    imports_first,
+    missing_module,
+)
+from preflight import CODEBOX_PREFLIGHT, bound_names, preflight
+from session_store import SpillingLog, delete_session_dir, session_dir
+from tracing import Tracer
+
+
+# Capture all of the Python output (up to a safeguard); `reduce_output` decides how
+# much of it the LLM actually sees and saves the rest to a file
+settings.MAX_OUTPUT_LENGTH = CODEBOX_MAX_OUTPUT_CHARS
+
+# A session whose browser tab has been gone for this long (in seconds) has ended,
+# and whatever is kept for it is deleted
+CODEBOX_SESSION_END_GRACE = float(os.environ.get("CODEBOX_SESSION_END_GRACE", 600))
+
+# Set by callers that run the agent outside of the Streamlit script thread
+SESSION_ID: ContextVar[str | None] = ContextVar("codebox_session_id", default=None)
+
+# Set (by `ParallelAgentExecutor`) to a borrowed kernel for a call that runs on its
+# own rather than on the session's kernel
+SCRATCH_KERNEL: ContextVar[LocalBox | CodeBox | None] = ContextVar(
+    "codebox_scratch_kernel", default=None
+)
+
+
+def current_session_id() -> str:
+    """The id of the Streamlit session the current tool call belongs to."""
+    if session_id := SESSION_ID.get():
+        return session_id
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "default"
 
-# Allow the LLM to see more of the Python output
-settings.MAX_OUTPUT_LENGTH = 100000
 
 TOOL_DESCRIPTION = """Input a string of code to a ipython interpreter.
 Write the entire code in a single-line string.
@@ -44,28 +92,33 @@ def codeboxtool(code: str) -> str:
 
     """
 
-    with CodeBox() as codebox:
+    # a clean kernel out of the same bounded pool the sessions lease from; it is
+    # reset before being handed to the next caller
+    with KernelScheduler.instance().checkout() as codebox:
         output = codebox.run(code)
         output_files = codebox.list_files()
 
-    output_content = output.content
-
-    if output.type == "image/png":
-        filename = f"image-{uuid4()}.png"
-        # file_buffer = BytesIO(base64.b64decode(output.content))
-        # file_buffer.name = filename
-        output_files.append(filename)
-        output_content = ""
-
-    elif output.type == "error":
-        print("Error:", output.content)
-        if "ModuleNotFoundError" in output.content:
-            if package := re.search(
-                r"ModuleNotFoundError: No module named '(.*)'",
-                output.content,
-            ):
-                codebox.install(package.group(1))
-                return f"{package.group(1)} was missing but it has now been installed. Please try again."
+        output_content = output.content
+
+        if output.type == "image/png":
+            filename = f"image-{uuid4()}.png"
+            output_files.append(filename)
+            output_content = ""
+
+        elif output.type == "error":
+            print("Error:", output.content)
+            if "ModuleNotFoundError" in output.content:
+                if (
+                    (package := re.search(
+                        r"ModuleNotFoundError: No module named '(.*)'",
+                        output.content,
+                    ))
+                    and (distribution := PackageInstaller.instance().distribution(
+                        package.group(1).split(".")[0]
+                    ))
+                ):
+                    codebox.install(distribution)
+                    return f"{package.group(1)} was missing but it has now been installed. Please try again."
 
     # return output.content
     return f"files generated: {output_files}\ncode output: {output.content}"
@@ -73,69 +126,333 @@ def codeboxtool(code: str) -> str:
 
 
 class LocalCodeBoxToolRunManager:
-    _instance = None
+    """Per-session state for the codebox tool; the kernel itself is leased from
+    the `KernelScheduler` for each run.
+    """
 
-    codebox: LocalBox | CodeBox
+    _instances: dict[str, "LocalCodeBoxToolRunManager"] = {}
+    _instances_lock = threading.Lock()
+    _releases_registered = False
+    # session id -> when it was first seen without a connected browser tab
+    _inactive_since: dict[str, float] = {}
+
+    session_id: str
+    # where the session's code runs and its files go, and the kernel generation
+    # the kernel was last moved there for
+    workdir: Path
+    workdir_generation: int
     input_files: list[File]
-    output_files: list[File]
-    code_log: list[tuple[str, str]]
+    # bounded in memory; older entries are moved to disk
+    output_files: SpillingLog
+    code_log: SpillingLog
     verbose: bool
+    # None when memoization is disabled
+    execution_cache: ExecutionCache | None
+    # names defined in the session's kernel (None if unknown), and the kernel
+    # generation they were tracked for
+    namespace: set[str] | None
+    namespace_generation: int
+    # per thread, as calls run on borrowed kernels may overlap the session's own
+    _last_run = threading.local()
 
     @classmethod
-    def instance(cls):
-        if cls._instance is None:
-            cls._instance = cls.__new__(cls)
-            cls._instance.codebox = CodeBox()
-            cls._instance.codebox.start()
-            cls._instance.input_files = []
-            cls._instance.output_files = []
-            cls._instance.code_log = []
-            cls._instance.verbose = True
-        return cls._instance
+    def instance(cls, session_id: str | None = None):
+        if session_id is None:
+            session_id = current_session_id()
+        with cls._instances_lock:
+            if not cls._releases_registered:
+                KernelScheduler.instance().on_session_released(cls._kernel_released)
+                cls._releases_registered = True
+            if session_id not in cls._instances:
+                self = cls.__new__(cls)
+                self.session_id = session_id
+                self.workdir = session_workdir(session_id)
+                self.workdir_generation = -1
+                self.input_files = []
+                self.output_files = SpillingLog(session_dir(session_id) / "output_files.jsonl")
+                self.code_log = SpillingLog(session_dir(session_id) / "code_log.jsonl")
+                self.verbose = True
+                self.execution_cache = (
+                    ExecutionCache(directory=self.workdir) if CODEBOX_MEMOIZE else None
+                )
+                self.namespace = None
+                self.namespace_generation = -1
+                cls._instances[session_id] = self
+            return cls._instances[session_id]
 
     @classmethod
-    def _run_handler(cls, code: str) -> dict[str, str | BytesIO]:
-        """Run code in container and send the output to the user"""
+    def get(cls, session_id: str) -> "LocalCodeBoxToolRunManager | None":
+        """The session's state, if it has any, without creating it."""
+        with cls._instances_lock:
+            return cls._instances.get(session_id)
 
+    @classmethod
+    def release(cls, session_id: str) -> None:
+        """Drop everything kept for a session once it has ended: its state, the
+        logs it spilled to disk, its working directory and its kernel.
+        """
+        with cls._instances_lock:
+            cls._instances.pop(session_id, None)
+            cls._inactive_since.pop(session_id, None)
+        KernelScheduler.instance().release_session(session_id)
+        delete_session_dir(session_id)
+        shutil.rmtree(session_workdir(session_id), ignore_errors=True)
+
+    @classmethod
+    def release_ended_sessions(cls, grace: float = CODEBOX_SESSION_END_GRACE) -> list[str]:
+        """Release the sessions whose browser tab has been gone for more than
+        `grace` seconds; returns their ids.
+        """
+        if not runtime.exists():
+            # e.g. the benchmark, which releases its sessions itself
+            return []
+        now = time.monotonic()
+        ended = []
+        with cls._instances_lock:
+            for session_id in cls._instances:
+                if runtime.get_instance().is_active_session(session_id):
+                    cls._inactive_since.pop(session_id, None)
+                elif now - cls._inactive_since.setdefault(session_id, now) > grace:
+                    ended.append(session_id)
+        for session_id in ended:
+            cls.release(session_id)
+        return ended
+
+    @classmethod
+    def _kernel_released(cls, session_id: str) -> None:
+        """Forget what was only valid for the kernel the session has lost (e.g. it
+        sat idle); its logs and files are kept until the session ends.
+        """
+        if (self := cls.get(session_id)) is not None and self.execution_cache is not None:
+            self.execution_cache.invalidate()
+
+    def memory_usage(self) -> dict[str, dict[str, int]]:
+        """What this session holds in memory."""
+        usage = {
+            "code_log": self.code_log.memory_usage(),
+            "output_files": self.output_files.memory_usage(),
+        }
+        if self.execution_cache is not None:
+            usage["execution_cache"] = self.execution_cache.memory_usage()
+        return usage
+
+    def list_files(self) -> list[CodeBoxFile]:
+        """The files in the session's working directory."""
+        os.makedirs(self.workdir, exist_ok=True)
+        return [
+            CodeBoxFile(name=file_name, content=None)
+            for file_name in os.listdir(self.workdir)
+            if os.path.isfile(os.path.join(self.workdir, file_name))
+        ]
+
+    def known_names(self, scheduler: KernelScheduler) -> set[str] | None:
+        """The names defined in the kernel the session's next run will use."""
+        if (
+            scheduler.has_kernel(self.session_id)
+            and scheduler.generation(self.session_id) == self.namespace_generation
+        ):
+            return self.namespace
+        # a fresh kernel only has what the warm-up code defines
+        return bound_names(scheduler.pool.warmup_code)
+
+    def _track_namespace(self, scheduler: KernelScheduler, code: str) -> None:
+        generation = scheduler.generation(self.session_id)
+        if generation != self.namespace_generation:
+            self.namespace = bound_names(scheduler.pool.warmup_code)
+            self.namespace_generation = generation
+        if self.namespace is not None:
+            names = bound_names(code)
+            self.namespace = None if names is None else self.namespace | names
+
+    @classmethod
+    def _run_handler(cls, code: str, callbacks: Callbacks = None) -> dict[str, str | list[str]]:
+        """Run code in container and send the output to the user"""
 
         self = cls.instance()
-        print(f"Code box obj ID: {id(self.codebox)}")
-        print(f"Code box session ID: {self.codebox.session_id}")
+        scheduler = KernelScheduler.instance()
+        scratch = SCRATCH_KERNEL.get()
+        # the span of this tool call, if the turn is being traced
+        tracer = Tracer.instance()
+        parent = tracer.span_for_run(getattr(callbacks, "parent_run_id", None))
+
+        notes = []
+        if CODEBOX_PREFLIGHT:
+            # reject code that can't run without waiting for a kernel
+            if scratch is None:
+                check = preflight(code, self.known_names(scheduler))
+            else:
+                check = preflight(code, bound_names(scheduler.pool.warmup_code))
+            if check.error is not None:
+                print(f"Pre-flight rejected code (streamlit session {self.session_id}):\n", code)
+                self.code_log.append((code, f"[preflight] {check.error}"))
+                return {"text": check.error}
+            code = check.code
+            notes += [f"pre-flight {repair}" for repair in check.repairs]
+
+        # install missing imports while the kernel is being leased
+        installs = PackageInstaller.instance().prepare(code, self.workdir) if CODEBOX_AUTO_INSTALL else {}
+
+        queued = time.time()
+        lease = scheduler.lease(self.session_id) if scratch is None else nullcontext(scratch)
+        with lease as codebox:
+            tracer.record("kernel.queue", parent, queued, time.time())
+            self._enter_workdir(scheduler, codebox, scratch is not None)
+            if installs:
+                with tracer.span("package.install", parent, distributions=sorted(installs)):
+                    notes += self._finish_installs(codebox, installs)
+            with tracer.span(
+                "kernel.run", parent, code_chars=len(code), scratch=scratch is not None
+            ) as span:
+                if scratch is None:
+                    result = self._run_memoized(scheduler, codebox, code)
+                else:
+                    # only code that defines no names runs there, and the borrowed
+                    # kernel is reset afterwards, so there is no state to track or
+                    # cache against
+                    result = self._run(codebox, code)
+                span.attributes.update(
+                    cached=bool(result.get("cached")),
+                    failed=not result.get("cached") and self._last_run.failed,
+                    output_chars=len(result.get("text", "")),
+                    images=len(result.get("images", [])),
+                )
+        if notes:
+            note = "; ".join(notes)
+            result["text"] = f"({note[:1].upper()}{note[1:]}.)\n" + result.get("text", "")
+        return result
+
+    def _enter_workdir(
+        self, scheduler: KernelScheduler, codebox: LocalBox | CodeBox, scratch: bool
+    ) -> None:
+        """Move the kernel into the session's working directory, unless it is
+        already there; kernels are moved back out whenever they are reset.
+        """
+        if scratch:
+            codebox.run(chdir_code(self.workdir))
+        elif (generation := scheduler.generation(self.session_id)) != self.workdir_generation:
+            codebox.run(chdir_code(self.workdir))
+            self.workdir_generation = generation
+
+    @staticmethod
+    def _finish_installs(
+        codebox: LocalBox | CodeBox, installs: dict[str, Future[str | None]]
+    ) -> list[str]:
+        installed, errors = PackageInstaller.instance().wait(installs)
+        if installed:
+            # new packages are importable without restarting (and wiping) the kernel
+            codebox.run(INVALIDATE_IMPORT_CACHES_CODE)
+        notes = [f"installed {', '.join(installed)}"] if installed else []
+        notes += [
+            f"could not install {distribution}: {error.splitlines()[-1]}"
+            for distribution, error in errors.items()
+        ]
+        return notes
+
+    def _run_memoized(
+        self, scheduler: KernelScheduler, codebox: LocalBox | CodeBox, code: str
+    ) -> dict[str, str | list[str]]:
+        if self.execution_cache is None:
+            result = self._run(codebox, code)
+            self._track_namespace(scheduler, code)
+            return result
+
+        # a fresh kernel (e.g. after eviction) has a new generation, so nothing
+        # cached against the previous kernel's state is reused
+        kernel_generation = scheduler.generation(self.session_id)
+        if (cached := self.execution_cache.get(code, kernel_generation)) is not None:
+            print(f"Cache hit for code (streamlit session {self.session_id}):\n", code)
+            self.code_log.append((code, f"[cached] {cached.get('text', '')}"))
+            cached["cached"] = True
+            cached["text"] = (
+                "(Cached result of an identical earlier run; the kernel state is unchanged.)\n"
+                + cached.get("text", "")
+            )
+            return cached
+
+        result = self._run(codebox, code)
+        self._track_namespace(scheduler, code)
+        self.execution_cache.record(code, kernel_generation, result, self._last_run.failed)
+        return result
+
+    def _run(
+        self, codebox: LocalBox | CodeBox, code: str, install_missing: bool = True
+    ) -> dict[str, str | list[str]]:
+        print(f"Code box obj ID: {id(codebox)}")
+        print(f"Code box session ID: {codebox.session_id} (streamlit session {self.session_id})")
         print("Code:\n", code)
-        outputs: list[CodeBoxOutput] | CodeBoxOutput = self.codebox.run(code)
+        outputs: list[CodeBoxOutput] | CodeBoxOutput = codebox.run(code)
 
         result = {}
+        # read back by `_run_handler` (in the same thread) once the run is over
+        self._last_run.failed = not isinstance(outputs, list) or any(
+            output.type == "error" for output in outputs
+        )
 
         if not isinstance(outputs, list):
             self.code_log.append((code, outputs.content))
-            return {"text": outputs.content}
+            return {"text": reduce_output(outputs.content, directory=self.workdir)}
 
         for output in outputs:
 
-            self.code_log.append((code, output.content))
+            self.code_log.append(
+                (code, "[image/png]" if output.type == "image/png" else output.content)
+            )
             if not isinstance(output.content, str):
                 raise TypeError("Expected output.content to be a string.")
 
             if output.type in ("plain/text", "text"):
-                result["text"] = output.content
+                result["text"] = reduce_output(output.content, directory=self.workdir)
 
             if output.type == "image/png":
-                filename = f"image-{uuid4()}.png"
-                file_buffer = BytesIO(base64.b64decode(output.content))
-                file_buffer.name = filename
-                self.output_files.append(File(name=filename, content=file_buffer.read()))
-                result["b64-image"] = file_buffer
+                # written once to a content-addressed file; the result (and so the
+                # LLM) only carries its name
+                name = save_plot(output.content, self.workdir)
+                self.output_files.append(name)
+                result.setdefault("images", []).append(name)
+                result["text"] = "\n".join(filter(None, [
+                    result.get("text"),
+                    f"[Plot saved as {name}; the user was shown a preview.]",
+                ]))
 
             if "Unable to run BokehJS code because BokehJS library is missing" in output.content:
                 result["bokeh"] = output.content
 
             if output.type == "error":
-                if "ModuleNotFoundError" in output.content:
-                    if package := re.search(
-                        r"ModuleNotFoundError: No module named '(.*)'",
-                        output.content,
+                installer = PackageInstaller.instance()
+                if (
+                    CODEBOX_AUTO_INSTALL
+                    and install_missing
+                    and (module := missing_module(output.content)) is not None
+                    and (distribution := installer.distribution(module)) is not None
+                ):
+                    # e.g. an import the static scan could not see
+                    installed, _ = installer.wait(installer.install([distribution]))
+                    if installed:
+                        codebox.run(INVALIDATE_IMPORT_CACHES_CODE)
+                        if imports_first(code, module) or classify(code) is not CodeKind.MUTATING:
+                            # nothing it did before the import fails differently the
+                            # second time, so run it again rather than ask the model to
+                            result = self._run(codebox, code, install_missing=False)
+                            result["text"] = (
+                                f"({installed[0]} was missing, so it was installed and the "
+                                "code run again.)\n" + result.get("text", "")
+                            )
+                            return result
+                        result["text"] = "\n".join(filter(None, [
+                            result.get("text"),
+                            f"({installed[0]} was missing and has been installed now. The code "
+                            "was not run again, as what it did before the import failed "
+                            "would be done twice: run what is still needed.)",
+                        ]))
+                elif not CODEBOX_AUTO_INSTALL and "ModuleNotFoundError" in output.content:
+                    if (
+                        (package := re.search(
+                            r"ModuleNotFoundError: No module named '(.*)'",
+                            output.content,
+                        ))
+                        and (distribution := installer.distribution(package.group(1).split(".")[0]))
                     ):
-                        self.codebox.install(package.group(1))
+                        codebox.install(distribution)
                         return {"text": (
                             f"{package.group(1)} was missing but "
                             "got installed now. Please try again."
@@ -143,6 +460,12 @@ class LocalCodeBoxToolRunManager:
                 else:
                     # TODO: pre-analyze error to optimize next code generation
                     pass
+                # show the model the (trimmed) traceback alongside any printed output
+                result["text"] = "\n".join(
+                    filter(None, [
+                        result.get("text"), reduce_output(output.content, directory=self.workdir)
+                    ])
+                )
                 if self.verbose:
                     print("Error:", output.content)
 
@@ -0,0 +1,491 @@
+"""Per-turn tracing: where the time of an answer went.
+
+Each agent turn is a trace. `TracingCallbackHandler` turns the LangChain events
+of the turn into spans (the turn itself, every LLM call with its token counts and
+retries, every tool call with its output size); the codebox tool adds spans for
+installing packages, waiting for a kernel and running the code, and the datalab
+caching proxy adds one per HTTP request made while the code runs.
+
+Finished spans are kept in memory for the diagnostics page, appended to
+`TRACE_DIR/spans.jsonl` (rotated at `TRACE_FILE_MAX_BYTES`), and, if
+`OTEL_EXPORTER_OTLP_ENDPOINT` is set, sent to an OpenTelemetry collector as
+OTLP/HTTP JSON.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+from uuid import UUID
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from prompting import extract_usage
+
+TRACING = os.environ.get("TRACING", "1") not in ("0", "false", "")
+TRACE_DIR = Path(os.environ.get("TRACE_DIR", ".traces"))
+# Finished spans kept in memory for the diagnostics page
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", 20_000))
+# e.g. http://localhost:4318; spans are POSTed to <endpoint>/v1/traces
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "datalab-agent")
+# Spans are exported in batches, at least this often (in seconds)
+TRACE_EXPORT_INTERVAL = float(os.environ.get("TRACE_EXPORT_INTERVAL", 2))
+# The JSONL files in TRACE_DIR are rotated once they reach this size, keeping
+# this many older files (`spans.jsonl.1` being the most recent)
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", 20 * 1024**2))
+TRACE_FILE_BACKUPS = int(os.environ.get("TRACE_FILE_BACKUPS", 2))
+
+
+def append_lines(path: Path, lines: list[str]) -> None:
+    """Append `lines` to the JSONL file `path`, rotating it first if they would
+    take it past `TRACE_FILE_MAX_BYTES`.
+    """
+    data = "".join(line + "\n" for line in lines)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        size = 0
+    if size and size + len(data) > TRACE_FILE_MAX_BYTES:
+        for idx in range(TRACE_FILE_BACKUPS - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{idx}")
+            if older.exists():
+                older.replace(path.with_name(f"{path.name}.{idx + 1}"))
+        if TRACE_FILE_BACKUPS > 0:
+            path.replace(path.with_name(f"{path.name}.1"))
+        else:
+            path.unlink()
+    with open(path, "a") as handle:
+        handle.write(data)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start: float
+    end: float | None = None
+    session_id: str | None = None
+    status: str = "ok"
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def child(self, name: str, **attributes: Any) -> Span:
+        return Span(
+            name=name,
+            trace_id=self.trace_id,
+            span_id=secrets.token_hex(8),
+            parent_id=self.span_id,
+            start=time.time(),
+            session_id=self.session_id,
+            attributes=attributes,
+        )
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span: Span) -> dict[str, Any]:
+    attributes = dict(span.attributes)
+    if span.session_id is not None:
+        attributes["session.id"] = span.session_id
+    otlp = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(int(span.start * 1e9)),
+        "endTimeUnixNano": str(int((span.end or span.start) * 1e9)),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+        "status": {"code": 2 if span.status == "error" else 1},
+    }
+    if span.parent_id is not None:
+        otlp["parentSpanId"] = span.parent_id
+    return otlp
+
+
+class Tracer:
+    """Records finished spans and exports them in the background.
+
+    Parameters
+    ----------
+    enabled
+        Whether to record anything; spans are still handed out when disabled.
+    trace_dir
+        Where to append spans as JSON lines; None to not write them.
+    otlp_endpoint
+        The base URL of an OTLP/HTTP collector; None to not send them.
+    max_spans
+        How many finished spans to keep in memory.
+
+    """
+
+    _instance: Tracer | None = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        enabled: bool = TRACING,
+        trace_dir: Path | None = TRACE_DIR,
+        otlp_endpoint: str | None = OTEL_EXPORTER_OTLP_ENDPOINT,
+        max_spans: int = TRACE_MAX_SPANS,
+    ):
+        self.enabled = enabled
+        self.trace_dir = Path(trace_dir) if trace_dir is not None else None
+        self.otlp_endpoint = otlp_endpoint.rstrip("/") if otlp_endpoint else None
+        self._lock = threading.Lock()
+        self._spans: deque[Span] = deque(maxlen=max_spans)
+        self._open: dict[str, Span] = {}
+        # LangChain run id -> span, for the tool code to attach its spans to
+        self._runs: dict[UUID, Span] = {}
+        self._queue: queue.Queue[Span] = queue.Queue()
+        self._exporting = self.enabled and (self.trace_dir is not None or bool(self.otlp_endpoint))
+        if self._exporting:
+            threading.Thread(target=self._export_loop, name="trace-export", daemon=True).start()
+
+    @classmethod
+    def instance(cls) -> Tracer:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def start_span(
+        self,
+        name: str,
+        parent: Span | None = None,
+        session_id: str | None = None,
+        **attributes: Any,
+    ) -> Span:
+        """Start a span under `parent`, or a new trace without one."""
+        if parent is not None:
+            span = parent.child(name, **attributes)
+        else:
+            span = Span(
+                name=name,
+                trace_id=secrets.token_hex(16),
+                span_id=secrets.token_hex(8),
+                parent_id=None,
+                start=time.time(),
+                session_id=session_id,
+                attributes=attributes,
+            )
+        with self._lock:
+            self._open[span.span_id] = span
+        return span
+
+    def end_span(self, span: Span, status: str | None = None, **attributes: Any) -> None:
+        span.end = time.time()
+        if status is not None:
+            span.status = status
+        span.attributes.update(attributes)
+        self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        with self._lock:
+            self._open.pop(span.span_id, None)
+            if not self.enabled:
+                return
+            self._spans.append(span)
+        if self._exporting:
+            self._queue.put(span)
+
+    @contextmanager
+    def span(self, name: str, parent: Span | None = None, **attributes: Any) -> Iterator[Span]:
+        span = self.start_span(name, parent, **attributes)
+        try:
+            yield span
+        except BaseException as exc:
+            self.end_span(span, "error", error=type(exc).__name__)
+            raise
+        self.end_span(span)
+
+    def record(
+        self, name: str, parent: Span | None, start: float, end: float, **attributes: Any
+    ) -> None:
+        """Record a span that has already finished (times from `time.time()`)."""
+        span = self.start_span(name, parent, **attributes)
+        span.start, span.end = start, end
+        self._finish(span)
+
+    def bind_run(self, run_id: UUID, span: Span) -> None:
+        with self._lock:
+            self._runs[run_id] = span
+
+    def unbind_run(self, run_id: UUID) -> None:
+        with self._lock:
+            self._runs.pop(run_id, None)
+
+    def span_for_run(self, run_id: UUID | None) -> Span | None:
+        """The span of a LangChain run (e.g. the tool call running some code)."""
+        with self._lock:
+            return self._runs.get(run_id) if run_id is not None else None
+
+    def enclosing(self, name: str) -> Span | None:
+        """The open span called `name`, if exactly one is open: requests the
+        kernels make can only be attributed to a run when one is running.
+        """
+        with self._lock:
+            spans = [span for span in self._open.values() if span.name == name]
+        return spans[0] if len(spans) == 1 else None
+
+    def spans(self) -> list[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def traces(self) -> dict[str, list[Span]]:
+        """Finished spans grouped by trace, oldest trace first."""
+        traces: dict[str, list[Span]] = {}
+        for span in sorted(self.spans(), key=lambda span: span.start):
+            traces.setdefault(span.trace_id, []).append(span)
+        return traces
+
+    def _export_loop(self) -> None:
+        client = httpx.Client(timeout=10) if self.otlp_endpoint else None
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + TRACE_EXPORT_INTERVAL
+            while (remaining := deadline - time.monotonic()) > 0 and len(batch) < 512:
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if self.trace_dir is not None:
+                try:
+                    append_lines(
+                        self.trace_dir / "spans.jsonl",
+                        [json.dumps(asdict(span), default=str) for span in batch],
+                    )
+                except OSError as exc:
+                    print(f"Failed to write spans: {exc}")
+            if client is not None:
+                payload = {
+                    "resourceSpans": [
+                        {
+                            "resource": {
+                                "attributes": [
+                                    {"key": "service.name", "value": _otlp_value(OTEL_SERVICE_NAME)}
+                                ]
+                            },
+                            "scopeSpans": [
+                                {"scope": {"name": "tracing"}, "spans": [_otlp_span(span) for span in batch]}
+                            ],
+                        }
+                    ]
+                }
+                try:
+                    client.post(f"{self.otlp_endpoint}/v1/traces", json=payload).raise_for_status()
+                except httpx.HTTPError as exc:
+                    print(f"Failed to export {len(batch)} spans to {self.otlp_endpoint}: {exc}")
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records one agent turn as a trace.
+
+    Parameters
+    ----------
+    session_id
+        The session the turn belongs to.
+    tracer
+        Where to record the spans; the process-wide tracer by default.
+    attributes
+        Recorded on the turn's span, e.g. the model selected for it.
+
+    """
+
+    # called in order in the task running the agent, so spans nest as they ran
+    run_inline = True
+
+    def __init__(self, session_id: str, tracer: Tracer | None = None, **attributes: Any):
+        self.session_id = session_id
+        self.tracer = tracer or Tracer.instance()
+        self.attributes = attributes
+        self.turn: Span | None = None
+        self._lock = threading.Lock()
+        self._spans: dict[UUID, Span] = {}
+        # parents of the runs without a span of their own (e.g. inner chains)
+        self._parents: dict[UUID, UUID | None] = {}
+
+    def _parent(self, parent_run_id: UUID | None) -> Span | None:
+        while parent_run_id is not None and parent_run_id not in self._spans:
+            parent_run_id = self._parents.get(parent_run_id)
+        return self._spans.get(parent_run_id) if parent_run_id is not None else self.turn
+
+    def _start(self, run_id: UUID, parent_run_id: UUID | None, name: str, **attributes: Any) -> None:
+        with self._lock:
+            span = self.tracer.start_span(
+                name, self._parent(parent_run_id), session_id=self.session_id, **attributes
+            )
+            self._spans[run_id] = span
+        self.tracer.bind_run(run_id, span)
+
+    def _end(self, run_id: UUID, status: str | None = None, **attributes: Any) -> Span | None:
+        with self._lock:
+            span = self._spans.pop(run_id, None)
+        if span is not None:
+            self.tracer.unbind_run(run_id)
+            self.tracer.end_span(span, status, **attributes)
+        return span
+
+    def on_chain_start(
+        self,
+        serialized: dict[str, Any],
+        inputs: dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        if parent_run_id is None and self.turn is None:
+            self._start(run_id, None, "turn")
+            self.turn = self._spans[run_id]
+            self.turn.attributes.update(
+                self.attributes, llm_calls=0, tool_calls=0, tool_errors=0, llm_retries=0
+            )
+        else:
+            self._parents[run_id] = parent_run_id
+
+    def on_chain_end(self, outputs: dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        self._parents.pop(run_id, None)
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._parents.pop(run_id, None)
+        self._end(run_id, "error", error=type(error).__name__)
+
+    def on_chat_model_start(
+        self,
+        serialized: dict[str, Any],
+        messages: list[list[Any]],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        params = kwargs.get("invocation_params") or {}
+        self._start(
+            run_id,
+            parent_run_id,
+            "llm",
+            model=params.get("model") or params.get("model_name") or "",
+            messages=sum(len(batch) for batch in messages),
+            retries=0,
+            # why the model router picked this model, when routing
+            route=(kwargs.get("metadata") or {}).get("route", ""),
+        )
+
+    def on_llm_start(
+        self,
+        serialized: dict[str, Any],
+        prompts: list[str],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        params = kwargs.get("invocation_params") or {}
+        self._start(
+            run_id,
+            parent_run_id,
+            "llm",
+            model=params.get("model") or params.get("model_name") or "",
+            prompt_chars=sum(len(prompt) for prompt in prompts),
+            retries=0,
+        )
+
+    def on_retry(self, retry_state: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            span = self._spans.get(run_id)
+            if span is not None:
+                span.attributes["retries"] = span.attributes.get("retries", 0) + 1
+            if self.turn is not None:
+                self.turn.attributes["llm_retries"] += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        usage = extract_usage(response)
+        output_chars = sum(
+            len(generation.text) for generations in response.generations for generation in generations
+        )
+        if self._end(run_id, output_chars=output_chars, **usage) is not None and self.turn is not None:
+            self.turn.attributes["llm_calls"] += 1
+            for key, value in usage.items():
+                self.turn.attributes[key] = self.turn.attributes.get(key, 0) + value
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, "error", error=type(error).__name__)
+
+    def on_tool_start(
+        self,
+        serialized: dict[str, Any],
+        input_str: str,
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> None:
+        self._start(
+            run_id, parent_run_id, f"tool:{serialized.get('name', 'tool')}", input_chars=len(input_str)
+        )
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        attributes: dict[str, Any] = {
+            "output_chars": len(output if isinstance(output, str) else json.dumps(output, default=str))
+        }
+        if isinstance(output, dict):
+            attributes["cached"] = bool(output.get("cached"))
+            attributes["images"] = len(output.get("images", []))
+        if self._end(run_id, **attributes) is not None and self.turn is not None:
+            self.turn.attributes["tool_calls"] += 1
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        if self._end(run_id, "error", error=type(error).__name__) is not None and self.turn is not None:
+            self.turn.attributes["tool_calls"] += 1
+            self.turn.attributes["tool_errors"] += 1
+
+    def close(self, status: str = "cancelled") -> None:
+        """End whatever is still open, e.g. when the turn was stopped."""
+        with self._lock:
+            open_runs = list(self._spans)
+        # innermost first, so that parents end after their children
+        for run_id in reversed(open_runs):
+            self._end(run_id, status)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """The `q`-th percentile (0-100) of `values`, by linear interpolation."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+__all__ = ("Span", "Tracer", "TracingCallbackHandler", "append_lines", "percentile")